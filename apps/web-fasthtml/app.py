@@ -5,18 +5,37 @@ from fasthtml.common import (
     HtmxHeaders,
     Link,
     Redirect,
+    Response,
+    Script,
+    StreamingResponse,
     fast_app,
     picolink,
     serve,
+    to_xml,
+)
+from templates import (
+    get_archive_progress,
+    get_archive_ui,
+    get_edit,
+    get_index,
+    get_new,
+    get_rows,
+    get_show,
 )
-from templates import get_archive_ui, get_edit, get_index, get_new, get_rows, get_show
 
 import htmx_experiments.contact as htmx_contact
-from htmx_experiments.archiver import Archiver
+from htmx_experiments.archiver import (
+    Archiver,
+    accepts_gzip,
+    etag_matches,
+    read_archive,
+)
 from htmx_experiments.contact import Contact
+from htmx_experiments.table import SORTS
 
 htmx_contact.PAGE_SIZE = 10  # Controls number of items in pagination
-Contact.load_db()
+# loads the contacts once they are first needed, `create_app` right away
+Contact.init(warm_up=False)
 
 
 @dataclass
@@ -28,7 +47,9 @@ class FormData:
 
 
 css = Link(rel="stylesheet", href="site.css", type="text/css")
-app, rt = fast_app(hdrs=(picolink, css), static_path="./static")
+# htmx 2 receives server-sent events with an extension, see get_archive_ui
+sse = Script(src="https://cdn.jsdelivr.net/npm/htmx-ext-sse@2.2.2/sse.js")
+app, rt = fast_app(hdrs=(picolink, css, sse), static_path="./static")
 
 
 @app.route("/")
@@ -36,19 +57,49 @@ def index():
     return Redirect("/contacts")
 
 
+@app.route("/healthz")
+def healthz():
+    "Answers right away, even while the contacts are still loading."
+    return "ok"
+
+
+@app.route("/readyz")
+def readyz():
+    "Answers 200 only once the contacts are loaded and indexed, see `Contact.init`."
+    if Contact.ready():
+        return "ready"
+    return Response("loading", status_code=503)
+
+
 @app.route("/contacts", methods=["GET"])
-def contacts(headers: HtmxHeaders, q: str | None = None, page: int | None = 0):
+def contacts(
+    headers: HtmxHeaders,
+    session,
+    q: str | None = None,
+    page: int | None = 0,
+    after_id: int | None = None,
+    sort: str | None = None,
+):
     search = q
     page = int(page) if page else 1
 
+    more = False
     if search is not None:
-        contacts_set = Contact.search(search)
-        if headers.trigger_name == "q":
-            return get_rows(contacts=contacts_set)
+        # one page of matches at a time, continuing after the last one shown
+        contacts_set = Contact.search(search, after_id)
+        more = len(contacts_set) == htmx_contact.PAGE_SIZE
+        if not contacts_set and after_id is None:
+            # nothing matches exactly, show the contacts closest to the typo instead
+            contacts_set = Contact.search(search, fuzzy=True)
+        if headers.trigger_name == "q" or headers.trigger == "more-results":
+            return get_rows(contacts=contacts_set, q=search, more=more)
     else:
-        contacts_set = Contact.all(page)
+        # first, last or email, "-" in front for descending, e.g. ?sort=-last&page=2
+        if sort not in SORTS:
+            sort = None  # unknown orders list the contacts by id
+        contacts_set = Contact.all(page, sort=sort)
 
-    return get_index(contacts_set, page, search)
+    return get_index(contacts_set, page, search, more, sort, session.get("archive_job"))
 
 
 @app.route("/contacts/count")
@@ -109,7 +160,8 @@ def contacts_email_get(email: str, contact_id: int = 0):
     if c is None:
         raise NotImplementedError(f"Tried to find non-existing {contact_id=}")
 
-    c.email = email
+    # a copy, so that the stored contact and the email index stay as they are
+    c = Contact(c.id, c.first, c.last, c.phone, email)
     c.validate()
     return c.errors.get("email") or ""
 
@@ -132,35 +184,84 @@ def contacts_delete(headers: HtmxHeaders, contact_id: int = 0):
 
 
 @app.route("/contacts/archive", methods=["POST"])
-def start_archive():
+def start_archive(session, format: str = "json", since: str | None = None):
     "Added to enable archive UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_adding_the_archiving_endpoint"
-    archiver = Archiver.get()
-    archiver.run()
+    try:
+        # `since`, the ETag of an earlier archive, asks for the changes since
+        archiver = Archiver.submit(format, since)
+    except ValueError as e:
+        return Response(str(e), status_code=400)
+    # each user follows their own job, also after leaving the page
+    session["archive_job"] = archiver.id
     return get_archive_ui(archiver)
 
 
-@app.route("/contacts/archive/status", methods=["GET"])
-def archive_status():
+@app.route("/contacts/archive/{job_id}/status", methods=["GET"])
+def archive_status(job_id: str):
     "Added to enable archive UI polling status update, see https://hypermedia.systems/a-dynamic-archive-ui/#_adding_the_progress_bar_ui"
-    archiver = Archiver.get()
+    archiver = Archiver.get(job_id)
     return get_archive_ui(archiver)
 
 
-@app.route("/contacts/archive/file", methods=["GET"])
-def archive_content():
+@app.route("/contacts/archive/{job_id}/events", methods=["GET"])
+def archive_events(job_id: str):
+    "Pushes the progress of the job as server-sent events, instead of the archive UI polling it"
+    archiver = Archiver.get(job_id)
+    # waiting streams hold no thread, so the server can keep many of them open
+    events = archiver.aevents(lambda: to_xml(get_archive_progress(archiver)))
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # proxies mustn't cache or buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/contacts/archive/{job_id}/file", methods=["GET"])
+def archive_content(job_id: str, request):
     "Added to enable file download in the archiver UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_downloading_the_result"
-    manager = Archiver.get()
-    return FileResponse(
-        manager.archive_file(), filename="contacts.json", media_type="text/plain"
+    manager = Archiver.get(job_id)
+    if manager.status() != "Complete":
+        return Response("archive not found", status_code=404)
+    headers = {"ETag": manager.etag(), "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), manager.digest):
+        # the client has the archive already
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip(request.headers.get("accept-encoding")):
+        # the archive is stored compressed, so it is sent as is
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(
+            manager.archive_file(),
+            filename=manager.download_name(),
+            media_type=manager.media_type(),
+            headers=headers,
+        )
+    headers["Content-Disposition"] = f"attachment; filename={manager.download_name()}"
+    headers["Content-Length"] = str(manager.size)
+    return StreamingResponse(
+        read_archive(manager.archive_file()),
+        media_type=manager.media_type(),
+        headers=headers,
     )
 
 
-@app.route("/contacts/archive/delete", methods=["DELETE"])
-def reset_archive():
+@app.route("/contacts/archive/{job_id}/delete", methods=["DELETE"])
+def reset_archive(job_id: str, session):
     "Added to enable cancellation of download in the archiver UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_dismissing_the_download_ui"
-    archiver = Archiver.get()
-    archiver.reset()
-    return get_archive_ui(archiver)
+    Archiver.cancel(job_id)
+    session.pop("archive_job", None)
+    return get_archive_ui(Archiver.get())
+
+
+def create_app(data_dir=None, warm_up=True):
+    """The app, serving the contacts in `data_dir`, by default `CONTACTS_DATA_DIR`.
+
+    The contacts load in the background, see /readyz. Servers with several worker
+    processes should create the app in each worker, e.g.
+    uvicorn --factory app:create_app --workers 4.
+    """
+    Contact.init(warm_up, data_dir)
+    return app
 
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+from urllib.parse import urlencode
+
 from fasthtml.common import (
     FT,
     H1,
@@ -10,7 +12,9 @@ from fasthtml.common import (
     Input,
     Label,
     Legend,
+    Option,
     P,
+    Select,
     Span,
     Table,
     Tbody,
@@ -25,7 +29,7 @@ from htmx_experiments.archiver import Archiver
 from htmx_experiments.contact import Contact
 
 
-def get_rows(contacts: list[Contact]) -> FT:
+def get_rows(contacts: list[Contact], q: str | None = None, more: bool = False) -> FT:
     _get_td_view = lambda c: Td(A("View", href=f"/contacts/{c.id}"))
     _get_td_edit = lambda c: Td(A("Edit", href=f"/contacts/{c.id}/edit"))
     _get_td_delete = lambda c: Td(
@@ -50,6 +54,25 @@ def get_rows(contacts: list[Contact]) -> FT:
         )
         for c in contacts
     )
+    if more:
+        # replaced by the rows of the next page of matches, see https://hypermedia.systems/htmx-patterns/#_click_to_load
+        url = "/contacts?" + urlencode({"q": q, "after_id": contacts[-1].id})
+        rows.children += (
+            Tr(
+                Td(
+                    A(
+                        "More results",
+                        id="more-results",
+                        href=url,
+                        hx_get=url,
+                        hx_target="closest tr",
+                        hx_swap="outerHTML",
+                        hx_select="tbody > tr",
+                    ),
+                    colspan="7",
+                )
+            ),
+        )
     return rows
 
 
@@ -73,16 +96,39 @@ def get_layout(*args, h1_str: str = "contacts.app"):
     return title, Container(h1, *args)
 
 
-def get_index(contacts, page: int, search: str | None = None):
-    archive_ui = get_archive_ui(Archiver.get())
+def get_sort_header(label: str, field: str, sort: str | None):
+    "Header sorting by `field`, in descending order if the page is sorted by it already."
+    order = f"-{field}" if sort == field else field
+    return Th(A(label, href=f"/contacts?sort={order}"))
+
+
+def get_index(
+    contacts,
+    page: int,
+    search: str | None = None,
+    more: bool = False,
+    sort: str | None = None,
+    archive_job: str | None = None,
+):
+    archive_ui = get_archive_ui(Archiver.get(archive_job))
     search_ui = get_search(search)
 
-    head = (Thead(Tr(Th("First"), Th("Last"), Th("Phone"), Th("Email"))),)
-    rows = get_rows(contacts)
+    head = (
+        Thead(
+            Tr(
+                get_sort_header("First", "first", sort),
+                get_sort_header("Last", "last", sort),
+                Th("Phone"),
+                get_sort_header("Email", "email", sort),
+            )
+        ),
+    )
+    rows = get_rows(contacts, search, more)
     table = Table(head, rows)
 
-    a_previous = A("Previous", href=f"/contacts?page={page - 1}")
-    a_next = A("Next", href=f"/contacts?page={page + 1}")
+    sorted_by = f"&sort={sort}" if sort else ""
+    a_previous = A("Previous", href=f"/contacts?page={page - 1}{sorted_by}")
+    a_next = A("Next", href=f"/contacts?page={page + 1}{sorted_by}")
     pager = P(Div(Span((a_previous, a_next), style="float: right")))
 
     add_contacts = A("Add Contact", href="/contacts/new")
@@ -188,37 +234,68 @@ def get_edit(c: Contact):
     return get_layout(edit_form, navigation)
 
 
+def get_archive_progress(archiver: Archiver):
+    "The progress of a running job, also sent as server-sent events by `archive_events`."
+    return (
+        f"{archiver.status()} ...",
+        "Creating Archive ...",
+        Div(
+            Div(
+                id="archive-progress",
+                _class="progress-bar",
+                aria_valuenow=f"{archiver.progress() * 100}",
+                style=f"width:{archiver.progress() * 100}%",
+            ),
+            _class="progress",
+        ),
+    )
+
+
 def get_archive_ui(archiver: Archiver):
     _id = "archive-ui"
-    url = "/contacts/archive"
+    url = f"/contacts/archive/{archiver.id}"
     match archiver.status():
         case "Waiting":
             return Div(
+                # all formats are gzip compressed, browsers decode them while downloading
+                Select(
+                    Option("JSON", value="json"),
+                    Option("NDJSON", value="ndjson"),
+                    Option("CSV", value="csv"),
+                    id="archive-format",
+                    name="format",
+                    aria_label="Archive format",
+                ),
                 Button(
                     "Download Contact Archive",
-                    hx_post=url,
+                    hx_post="/contacts/archive",
+                    hx_include="#archive-format",
                 ),
                 id=_id,
                 hx_target="this",
                 hx_swap="outerHTML",
             )
 
-        case "Running":
+        case "Queued" | "Running":
+            # the server pushes the progress as server-sent events when it changes, see
+            # https://htmx.org/extensions/sse/, and the job's UI is fetched once it is
+            # finished. If the event stream fails, the UI is fetched again after a
+            # second, which polls instead.
             return Div(
-                "Running ...",
                 Div(
-                    "Creating Archive ...",
                     Div(
-                        Div(
-                            id="archive-progress",
-                            _class="progress-bar",
-                            aria_valuenow=f"{archiver.progress() * 100}",
-                            style=f"width:{archiver.progress() * 100}%",
-                        ),
-                        _class="progress",
+                        get_archive_progress(archiver),
+                        sse_swap="progress",
+                        hx_target="this",
+                        hx_swap="innerHTML",
+                    ),
+                    Div(
+                        hx_get=f"{url}/status",  # if "/update" is not used as in web4 / web5 etc this yields a 404 *shrug*
+                        hx_trigger="sse:done, htmx:sseError from:#archive-events delay:1s",
                     ),
-                    hx_get=f"{url}/status",  # if "/update" is not used as in web4 / web5 etc this yields a 404 *shrug*
-                    hx_trigger="load delay:500ms",
+                    id="archive-events",
+                    hx_ext="sse",
+                    sse_connect=f"{url}/events",
                 ),
                 id=_id,
                 hx_target="this",
@@ -238,5 +315,13 @@ def get_archive_ui(archiver: Archiver):
                 hx_target="this",
                 hx_swap="outerHTML",
             )
+        case "Failed":
+            return Div(
+                "Creating the archive failed.",
+                Button("Clear", hx_delete=f"{url}/delete"),
+                id=_id,
+                hx_target="this",
+                hx_swap="outerHTML",
+            )
         case _:
             raise NotImplementedError()
@@ -1,42 +1,65 @@
 "Based on Contact.app described in https://hypermedia.systems/a-web-1-0-application/ available here https://github.com/bigskysoftware/contact-app"
 
-from flask import Flask, flash, redirect, render_template, request
+from flask import Blueprint, Flask, flash, redirect, render_template, request
 
 import htmx_experiments.contact as htmx_contact
 from htmx_experiments.contact import Contact
+from htmx_experiments.table import SORTS
 
 htmx_contact.PAGE_SIZE = 10  # Controls number of items in pagination
 
-Contact.load_db()
-app = Flask(__name__)
-app.secret_key = b"hypermedia rocks"
+bp = Blueprint("contacts", __name__)
 
 
-@app.route("/")
+@bp.route("/")
 def index():
     return redirect("/contacts")
 
 
-@app.route("/contacts")
+@bp.route("/healthz")
+def healthz():
+    "Answers right away, even while the contacts are still loading."
+    return "ok"
+
+
+@bp.route("/readyz")
+def readyz():
+    "Answers 200 only once the contacts are loaded and indexed, see `Contact.init`."
+    if Contact.ready():
+        return "ready"
+    return "loading", 503
+
+
+@bp.route("/contacts")
 def contacts():
     search = request.args.get("q")
     # `page` related changes to enable paging, see https://hypermedia.systems/htmx-patterns/#_another_application_improvement_paging
     page = int(request.args.get("page", 1))
+    sort = None
+    more = False
     if search is not None:
-        contacts_set = Contact.search(search)
+        # one page of matches at a time, continuing after the last one shown
+        contacts_set = Contact.search(search, request.args.get("after_id"))
+        more = len(contacts_set) == htmx_contact.PAGE_SIZE
     else:
-        contacts_set = Contact.all(page)
-    return render_template("index.html", contacts=contacts_set, page=page)
+        # first, last or email, "-" in front for descending, e.g. ?sort=-last&page=2
+        sort = request.args.get("sort")
+        if sort not in SORTS:
+            sort = None  # unknown orders list the contacts by id
+        contacts_set = Contact.all(page, sort=sort)
+    return render_template(
+        "index.html", contacts=contacts_set, page=page, sort=sort, more=more
+    )
 
 
-@app.route("/contacts/new", methods=["GET"])
+@bp.route("/contacts/new", methods=["GET"])
 def contacts_new_get():
     return render_template(
         "new.html", contact=Contact()
     )  # TODO: why are new contacts initialized with _id=None here and below?
 
 
-@app.route("/contacts/new", methods=["POST"])
+@bp.route("/contacts/new", methods=["POST"])
 def contacts_new():
     c = Contact(
         None,
@@ -53,19 +76,19 @@ def contacts_new():
         return render_template("new.html", contact=c)
 
 
-@app.route("/contacts/<contact_id>", methods=["GET"])
+@bp.route("/contacts/<contact_id>", methods=["GET"])
 def contacts_view(contact_id=0):
     contact = Contact.find(contact_id)
     return render_template("show.html", contact=contact)
 
 
-@app.route("/contacts/<contact_id>/edit", methods=["GET"])
+@bp.route("/contacts/<contact_id>/edit", methods=["GET"])
 def contacts_edit_get(contact_id=0):
     contact = Contact.find(contact_id)
     return render_template("edit.html", contact=contact)
 
 
-@app.route("/contacts/<contact_id>/edit", methods=["POST"])
+@bp.route("/contacts/<contact_id>/edit", methods=["POST"])
 def contacts_edit_post(contact_id=0):
     c = Contact.find(contact_id)
     if c is None:
@@ -83,18 +106,19 @@ def contacts_edit_post(contact_id=0):
         return render_template("edit.html", contact=c)
 
 
-@app.route("/contacts/<contact_id>/email", methods=["GET"])
+@bp.route("/contacts/<contact_id>/email", methods=["GET"])
 def contacts_email_get(contact_id=0):
     "Validating e-mails server side, see https://hypermedia.systems/htmx-patterns/#_validating_emails_server_side"
     c = Contact.find(contact_id)
     if c is None:
         raise NotImplementedError(f"Tried to find non-existing {contact_id=}")
-    c.email = request.args.get("email")
+    # a copy, so that the stored contact and the email index stay as they are
+    c = Contact(c.id, c.first, c.last, c.phone, request.args.get("email"))
     c.validate()
     return c.errors.get("email") or ""
 
 
-@app.route("/contacts/<contact_id>", methods=["DELETE"])
+@bp.route("/contacts/<contact_id>", methods=["DELETE"])
 def contacts_delete(contact_id=0):
     c = Contact.find(contact_id)
     if c is None:
@@ -104,3 +128,21 @@ def contacts_delete(contact_id=0):
     return redirect(
         "/contacts", 303
     )  # 303 necessary, explanation here https://hypermedia.systems/htmx-patterns/#_a_response_code_gotcha
+
+
+def create_app(data_dir=None, warm_up=True) -> Flask:
+    """The app, serving the contacts in `data_dir`, by default `CONTACTS_DATA_DIR`.
+
+    The contacts load in the background, see /readyz. Servers with several worker
+    processes should create the app in each worker, e.g. gunicorn "app:create_app()".
+    """
+    Contact.init(warm_up, data_dir)
+    app = Flask(__name__)
+    app.secret_key = b"hypermedia rocks"
+    app.register_blueprint(bp)
+    return app
+
+
+# for `flask run`, which loads the contacts once they are first needed, so that
+# importing this module starts no thread
+app = create_app(warm_up=False)
@@ -1,72 +1,123 @@
 "Based on Contact.app described in https://hypermedia.systems/a-web-1-0-application/ available here https://github.com/bigskysoftware/contact-app"
 
-from flask import Flask, flash, redirect, render_template, request, send_file
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    flash,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    stream_with_context,
+)
 
 import htmx_experiments.contact as htmx_contact
-from htmx_experiments.archiver import Archiver
+from htmx_experiments.archiver import (
+    Archiver,
+    accepts_gzip,
+    etag_matches,
+    read_archive,
+)
 from htmx_experiments.contact import Contact
+from htmx_experiments.table import SORTS
 
 htmx_contact.PAGE_SIZE = 10  # Controls number of items in pagination
 
-Contact.load_db()
-app = Flask(__name__)
-app.secret_key = b"hypermedia rocks"
+bp = Blueprint("contacts", __name__)
 
 
-@app.route("/")
+@bp.route("/")
 def index():
     return redirect("/contacts")
 
 
-@app.route("/contacts", methods=["GET"])
+@bp.route("/healthz")
+def healthz():
+    "Answers right away, even while the contacts are still loading."
+    return "ok"
+
+
+@bp.route("/readyz")
+def readyz():
+    "Answers 200 only once the contacts are loaded and indexed, see `Contact.init`."
+    if Contact.ready():
+        return "ready"
+    return "loading", 503
+
+
+@bp.route("/contacts", methods=["GET"])
 def contacts():
     search = request.args.get("q")
     # `page` related changes to enable paging, see https://hypermedia.systems/htmx-patterns/#_another_application_improvement_paging
     page = int(request.args.get("page", 1))
+    sort = None
+    more = False
     if search is not None:
-        contacts_set = Contact.search(search)
+        # one page of matches at a time, continuing after the last one shown
+        contacts_set = Contact.search(search, request.args.get("after_id"))
+        more = len(contacts_set) == htmx_contact.PAGE_SIZE
+        if not contacts_set and request.args.get("after_id") is None:
+            # nothing matches exactly, show the contacts closest to the typo instead
+            contacts_set = Contact.search(search, fuzzy=True)
         # send smaller html if search trigger, see https://hypermedia.systems/more-htmx-patterns/#_http_request_headers_in_htmx and https://hypermedia.systems/more-htmx-patterns/#_using_our_new_template
-        if request.headers.get("HX-Trigger") == "search":
-            return render_template("rows.html", contacts=contacts_set)
+        if request.headers.get("HX-Trigger") in ("search", "more-results"):
+            return render_template("rows.html", contacts=contacts_set, more=more)
     else:
-        contacts_set = Contact.all(page)
+        # first, last or email, "-" in front for descending, e.g. ?sort=-last&page=2
+        sort = request.args.get("sort")
+        if sort not in SORTS:
+            sort = None  # unknown orders list the contacts by id
+        contacts_set = Contact.all(page, sort=sort)
     return render_template(
-        "index.html", contacts=contacts_set, page=page, archiver=Archiver.get()
+        "index.html",
+        contacts=contacts_set,
+        page=page,
+        sort=sort,
+        more=more,
+        archiver=Archiver.get(session.get("archive_job")),
     )  # for archiver part see https://hypermedia.systems/a-dynamic-archive-ui/#_conditionally_rendering_a_progress_ui
 
 
-@app.route("/contacts/", methods=["DELETE"])
+@bp.route("/contacts/", methods=["DELETE"])
 def contacts_delete_all():
     "Bulk delete, see https://hypermedia.systems/more-htmx-patterns/#_the_server_side_for_delete_selected_contacts"
     contact_ids = [int(id) for id in request.args.getlist("selected_contact_ids")]
     page = int(request.args.get("page", 1))
-    for contact_id in contact_ids:
-        c = Contact.find(contact_id)
-        if c is None:
-            raise NotImplementedError(f"Tried to find non-existing {contact_id=}")
-        c.delete()
+    # a batch writes the store once for all selected contacts
+    with Contact.batch() as batch:
+        for contact_id in contact_ids:
+            c = Contact.find(contact_id)
+            if c is None:
+                raise NotImplementedError(f"Tried to find non-existing {contact_id=}")
+            batch.delete(c)
     flash("Deleted Contacts!")
     contacts_set = Contact.all()
     return render_template(
-        "index.html", contacts=contacts_set, page=page, archiver=Archiver.get()
+        "index.html",
+        contacts=contacts_set,
+        page=page,
+        archiver=Archiver.get(session.get("archive_job")),
     )  # for archiver part see https://hypermedia.systems/a-dynamic-archive-ui/#_conditionally_rendering_a_progress_ui
 
 
-@app.route("/contacts/count")
+@bp.route("/contacts/count")
 def contacts_count():
     "`count` here to enable lazy loading, see https://hypermedia.systems/more-htmx-patterns/#_lazy_loading"
     count = Contact.count()
     return "(" + str(count) + " total Contacts)"
 
 
-@app.route("/contacts/new", methods=["GET"])
+@bp.route("/contacts/new", methods=["GET"])
 def contacts_new_get():
     return render_template(
         "new.html", contact=Contact()
     )  # TODO: why are new contacts initialized with _id=None here and below?
 
 
-@app.route("/contacts/new", methods=["POST"])
+@bp.route("/contacts/new", methods=["POST"])
 def contacts_new():
     c = Contact(
         None,
@@ -83,19 +134,19 @@ def contacts_new():
         return render_template("new.html", contact=c)
 
 
-@app.route("/contacts/<contact_id>", methods=["GET"])
+@bp.route("/contacts/<contact_id>", methods=["GET"])
 def contacts_view(contact_id=0):
     contact = Contact.find(contact_id)
     return render_template("show.html", contact=contact)
 
 
-@app.route("/contacts/<contact_id>/edit", methods=["GET"])
+@bp.route("/contacts/<contact_id>/edit", methods=["GET"])
 def contacts_edit_get(contact_id=0):
     contact = Contact.find(contact_id)
     return render_template("edit.html", contact=contact)
 
 
-@app.route("/contacts/<contact_id>/edit", methods=["POST"])
+@bp.route("/contacts/<contact_id>/edit", methods=["POST"])
 def contacts_edit_post(contact_id=0):
     c = Contact.find(contact_id)
     if c is None:
@@ -113,18 +164,19 @@ def contacts_edit_post(contact_id=0):
         return render_template("edit.html", contact=c)
 
 
-@app.route("/contacts/<contact_id>/email", methods=["GET"])
+@bp.route("/contacts/<contact_id>/email", methods=["GET"])
 def contacts_email_get(contact_id=0):
     "Validating e-mails server side, see https://hypermedia.systems/htmx-patterns/#_validating_emails_server_side"
     c = Contact.find(contact_id)
     if c is None:
         raise NotImplementedError(f"Tried to find non-existing {contact_id=}")
-    c.email = request.args.get("email")
+    # a copy, so that the stored contact and the email index stay as they are
+    c = Contact(c.id, c.first, c.last, c.phone, request.args.get("email"))
     c.validate()
     return c.errors.get("email") or ""
 
 
-@app.route("/contacts/<contact_id>", methods=["DELETE"])
+@bp.route("/contacts/<contact_id>", methods=["DELETE"])
 def contacts_delete(contact_id=0):
     c = Contact.find(contact_id)
     if c is None:
@@ -140,31 +192,99 @@ def contacts_delete(contact_id=0):
         return ""
 
 
-@app.route("/contacts/archive", methods=["POST"])
+@bp.route("/contacts/archive", methods=["POST"])
 def start_archive():
     "Added to enable archive UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_adding_the_archiving_endpoint"
-    archiver = Archiver.get()
-    archiver.run()
+    try:
+        # `since`, the ETag of an earlier archive, asks for the changes since
+        archiver = Archiver.submit(
+            request.form.get("format", "json"), request.form.get("since")
+        )
+    except ValueError:
+        abort(400)
+    # each user follows their own job, also after leaving the page
+    session["archive_job"] = archiver.id
     return render_template("archive_ui.html", archiver=archiver)
 
 
-@app.route("/contacts/archive", methods=["GET"])
-def archive_status():
+@bp.route("/contacts/archive/<job_id>", methods=["GET"])
+def archive_status(job_id):
     "Added to enable archive UI polling status update, see https://hypermedia.systems/a-dynamic-archive-ui/#_adding_the_progress_bar_ui"
-    archiver = Archiver.get()
+    archiver = Archiver.get(job_id)
     return render_template("archive_ui.html", archiver=archiver)
 
 
-@app.route("/contacts/archive/file", methods=["GET"])
-def archive_content():
-    "Added to enable file download in the archiver UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_downloading_the_result"
-    manager = Archiver.get()
-    return send_file(manager.archive_file(), "archive.json", as_attachment=True)
+@bp.route("/contacts/archive/<job_id>/events", methods=["GET"])
+def archive_events(job_id):
+    "Pushes the progress of the job as server-sent events, instead of the archive UI polling it"
+    archiver = Archiver.get(job_id)
+    events = archiver.events(
+        lambda: render_template("archive_progress.html", archiver=archiver)
+    )
+    return current_app.response_class(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        # proxies mustn't cache or buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
-@app.route("/contacts/archive", methods=["DELETE"])
-def reset_archive():
+@bp.route("/contacts/archive/<job_id>/file", methods=["GET"])
+def archive_content(job_id):
+    "Added to enable file download in the archiver UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_downloading_the_result"
+    manager = Archiver.get(job_id)
+    if manager.status() != "Complete":
+        abort(404)
+    if etag_matches(request.headers.get("If-None-Match"), manager.digest):
+        # the client has the archive already
+        response = current_app.response_class(status=304)
+    elif accepts_gzip(request.headers.get("Accept-Encoding")):
+        # the archive is stored compressed, so it is sent as is
+        response = send_file(
+            manager.archive_file(),
+            manager.media_type(),
+            as_attachment=True,
+            download_name=manager.download_name(),
+            etag=False,
+        )
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = current_app.response_class(
+            read_archive(manager.archive_file()),
+            mimetype=manager.media_type(),
+            headers={
+                "Content-Disposition": f"attachment; filename={manager.download_name()}",
+                "Content-Length": str(manager.size),
+            },
+        )
+    response.headers["ETag"] = manager.etag()
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+@bp.route("/contacts/archive/<job_id>", methods=["DELETE"])
+def reset_archive(job_id):
     "Added to enable cancellation of download in the archiver UI, see https://hypermedia.systems/a-dynamic-archive-ui/#_dismissing_the_download_ui"
-    archiver = Archiver.get()
-    archiver.reset()
-    return render_template("archive_ui.html", archiver=archiver)
+    Archiver.cancel(job_id)
+    session.pop("archive_job", None)
+    return render_template(
+        "archive_ui.html", archiver=Archiver.get(session.get("archive_job"))
+    )
+
+
+def create_app(data_dir=None, warm_up=True) -> Flask:
+    """The app, serving the contacts in `data_dir`, by default `CONTACTS_DATA_DIR`.
+
+    The contacts load in the background, see /readyz. Servers with several worker
+    processes should create the app in each worker, e.g. gunicorn "app:create_app()".
+    """
+    Contact.init(warm_up, data_dir)
+    app = Flask(__name__)
+    app.secret_key = b"hypermedia rocks"
+    app.register_blueprint(bp)
+    return app
+
+
+# for `flask run`, which loads the contacts once they are first needed, so that
+# importing this module starts no thread
+app = create_app(warm_up=False)
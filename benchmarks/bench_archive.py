@@ -0,0 +1,99 @@
+"""Size and time of contact archives, per format.
+
+    python benchmarks/bench_archive.py [number of contacts]
+
+Each format is written gzip compressed by `write_archive`, as the apps do. The
+baseline is the previous download, contacts.json uncompressed and indented.
+Then the jobs of `ArchiveManager` are timed for an archive of the unchanged
+store, which reuses the previous one, and for the changes since, after 1% of the
+contacts changed.
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import htmx_experiments.contact as htmx_contact  # noqa: E402
+from htmx_experiments.archiver import FORMATS, ArchiveManager, write_archive  # noqa: E402
+from htmx_experiments.contact import Contact  # noqa: E402
+from htmx_experiments.table import ContactTable  # noqa: E402
+
+SYLLABLES = "ka lo mi ra ne to su an el is or um ba de fi go hu ja".split()
+
+
+def name(rng: random.Random) -> str:
+    return "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+
+
+def generate(n: int) -> ContactTable:
+    rng = random.Random(0)
+    table = ContactTable()
+    for i in range(1, n + 1):
+        first, last = name(rng), name(rng)
+        phone = f"555-{rng.randrange(10**7):07d}"
+        email = f"{first}.{last}{i}@example.com".lower()
+        table[i] = Contact(i, first, last, phone, email)
+    return table
+
+
+def main(n: int):
+    table = generate(n)
+    print(f"{n} contacts")
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "contacts.json"
+        t = time.perf_counter()
+        rows = [c.row() for c in table.values()]
+        with open(path, "w") as f:
+            json.dump({"next_id": table.next_id, "contacts": rows}, f, indent=2)
+        baseline = path.stat().st_size
+        print(
+            f"{'baseline':>8}: {baseline / 1e6:7.2f} MB, "
+            f"{time.perf_counter() - t:.2f} s, indented json, not compressed"
+        )
+
+        for format_ in FORMATS:
+            path = Path(directory) / f"archive.{format_}.gz"
+            t = time.perf_counter()
+            size = write_archive(table, path, format_=format_)
+            elapsed = time.perf_counter() - t
+            compressed = path.stat().st_size
+            print(
+                f"{format_:>8}: {compressed / 1e6:7.2f} MB, {elapsed:.2f} s, "
+                f"{size / 1e6:.2f} MB uncompressed, "
+                f"{baseline / compressed:.1f}x smaller than the baseline"
+            )
+
+        htmx_contact.DATA_DIR = directory
+        Contact.db = table
+        manager = ArchiveManager()
+        full = timed("full", manager, "json")
+        timed("again", manager, "json")
+        for id_ in range(1, n + 1, 100):
+            c = table[id_]
+            table[id_] = Contact(id_, "Changed", c.last, c.phone, c.email)
+        timed("changes", manager, "json", full.digest)
+
+
+def timed(label: str, manager: ArchiveManager, format_: str, since=None):
+    "Times a job of `manager` until it is complete."
+    t = time.perf_counter()
+    job = manager.submit(format_, since)
+    while job.status() != "Complete":
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - t
+    print(
+        f"{label:>8}: {os.path.getsize(job.archive_file()) / 1e6:7.2f} MB, "
+        f"{elapsed * 1000:.1f} ms"
+    )
+    return job
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,73 @@
+"""Cost of many clients following the progress of an archive job.
+
+    python benchmarks/bench_events.py [number of streams]
+
+Each client holds an event stream of `Archiver.aevents` on one event loop, as the
+fasthtml app serves them, while a worker thread reports the progress of a job in
+steps of a tenth of a percent. Streams are only woken for the 100 changes of the
+shown percent. The baseline is the previous polling every 500 ms, counted in
+requests a job of the same duration would have cost.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from htmx_experiments.archiver import Archiver  # noqa: E402
+
+STEPS = 200
+CHUNK_TIME = 0.005  # seconds to serialize and compress a chunk of 1000 rows
+POLL_INTERVAL = 0.5
+
+
+def run_job(job: Archiver, started: threading.Event):
+    started.wait()
+    job.set_status("Running")
+    for step in range(1, STEPS + 1):
+        job.report(step / STEPS)
+        time.sleep(CHUNK_TIME)
+    job.set_status("Complete")
+
+
+async def follow(job: Archiver, counts: list[int]):
+    async for _ in job.aevents(lambda: f"{job.progress():.0%}"):
+        counts.append(1)
+
+
+async def main(n: int):
+    job = Archiver("bench")
+    started = threading.Event()
+    worker = threading.Thread(target=run_job, args=(job, started))
+    worker.start()
+    counts = []
+    tracemalloc.start()
+    tasks = [asyncio.create_task(follow(job, counts)) for _ in range(n)]
+    await asyncio.sleep(0.1)  # until all streams wait for changes
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    threads = threading.active_count()
+    t = time.perf_counter()
+    started.set()
+    await asyncio.gather(*tasks)
+    await asyncio.to_thread(worker.join)
+    elapsed = time.perf_counter() - t
+    print(
+        f"{n} streams: {threads} threads, {memory / max(n, 1) / 1024:.1f} KiB per "
+        f"stream, {len(counts) / max(n, 1):.0f} events each, job took {elapsed:.2f} s"
+    )
+    if n:
+        print(
+            f"polling: {elapsed / POLL_INTERVAL:.0f} requests each, "
+            f"{n * elapsed / POLL_INTERVAL:.0f} in all rendering the whole archive UI"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(0))
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000))
@@ -0,0 +1,147 @@
+"""Latency of fuzzy searches with typos, per storage backend.
+
+    python benchmarks/bench_fuzzy.py [number of contacts]
+
+Queries are names of random contacts with one typo each, searched for the first
+page of 10 results. The naive alternative, comparing the query to every word of
+every contact, is timed for one of them as a baseline. Exits with 1 if a backend
+misses `TARGET_P95`.
+"""
+
+import random
+import statistics
+import sys
+import tempfile
+import time
+from difflib import SequenceMatcher
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from htmx_experiments.contact import Contact  # noqa: E402
+from htmx_experiments.fuzzy import max_edits, words  # noqa: E402
+from htmx_experiments.shared_store import SharedStore  # noqa: E402
+from htmx_experiments.sqlite_store import SqliteStore  # noqa: E402
+from htmx_experiments.table import ContactTable, fold, search_key  # noqa: E402
+
+TARGET_P95 = 0.1  # seconds, about what still feels instant for a keystroke
+QUERIES = 200
+SYLLABLES = "ka lo mi ra ne to su an el is or um ba de fi go hu ja".split()
+
+
+def name(rng: random.Random) -> str:
+    return "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+
+
+def generate(n: int) -> list:
+    rng = random.Random(0)
+    firsts = [name(rng) for _ in range(2000)]
+    lasts = [name(rng) for _ in range(5000)]
+    contacts = []
+    for i in range(1, n + 1):
+        first, last = rng.choice(firsts), rng.choice(lasts)
+        phone = f"555-{rng.randrange(10**7):07d}"
+        email = f"{first}.{last}{i}@example.com".lower()
+        contacts.append(Contact(i, first, last, phone, email))
+    return contacts
+
+
+def typo(word: str, rng: random.Random) -> str:
+    i = rng.randrange(len(word) - 1)
+    kind = rng.choice(["swap", "drop", "double", "replace"])
+    if kind == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+    if kind == "drop":
+        return word[:i] + word[i + 1 :]
+    if kind == "double":
+        return word[:i] + word[i] + word[i:]
+    return word[:i] + rng.choice("aeiou") + word[i + 1 :]
+
+
+def queries(contacts: list) -> list[str]:
+    rng = random.Random(1)
+    found = []
+    for c in rng.sample(contacts, QUERIES):
+        if rng.random() < 0.5:
+            found.append(typo(c.last, rng))
+        else:
+            found.append(f"{c.first} {typo(c.last, rng)}")
+    return found
+
+
+def naive(contacts: list, query: str, limit: int) -> list[int]:
+    "Similarity of every query word to every word of every contact."
+    ranked = []
+    query_words = words(fold(query))
+    for c in contacts:
+        key_words = words(search_key(c.first, c.last, c.phone, c.email))
+        score = 0.0
+        for word in query_words:
+            score += max(
+                SequenceMatcher(
+                    None, word, other[: len(word) + max_edits(word)]
+                ).ratio()
+                for other in key_words
+            )
+        ranked.append((-score, c.id))
+    ranked.sort()
+    return [id_ for _, id_ in ranked[:limit]]
+
+
+def measure(store, texts: list[str]) -> tuple[float, list[float]]:
+    "Times the first search, which builds the indexes built lazily, and the others."
+    t = time.perf_counter()
+    store.fuzzy_search(texts[0], 10)
+    first = time.perf_counter() - t
+    times = []
+    for text in texts:
+        t = time.perf_counter()
+        store.fuzzy_search(text, 10)
+        times.append(time.perf_counter() - t)
+    return first, times
+
+
+def main(n: int) -> int:
+    contacts = generate(n)
+    texts = queries(contacts)
+    print(f"{n} contacts, {len(texts)} queries such as {texts[:3]}")
+
+    t = time.perf_counter()
+    naive(contacts, texts[0], 10)
+    print(f"   naive: {time.perf_counter() - t:.3f} s per query")
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite = SqliteStore(Contact, Path(directory) / "contacts.sqlite3")
+        shared = SharedStore(Contact, Path(directory) / "contacts.mmap")
+        table = ContactTable()
+        for store in [sqlite, shared]:
+            with store.transaction():
+                for c in contacts:
+                    store[c.id] = c
+        for c in contacts:
+            table[c.id] = c
+
+        for backend, store in [
+            ("memory", table),
+            ("sqlite", sqlite),
+            ("shared", shared),
+        ]:
+            first, times = measure(store, texts)
+            p50 = statistics.median(times)
+            p95 = statistics.quantiles(times, n=20)[-1]
+            ok = p95 <= TARGET_P95
+            failed |= not ok
+            print(
+                f"{backend:>8}: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, "
+                f"max {max(times) * 1000:.1f} ms, first {first * 1000:.0f} ms "
+                f"{'ok' if ok else 'MISSED TARGET'}"
+            )
+        sqlite.close()
+        shared.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
@@ -0,0 +1,62 @@
+"""Memory the in-memory storage backends take per contact.
+
+    python benchmarks/bench_memory.py [number of contacts]
+
+The contacts are created while tracing allocations, as when loading them, so the
+memory backend counts the `Contact` objects it keeps and the compact backend only
+its records. The indexes are counted separately, with the lazily built ones built.
+"""
+
+import sys
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from htmx_experiments.contact import Contact  # noqa: E402
+from htmx_experiments.table import CompactTable, ContactTable  # noqa: E402
+
+
+def contacts(n: int):
+    for i in range(1, n + 1):
+        yield Contact(
+            i, f"First{i}", f"Last{i % 1000}", f"555-{i:07d}", f"contact{i}@example.com"
+        )
+
+
+def measure(table, n: int) -> tuple[int, int]:
+    "Bytes taken by the rows and by the indexes of `table` once it holds `n` contacts."
+    tracemalloc.start()
+    try:
+        for c in contacts(n):
+            table[c.id] = c
+        table.search("contact")
+        table.fuzzy_search("contact", 10)
+        for field in ("first", "last", "email"):
+            table.page(0, 10, field)
+        total = tracemalloc.get_traced_memory()[0]
+        # what clearing the indexes frees is theirs, what's left the rows'
+        for index in table.indexes:
+            index.clear()
+        rows = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return rows, total - rows
+
+
+def main(n: int):
+    print(f"{n} contacts, bytes per contact")
+    for backend, table in [
+        ("memory", ContactTable()),
+        ("compact", CompactTable(Contact)),
+    ]:
+        rows, indexes = measure(table, n)
+        print(
+            f"{backend:>8}: rows {rows / n:.0f}, indexes {indexes / n:.0f}, "
+            f"total {(rows + indexes) / n:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
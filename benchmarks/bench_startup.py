@@ -0,0 +1,93 @@
+"""Time until the first page of contacts can be served, per storage backend.
+
+    python benchmarks/bench_startup.py [number of contacts]
+
+Each backend starts in a fresh process reading the same generated contacts, the
+shared and sqlite backends from files converted beforehand. The first page sorted
+by last name is timed separately, it builds the sorted index where there is none.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from htmx_experiments.snapshot import from_json  # noqa: E402
+
+START = """
+import time
+t = time.perf_counter()
+from htmx_experiments.contact import Contact
+Contact.load_db()
+Contact.all()
+print(time.perf_counter() - t)
+t = time.perf_counter()
+Contact.all(sort="last")
+print(time.perf_counter() - t)
+"""
+
+
+def generate(path: Path, n: int):
+    contacts = [
+        {
+            "id": i,
+            "first": f"First{i}",
+            "last": f"Last{i % 1000}",
+            "phone": f"555-{i:07d}",
+            "email": f"contact{i}@example.com",
+            "errors": {},
+        }
+        for i in range(1, n + 1)
+    ]
+    with open(path, "w") as f:
+        json.dump({"next_id": n + 1, "contacts": contacts}, f, indent=2)
+
+
+def start(directory: Path, backend: str) -> tuple[float, float]:
+    "Seconds until the first page, and for the first sorted page after it."
+    env = os.environ | {"CONTACTS_BACKEND": backend, "PYTHONPATH": str(ROOT / "src")}
+    out = subprocess.run(
+        [sys.executable, "-c", START],
+        cwd=directory,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    first, sorted_ = out.stdout.split()
+    return float(first), float(sorted_)
+
+
+def main(n: int):
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        generate(directory / "contacts.json", n)
+        print(
+            f"{n} contacts, contacts.json: {os.path.getsize(directory / 'contacts.json') / 1e6:.1f} MB"
+        )
+
+        t = time.perf_counter()
+        from_json(directory / "contacts.json", directory / "contacts.mmap")
+        print(
+            f"converting to contacts.mmap: {time.perf_counter() - t:.3f} s, "
+            f"{os.path.getsize(directory / 'contacts.mmap') / 1e6:.1f} MB"
+        )
+        # the first start imports contacts.json into contacts.sqlite3
+        start(directory, "sqlite")
+
+        for backend in ["memory", "compact", "sqlite", "shared"]:
+            first, sorted_ = start(directory, backend)
+            print(
+                f"{backend:>8}: first page after {first:.3f} s, "
+                f"first sorted page {sorted_:.3f} s"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -1,44 +1,795 @@
+"""Exports the contacts to archive files for download, reporting their progress.
+
+Each export is a job of `ArchiveManager`, addressed by its id. An archive is
+gzip compressed JSON in the format of contacts.json, NDJSON or CSV, see
+`FORMATS`. It is written from a consistent view of the store, see the stores'
+`export`, serialized and compressed a chunk of rows at a time, so memory use
+doesn't depend on the number of contacts.
+
+Archives are addressed by the digest of their content, which is their ETag. The
+manager keeps the latest archive per format, and a job submitted while the store
+is still in the state it was made from completes right away with a link to it.
+A job can also export just the changes since an earlier archive, see `Manifest`.
+"""
+
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
 import time
-from random import random
-from threading import Thread
+import uuid
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from itertools import islice
+from json.encoder import encode_basestring_ascii as quote
+from threading import Condition, Lock
+
+from .contact import Contact, data_path
+
+# exports running at the same time, further ones wait for a free worker
+ARCHIVE_WORKERS = int(os.environ.get("CONTACTS_ARCHIVE_WORKERS", 2))
+# seconds a finished archive stays available for download
+ARCHIVE_TTL = float(os.environ.get("CONTACTS_ARCHIVE_TTL", 3600))
+# archives whose manifests are kept, so that later archives can hold the changes since
+ARCHIVE_HISTORY = int(os.environ.get("CONTACTS_ARCHIVE_HISTORY", 4))
+# seconds between comments keeping otherwise idle event streams open
+KEEPALIVE = 15
+# rows serialized per write, and between progress updates and cancellation checks
+CHUNK_ROWS = 1000
+# gzip compression level, 6 compresses contacts almost as well as 9, much faster
+GZIP_LEVEL = 6
+FIELDS = ("id", "first", "last", "phone", "email")
+# a contact as compact JSON, filled in by `json_object`
+OBJECT = '{"id":%d,"first":%s,"last":%s,"phone":%s,"email":%s}'
+# job ids as `ArchiveManager.submit` makes them, anything else names no job file
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class ArchiveFormat:
+    "Serializes rows of (id, first, last, phone, email) a chunk at a time."
+
+    suffix = ""
+    media_type = ""
+    # whether the format can hold the changes since an earlier archive
+    deltas = True
+
+    def head(self, next_id: int, since: str | None = None) -> str:
+        "Starts an archive, of the changes since the archive `since` if given."
+        return ""
+
+    def rows(self, rows: list[tuple], first: bool) -> str:
+        "The text of `rows`, `first` if they are the first ones of the archive."
+        raise NotImplementedError
+
+    def tail(self, deleted: list[int] | None = None) -> str:
+        "Ends an archive, of changes including the `deleted` ids if given."
+        return ""
+
+
+def json_object(row: tuple) -> str:
+    """The contact of `row` as compact JSON, like `json.dumps` would write it.
+
+    Only the strings go through the encoder, which is more than twice as fast as
+    encoding a dict per contact.
+    """
+    id_, *values = row
+    return OBJECT % (id_, *["null" if v is None else quote(v) for v in values])
+
+
+class JsonFormat(ArchiveFormat):
+    """The format of contacts.json, without any whitespace.
+
+    Changes have a "since" key, the changed and new contacts under "contacts"
+    and the ids of the deleted ones under "deleted".
+    """
+
+    suffix = ".json"
+    media_type = "application/json"
+
+    def head(self, next_id: int, since: str | None = None) -> str:
+        if since is not None:
+            return f'{{"next_id":{next_id},"since":{quote(since)},"contacts":['
+        return f'{{"next_id":{next_id},"contacts":['
+
+    def rows(self, rows: list[tuple], first: bool) -> str:
+        text = ",".join(map(json_object, rows))
+        return text if first else "," + text
+
+    def tail(self, deleted: list[int] | None = None) -> str:
+        if deleted is not None:
+            return f'],"deleted":[{",".join(map(str, deleted))}]}}'
+        return "]}"
+
+
+class NdjsonFormat(ArchiveFormat):
+    """A JSON object per contact and line, which tools can process line by line.
+
+    Changes end with a line {"id":...,"deleted":true} per deleted contact.
+    """
+
+    suffix = ".ndjson"
+    media_type = "application/x-ndjson"
+
+    def rows(self, rows: list[tuple], first: bool) -> str:
+        return "".join(json_object(row) + "\n" for row in rows)
+
+    def tail(self, deleted: list[int] | None = None) -> str:
+        return "".join('{"id":%d,"deleted":true}\n' % id_ for id_ in deleted or ())
+
+
+class CsvFormat(ArchiveFormat):
+    "A header and a line per contact, None becomes an empty field."
+
+    suffix = ".csv"
+    media_type = "text/csv"
+    deltas = False  # a line can't tell a deleted contact from one without fields
+
+    def head(self, next_id: int, since: str | None = None) -> str:
+        return ",".join(FIELDS) + "\r\n"
+
+    def rows(self, rows: list[tuple], first: bool) -> str:
+        out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        return out.getvalue()
+
+
+FORMATS = {"json": JsonFormat(), "ndjson": NdjsonFormat(), "csv": CsvFormat()}
+
+
+class Manifest:
+    """What an archive holds: the ids of its contacts in ascending order, a hash of
+    each contact and the digest of the archive's content.
+
+    Comparing the rows of the store with the manifest of an earlier archive tells
+    the contacts changed, added or deleted since, see `Delta`. A hash is the first
+    8 bytes of the blake2b digest of the contact as JSON, so it is the same in
+    every process, and the manager saves manifests to the data directory, see
+    `save`, for all processes serving it.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.hashes = array("q")
+        self.digest = None
+
+    def add(self, rows: list[tuple]) -> array:
+        "Adds the rows following those added so far, returns their hashes."
+        hashes = array("q")
+        hashes.frombytes(
+            b"".join(
+                hashlib.blake2b(json_object(row).encode(), digest_size=8).digest()
+                for row in rows
+            )
+        )
+        self.ids.extend([row[0] for row in rows])
+        self.hashes.extend(hashes)
+        return hashes
+
+    def save(self, path):
+        "Writes the number of contacts, ids and hashes next to `path`, then renames."
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                array("q", [len(self.ids)]).tofile(f)
+                self.ids.tofile(f)
+                self.hashes.tofile(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, digest: str) -> "Manifest":
+        "Reads the manifest `save` wrote to `path` for the archive of `digest`."
+        manifest = cls()
+        with open(path, "rb") as f:
+            count = array("q")
+            count.fromfile(f, 1)
+            manifest.ids.fromfile(f, count[0])
+            manifest.hashes.fromfile(f, count[0])
+        manifest.digest = digest
+        return manifest
+
+
+def manifest_file(digest: str) -> str:
+    "Where the manager saves the manifest of the archive of `digest`."
+    return data_path(f"archive-{digest}.manifest")
+
+
+class Delta:
+    """Picks the rows changed since the archive of `base`, fed all rows of the store
+    in id order, and collects the ids of those deleted meanwhile."""
+
+    def __init__(self, base: Manifest):
+        self.base = base
+        self.position = 0  # in `base` of the first id not passed yet
+        self.deleted = []
+
+    def changed(self, rows: list[tuple], hashes: array) -> list[tuple]:
+        ids, old, i = self.base.ids, self.base.hashes, self.position
+        n = len(ids)
+        found = []
+        for row, hash_ in zip(rows, hashes):
+            id_ = row[0]
+            while i < n and ids[i] < id_:
+                self.deleted.append(ids[i])
+                i += 1
+            if i < n and ids[i] == id_:
+                if old[i] != hash_:
+                    found.append(row)
+                i += 1
+            else:
+                found.append(row)
+        self.position = i
+        return found
+
+    def finish(self) -> list[int]:
+        "The deleted ids, once all rows were passed."
+        self.deleted.extend(self.base.ids[self.position :])
+        self.position = len(self.base.ids)
+        return self.deleted
+
+
+def write_archive(
+    db, path, progress=None, cancelled=None, format_="json", manifest=None, base=None
+) -> int | None:
+    """Writes the contacts of `db` as of the call to `path`, gzip compressed in one of
+    `FORMATS`, and returns the size of the uncompressed archive once it is complete.
+
+    Rows are serialized and compressed `CHUNK_ROWS` at a time on their way to the
+    file, which is written next to `path` and renamed into place when complete, so
+    `path` always holds a whole archive. `progress` is called with the fraction of
+    rows written after every chunk. If `cancelled()` turns true the partial file is
+    removed, `path` is left as it was and None returned.
+
+    A `manifest` is filled with the contacts and the digest of the archive. Given
+    the `base` manifest of an earlier archive, only the changes since are written.
+    """
+    serializer = FORMATS[format_]
+    directory = os.path.dirname(os.path.abspath(path))
+    manifest = Manifest() if manifest is None and base is not None else manifest
+    delta = None if base is None else Delta(base)
+    digest = hashlib.blake2b(digest_size=16)
+
+    def write(text: str) -> int:
+        data = text.encode()
+        digest.update(data)
+        return out.write(data)
+
+    with db.export() as (count, next_id, rows):
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with (
+                os.fdopen(fd, "wb") as f,
+                gzip.GzipFile(fileobj=f, mode="wb", compresslevel=GZIP_LEVEL) as out,
+            ):
+                size = write(serializer.head(next_id, base and base.digest))
+                written = 0
+                first = True
+                rows = iter(rows)
+                while chunk := list(islice(rows, CHUNK_ROWS)):
+                    written += len(chunk)
+                    if manifest is not None:
+                        hashes = manifest.add(chunk)
+                        if delta is not None:
+                            chunk = delta.changed(chunk, hashes)
+                    if chunk:
+                        size += write(serializer.rows(chunk, first))
+                        first = False
+                    if cancelled is not None and cancelled():
+                        raise Cancelled
+                    if progress is not None and written < count:
+                        progress(written / count)
+                size += write(serializer.tail(delta and delta.finish()))
+            os.replace(tmp, path)
+        except Cancelled:
+            os.unlink(tmp)
+            return None
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    if manifest is not None:
+        manifest.digest = digest.hexdigest()
+    if progress is not None:
+        progress(1.0)
+    return size
+
+
+def read_archive(path, chunk_size=64 * 1024):
+    "Yields the uncompressed content of the archive at `path` in chunks."
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    "Whether an Accept-Encoding header allows a gzip encoded response."
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            quality = params.strip().removeprefix("q=")
+            try:
+                return float(quality or 1) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def etag_matches(if_none_match: str | None, digest: str) -> bool:
+    "Whether an If-None-Match header names the archive of `digest`, weakly compared."
+    for tag in (if_none_match or "").split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == "*" or tag == f'"{digest}"':
+            return True
+    return False
+
+
+def link(source, path):
+    "Makes `path` another name of the file `source`, or a copy where links fail."
+    try:
+        os.link(source, path)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def sse(event: str, data="") -> str:
+    "A server-sent event, each line of `data` in a data field of its own."
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event}\n{lines}\n"
+
+
+def wake(futures):
+    for future in futures:
+        if not future.done():
+            future.set_result(None)
+
+
+def state(db) -> tuple:
+    "Changes with every write to `db`, and with ids handed out for new contacts."
+    return (db.version, db.next_id)
+
+
+class Cancelled(Exception):
+    "Raised within `write_archive` to stop a cancelled export."
 
 
 class Archiver:
-    archive_status = "Waiting"
-    archive_progress = 0
-    thread = None
+    """One archive job, which exports the contacts to a file of its own.
+
+    `status()` is "Waiting" for an archiver without a job, which offers to start
+    one, else "Queued" until a worker of `ArchiveManager` picks the job up, then
+    "Running" and finally "Complete" or "Failed".
+    """
+
+    # runs the jobs of all users, see `submit` and `get`
+    manager: "ArchiveManager"
+
+    def __init__(self, job_id=None, ttl=ARCHIVE_TTL, format_="json", since=None):
+        self.id = job_id
+        self.ttl = ttl
+        self.format = FORMATS[format_]
+        self.format_name = format_
+        # digest of the earlier archive the job exports the changes since, and its
+        # manifest, if it does
+        self.since = since
+        self.base = None
+        # (version, next_id) of the store the archive is made from
+        self.state = None
+        self.manifest = None
+        self.digest = None  # of the archive's content, once complete
+        self.size = None  # of the uncompressed archive, once complete
+        self.archive_status = "Waiting" if job_id is None else "Queued"
+        self.archive_progress = 0
+        # time.monotonic() after which the manager drops the finished job
+        self.expires = None
+        self.cancelled = False
+        # guards the state, and wakes the event streams when `version` changes
+        self.condition = Condition()
+        # counts the changes worth showing, see `changed`
+        self.version = 0
+        # (loop, future) of the asynchronous event streams waiting for a change
+        self.waiters = []
 
     def status(self):
-        return Archiver.archive_status
+        return self.archive_status
 
     def progress(self):
-        return Archiver.archive_progress
-
-    def run(self):
-        if Archiver.archive_status == "Waiting":
-            Archiver.archive_status = "Running"
-            Archiver.archive_progress = 0
-            Archiver.thread = Thread(target=self.run_impl)
-            Archiver.thread.start()
-
-    def run_impl(self):
-        for i in range(10):
-            time.sleep(1 * random())
-            if Archiver.archive_status != "Running":
-                return
-            Archiver.archive_progress = (i + 1) / 10
-            print("Here... " + str(Archiver.archive_progress))
-        time.sleep(1)
-        if Archiver.archive_status != "Running":
+        return self.archive_progress
+
+    def run_impl(self, keep=None):
+        "Exports the archive, then passes the job to `keep` before it is complete."
+        if self.cancelled:
             return
-        Archiver.archive_status = "Complete"
+        self.set_status("Running")
+        try:
+            Contact.sync()
+            # read before the export, so that a write in between makes it older
+            self.state = state(Contact.db)
+            manifest = Manifest()
+            self.size = write_archive(
+                Contact.db,
+                self.archive_file(),
+                self.report,
+                lambda: self.cancelled,
+                self.format_name,
+                manifest,
+                self.base,
+            )
+            self.manifest = manifest
+            self.digest = manifest.digest
+        except Exception:
+            self.set_status("Failed")
+            raise
+        finally:
+            self.base = None
+            self.expires = time.monotonic() + self.ttl
+        with self.condition:
+            if self.cancelled:
+                # completed just before `reset` or just after it removed the file
+                with suppress(FileNotFoundError):
+                    os.unlink(self.archive_file())
+            elif self.size is not None:
+                if keep is not None:
+                    keep(self)
+                with suppress(OSError):
+                    self.save()  # else only this process can serve the job
+                self.set_status("Complete")
+
+    def set_status(self, status: str):
+        with self.condition:
+            self.archive_status = status
+            self.changed()
+
+    def report(self, fraction: float):
+        with self.condition:
+            # the progress bar only shows whole percents
+            if int(fraction * 100) != int(self.archive_progress * 100):
+                self.changed()
+            self.archive_progress = fraction
+
+    def changed(self):
+        "Wakes the event streams, with `condition` held."
+        self.version += 1
+        self.condition.notify_all()
+        # one call per loop, which is what wakes the loop's thread
+        futures = {}
+        for loop, future in self.waiters:
+            futures.setdefault(loop, []).append(future)
+        for loop, waiting in futures.items():
+            # the streams may have ended along with their loop
+            with suppress(RuntimeError):
+                loop.call_soon_threadsafe(wake, waiting)
+        self.waiters.clear()
+
+    def finished(self) -> bool:
+        "Whether the status won't change anymore."
+        return self.cancelled or self.archive_status in (
+            "Waiting",
+            "Complete",
+            "Failed",
+        )
+
+    def events(self, render, keepalive=KEEPALIVE):
+        """Yields the job's progress as server-sent events until it is finished.
+
+        A "progress" event carries the html of `render()` and is only sent when the
+        status or the shown progress changed, a "done" event ends the stream.
+        Without changes a comment is sent every `keepalive` seconds, so that
+        proxies keep the connection open and a closed one is noticed.
+        """
+        version = None
+        while True:
+            with self.condition:
+                if version == self.version and not self.finished():
+                    self.condition.wait(keepalive)
+                fresh = version != self.version
+                version = self.version
+                finished = self.finished()
+            if finished:
+                yield sse("done")
+                return
+            yield sse("progress", render()) if fresh else ": keepalive\n\n"
+
+    async def aevents(self, render, keepalive=KEEPALIVE):
+        """Like `events`, for asynchronous servers.
+
+        A waiting stream holds no thread, just a future which `changed` resolves,
+        so a server can keep many of them open.
+        """
+        version = None
+        while True:
+            if version == self.version and not self.finished():
+                await self.wait_async(version, keepalive)
+            with self.condition:
+                fresh = version != self.version
+                version = self.version
+                finished = self.finished()
+            if finished:
+                yield sse("done")
+                return
+            yield sse("progress", render()) if fresh else ": keepalive\n\n"
+
+    async def wait_async(self, version: int, timeout: float):
+        "Waits up to `timeout` seconds for `version` to change."
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self.condition:
+            if version != self.version:
+                return
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def save(self):
+        """Writes what other processes need to serve the complete job to `job_file`,
+        next to the archive, expiring along with the job."""
+        remaining = self.expires - time.monotonic()
+        job = {
+            "format": self.format_name,
+            "since": self.since,
+            "digest": self.digest,
+            "size": self.size,
+            "expires": time.time() + remaining,
+        }
+        path = self.job_file()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, job_id: str) -> "Archiver | None":
+        "The complete job `job_id` saved by another process, None if there is none."
+        if not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(data_path(f"archive-{job_id}.job")) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        remaining = saved["expires"] - time.time()
+        job = cls(job_id, remaining, saved["format"], saved["since"])
+        job.digest, job.size = saved["digest"], saved["size"]
+        job.archive_status = "Complete"
+        job.archive_progress = 1.0
+        job.expires = time.monotonic() + remaining
+        return job
 
     def archive_file(self):
-        return "contacts.json"
+        "The gzip compressed archive."
+        return data_path(f"archive-{self.id}{self.format.suffix}.gz")
+
+    def job_file(self):
+        "The job as `save` wrote it, for other processes."
+        return data_path(f"archive-{self.id}.job")
+
+    def cache_file(self):
+        "Where the manager keeps the archive for later jobs, named by its content."
+        return data_path(f"archive-{self.digest}{self.format.suffix}.gz")
+
+    def download_name(self):
+        "Name of the archive once the client decoded it."
+        if self.since is not None:
+            return f"contacts-changes{self.format.suffix}"
+        return f"contacts{self.format.suffix}"
+
+    def etag(self):
+        "Weak, as the archive is the same with and without the gzip encoding."
+        return f'W/"{self.digest}"'
+
+    def media_type(self):
+        return self.format.media_type
 
     def reset(self):
-        Archiver.archive_status = "Waiting"
+        "Cancels the job, if it is still queued or running, and removes its files."
+        with self.condition:
+            self.cancelled = True
+            self.changed()
+            with suppress(FileNotFoundError):
+                os.unlink(self.archive_file())
+            with suppress(FileNotFoundError):
+                os.unlink(self.job_file())
 
     @classmethod
-    def get(cls):
-        return Archiver()
+    def submit(cls, format_="json", since=None) -> "Archiver":
+        return cls.manager.submit(format_, since)
+
+    @classmethod
+    def get(cls, job_id=None) -> "Archiver":
+        "Returns the job `job_id`, or an archiver without a job if there is none such."
+        return cls.manager.get(job_id) or Archiver()
+
+    @classmethod
+    def cancel(cls, job_id):
+        cls.manager.cancel(job_id)
+
+
+class ArchiveManager:
+    """Runs archive jobs on a pool of `workers` threads, queueing the jobs submitted
+    while all of them are busy, and keeps each job by id until it expires, `ttl`
+    seconds after it finished. The archives of complete jobs are kept as long as the
+    store doesn't change, for later jobs to link to instead of exporting again.
+
+    Ids are random, so that users can't get at each other's archives by guessing.
+    Complete jobs are saved to the data directory, so that every process serving it
+    finds them, see `Archiver.save`, while a queued or running job is only known to
+    the process running it.
+    """
+
+    def __init__(
+        self, workers=ARCHIVE_WORKERS, ttl=ARCHIVE_TTL, history=ARCHIVE_HISTORY
+    ):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="archiver")
+        self.ttl = ttl
+        self.jobs = {}
+        # the latest complete job per (format, since), whose `cache_file` is kept
+        # for jobs submitted while the store is still in `state`
+        self.cache = {}
+        self.state = None
+        # manifests of the latest `history` archives by digest, for `since`
+        self.manifests = OrderedDict()
+        self.history = history
+        self.lock = Lock()
+
+    def submit(self, format_="json", since=None) -> Archiver:
+        """Queues a job exporting an archive in `format_`, one of `FORMATS`, of the
+        changes since the archive of digest `since` if given.
+
+        If an archive was already made of the store as it is, the job is complete
+        right away and shares its file.
+        """
+        if format_ not in FORMATS:
+            raise ValueError(f"Unknown archive format {format_!r}")
+        if since is not None and not FORMATS[format_].deltas:
+            raise ValueError(f"{format_} archives can't hold changes")
+        if since is not None:
+            # the digest, also when given as the archive's ETag
+            since = since.removeprefix("W/").strip('"')
+        self.prune()
+        job = Archiver(uuid.uuid4().hex, self.ttl, format_, since)
+        Contact.sync()
+        current = state(Contact.db)
+        with self.lock:
+            if since is not None:
+                job.base = self.manifest(since)
+            self.check(current)
+            cached = self.cache.get((format_, since))
+            if cached is not None:
+                try:
+                    # under the lock, so that `check` doesn't remove the file meanwhile
+                    link(cached.cache_file(), job.archive_file())
+                except FileNotFoundError:
+                    # removed from the data directory otherwise
+                    del self.cache[(format_, since)]
+                    cached = None
+            if cached is not None:
+                job.digest, job.size = cached.digest, cached.size
+                job.base = None
+                job.archive_status = "Complete"
+                job.archive_progress = 1.0
+                job.expires = time.monotonic() + self.ttl
+                with suppress(OSError):
+                    job.save()  # else only this process can serve the job
+            self.jobs[job.id] = job
+        if cached is None:
+            self.pool.submit(job.run_impl, self.keep)
+        return job
+
+    def manifest(self, digest: str) -> Manifest:
+        """The manifest of the archive of `digest`, also if another process made it,
+        with `lock` held."""
+        manifest = self.manifests.get(digest)
+        if manifest is None:
+            try:
+                manifest = Manifest.load(manifest_file(digest), digest)
+            except FileNotFoundError:
+                raise ValueError(f"Unknown archive {digest!r}") from None
+            self.manifests[digest] = manifest
+        self.manifests.move_to_end(digest)
+        self.evict()
+        return manifest
+
+    def keep(self, job: Archiver):
+        "Keeps the archive of a job for later ones, and its manifest."
+        if job.digest is None:
+            return
+        try:
+            job.manifest.save(manifest_file(job.digest))
+        except OSError:
+            pass  # only this process can export the changes since then
+        with self.lock:
+            self.manifests[job.digest] = job.manifest
+            self.manifests.move_to_end(job.digest)
+            self.evict()
+            job.manifest = None
+            if job.state != self.state:
+                return  # the store changed meanwhile, see `check`
+            key = (job.format_name, job.since)
+            if key in self.cache and self.cache[key].digest != job.digest:
+                self.forget(key)
+            try:
+                link(job.archive_file(), job.cache_file())
+            except FileExistsError:
+                pass  # the same content, made before
+            except FileNotFoundError:
+                return  # the job was cancelled meanwhile
+            self.cache[key] = job
+
+    def evict(self):
+        "Forgets the manifests beyond the latest `history` ones, with `lock` held."
+        while len(self.manifests) > self.history:
+            digest, _ = self.manifests.popitem(last=False)
+            with suppress(FileNotFoundError):
+                os.unlink(manifest_file(digest))
+            # the changes since it can't be asked for anymore
+            for key in [key for key in self.cache if key[1] == digest]:
+                self.forget(key)
+
+    def check(self, current):
+        "Forgets the archives of the store in an earlier state, with `lock` held."
+        if current != self.state:
+            for key in list(self.cache):
+                self.forget(key)
+            self.state = current
+
+    def forget(self, key):
+        job = self.cache.pop(key)
+        with suppress(FileNotFoundError):
+            os.unlink(job.cache_file())
+
+    def get(self, job_id) -> Archiver | None:
+        "The job `job_id`, also if it is complete and another process ran it."
+        self.prune()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and job_id is not None:
+            job = Archiver.load(job_id)
+            if job is not None and job.expires < time.monotonic():
+                job.reset()
+                return None
+        return job
+
+    def cancel(self, job_id):
+        "Cancels the job `job_id` and forgets it, if there is one."
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is None and job_id is not None:
+            job = Archiver.load(job_id)
+        if job is not None:
+            job.reset()
+
+    def prune(self):
+        "Forgets the expired jobs and removes their files."
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                job
+                for job in self.jobs.values()
+                if job.expires is not None and job.expires < now
+            ]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            job.reset()
+
+
+Archiver.manager = ArchiveManager()
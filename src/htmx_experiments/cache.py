@@ -0,0 +1,66 @@
+"Bounded LRU cache for query results, invalidated by any change of the contacts."
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResultCache:
+    """Maps query keys to results computed at a given store version.
+
+    Stores bump their `version` with every change, so as soon as a lookup
+    passes a new version all entries are dropped. Callers read the version
+    before computing a result, so a result which raced with a change is
+    dropped as well. `maxsize=0` disables caching.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.narrowed = 0  # misses answered from a cached broader result
+
+    def check(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        with self.lock:
+            self.check(version)
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, version):
+        "Like `get`, but without counting a hit or miss."
+        with self.lock:
+            self.check(version)
+            return self.entries.get(key)
+
+    def put(self, key, version, value):
+        with self.lock:
+            # computed before the latest change seen by `get`
+            if version != self.version or self.maxsize <= 0:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "narrowed": self.narrowed,
+        }
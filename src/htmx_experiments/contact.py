@@ -1,17 +1,66 @@
 # taken from https://github.com/bigskysoftware/contact-app/blob/master/contacts_model.py
+import atexit
 import json
-import time
+import os
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+from threading import RLock
 from typing import Self
 
+from . import latency
+from .cache import ResultCache
+from .filelock import FileLock
+from .flusher import Flusher
+from .journal import Journal
+from .loader import Loader
+from .shared_store import SharedStore
+from .sqlite_store import SqliteStore
+from .table import CompactTable, ContactTable, matches, needle, sort_order
+
 # ========================================================
 # Contact Model
 # ========================================================
 PAGE_SIZE = 100
+# "memory" keeps all contacts in `Contact.db` and persists them to contacts.json,
+# "compact" does the same with less memory per contact, creating `Contact`s on read,
+# "sqlite" keeps them in contacts.sqlite3, which several processes can share,
+# "shared" in contacts.mmap, which all processes map into memory instead of reading
+BACKEND = os.environ.get("CONTACTS_BACKEND", "memory")
+# "sync", "group" or "async", see `htmx_experiments.flusher`
+DURABILITY = os.environ.get("CONTACTS_DURABILITY", "sync")
+# set CONTACTS_JOURNAL=1 to append changes to contacts.log instead of rewriting
+# contacts.json each time, see `htmx_experiments.journal`
+JOURNAL = os.environ.get("CONTACTS_JOURNAL") == "1"
+# set CONTACTS_WATCH=1 when several processes serve the same contacts.json, so that
+# each applies the changes of the others, see `Contact.sync`
+WATCH = os.environ.get("CONTACTS_WATCH") == "1"
+# number of `search` / `all` results kept by `Contact.cache`, 0 to disable it
+CACHE_SIZE = int(os.environ.get("CONTACTS_CACHE_SIZE", 256))
+# directory of contacts.json and the other files the contacts are stored in
+DATA_DIR = os.environ.get("CONTACTS_DATA_DIR", ".")
+
+
+def data_path(name: str) -> str:
+    return os.path.join(DATA_DIR, name)
 
 
 class Contact:
     # mock contacts database
-    db = {}
+    db = ContactTable()
+    # set by `load_db` if `JOURNAL` or `WATCH` is on, appends mutations to a log instead
+    # of rewriting contacts.json
+    journal: Journal | None = None
+    # set by `load_db` to write changes from a background thread, see `DURABILITY`
+    flusher: Flusher | None = None
+    # serializes writers
+    lock = RLock()
+    # set by `load_db` if `WATCH` is on, serializes writers of all processes
+    file_lock: FileLock | None = None
+    # set by `init` to load the contacts in the background or on first use
+    loader: Loader | None = None
+    # results of `search` and `all` as of `db.version`
+    cache = ResultCache(CACHE_SIZE)
 
     def __init__(self, id_=None, first=None, last=None, phone=None, email=None):
         self.id = id_
@@ -29,82 +78,421 @@ class Contact:
         self.last = last
         self.phone = phone
         self.email = email
+        Contact.db.reindex(self)
 
-    def validate(self):
+    def validate(self, ignore=frozenset()):
+        "`ignore` holds ids whose stored emails don't count, e.g. rows a batch deletes."
         if not self.email:
             self.errors["email"] = "Email Required"
-        existing_contact = next(
-            filter(
-                lambda c: c.id != self.id and c.email == self.email, Contact.db.values()
-            ),
-            None,
-        )
-        if existing_contact:
+        if any(
+            id_ != self.id and id_ not in ignore
+            for id_ in Contact.db.email_owners(self.email)
+        ):
             self.errors["email"] = "Email Must Be Unique"
         return len(self.errors) == 0
 
     def save(self):
-        if not self.validate():
-            return False
-        if self.id is None:
-            if len(Contact.db) == 0:
-                max_id = 1
-            else:
-                max_id = max(contact.id for contact in Contact.db.values())
-            self.id = max_id + 1
+        latency.inject("save")
+        with Contact.transaction() as changes:
+            if not self.validate():
+                return False
+            if self.id is None:
+                self.id = Contact.db.allocate_id()
             Contact.db[self.id] = self
-        Contact.save_db()
+            changes.append(("put", self))
         return True
 
     def delete(self):
-        del Contact.db[self.id]
-        Contact.save_db()
+        with Contact.transaction() as changes:
+            del Contact.db[self.id]
+            changes.append(("delete", self))
+
+    def row(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if k != "errors"}
+
+    @classmethod
+    def batch(cls) -> "Batch":
+        return Batch()
+
+    @classmethod
+    @contextmanager
+    def locked(cls):
+        "Holds `lock`, and with `WATCH` on also `file_lock`, which other processes share."
+        with cls.lock:
+            if cls.file_lock is None:
+                yield
+            else:
+                with cls.file_lock.hold():
+                    yield
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """Runs the block as the only writer, which should add its `(op, contact)` changes
+        to the yielded list. They are persisted when the block ends without error.
+
+        The store's transaction keeps other processes from writing in between, with
+        `WATCH` on so does `file_lock`, and `db` is brought up to date first.
+        """
+        changes = []
+        # before taking `lock`, which loading needs
+        cls.wait_loaded()
+        with cls.locked():
+            cls.sync()
+            with cls.db.transaction():
+                yield changes
+            ticket = cls.persist(changes)
+        if ticket is not None:
+            # waiting for the flush while holding `lock` would block the flusher
+            cls.flusher.settle(ticket)
+
+    @classmethod
+    def init(cls, warm_up=True, data_dir=None):
+        """Loads the contacts from `data_dir`, by default `DATA_DIR`, in a background
+        thread, or with `warm_up=False` once they are first needed, instead of right
+        away like `load_db`.
+
+        Reads and writes wait until the contacts are loaded, see `ready`. Servers which
+        fork worker processes should call it in each worker, see `forked`.
+        """
+        global DATA_DIR
+        if data_dir is not None:
+            DATA_DIR = str(data_dir)
+        if cls.loader is None:
+            cls.loader = Loader(cls.load_db)
+        if warm_up:
+            cls.loader.start()
+
+    @classmethod
+    def forked(cls):
+        """Runs in the child of a fork, which inherits none of the parent's threads.
+
+        The flusher's thread is started again. Loading which wasn't done starts over,
+        as its thread may have held locks which nothing would ever release.
+        """
+        if cls.flusher is not None:
+            # writing the pending changes is up to the parent
+            atexit.unregister(cls.flusher.stop)
+        if cls.loader is not None and not cls.loader.ready:
+            cls.lock = RLock()
+            cls.db = ContactTable()
+            cls.file_lock = cls.journal = cls.flusher = None
+            warm_up, cls.loader = cls.loader.started, None
+            cls.init(warm_up)
+        elif cls.flusher is not None:
+            cls.flusher = Flusher(cls.write, cls.flusher.mode)
+
+    @classmethod
+    def ready(cls) -> bool:
+        "True once the contacts are loaded and indexed."
+        return cls.loader is None or cls.loader.ready
+
+    @classmethod
+    def wait_loaded(cls):
+        if cls.loader is not None:
+            cls.loader.wait()
+
+    @classmethod
+    def sync(cls):
+        "Applies the changes other processes logged since the last call, if `WATCH` is on."
+        cls.wait_loaded()
+        if cls.file_lock is None or not cls.journal.behind():
+            return
+        with cls.lock:
+            # records name the changed ids, the indexes follow along in `db`
+            for r in cls.journal.follow():
+                cls.replay(r)
 
     @classmethod
     def count(cls):
-        time.sleep(2)
+        latency.inject("count")
+        cls.sync()
         return len(cls.db)
 
     @classmethod
-    def all(cls, page=1):
-        page = int(page)
-        start = (page - 1) * PAGE_SIZE
-        end = start + PAGE_SIZE
-        return list(cls.db.values())[start:end]
+    def all(cls, page=1, after_id=None, limit=None, sort=None):
+        """Returns the `page`-th page of contacts, or the `limit` contacts following `after_id`.
+
+        Pages are in id order, or sorted by `sort`, one of `SORT_FIELDS`, prefixed
+        with "-" for descending order. The stores keep an index per sort order, so
+        a page costs about the same in any order.
+        """
+        limit = PAGE_SIZE if limit is None else int(limit)
+        if sort is not None:
+            sort_order(sort)  # raises ValueError for unknown fields
+            if after_id is not None:
+                raise ValueError("after_id pages in id order, it can't be sorted")
+        cls.sync()
+        version = cls.db.version
+        key = ("all", int(page), after_id and int(after_id), limit, sort)
+        contacts = cls.cache.get(key, version)
+        if contacts is None:
+            if after_id is not None:
+                contacts = cls.db.after(int(after_id), limit)
+            else:
+                start = (int(page) - 1) * limit
+                contacts = cls.db.page(start, start + limit, sort)
+            cls.cache.put(key, version, contacts)
+        return list(contacts)
+
+    @classmethod
+    def search(cls, text, after_id=None, limit=None, fuzzy=False):
+        """Returns up to `limit` contacts containing `text` with ids above `after_id`.
+
+        The store's search is consumed lazily and stops once the page is full, so
+        the first page of a common term costs as much as that of a rare one.
+
+        With `fuzzy` the contacts are those closest to `text`, typos included, best
+        first, see `fuzzy.rank`. There is a single page of them, `after_id` is ignored.
+        """
+        limit = PAGE_SIZE if limit is None else int(limit)
+        after_id = int(after_id or 0)
+        cls.sync()
+        version = cls.db.version
+        if fuzzy:
+            key = ("fuzzy", text, limit)
+            contacts = cls.cache.get(key, version)
+            if contacts is None:
+                latency.inject("search")
+                contacts = cls.db.fuzzy_search(text, limit)
+                cls.cache.put(key, version, contacts)
+            return list(contacts)
+        key = ("search", text, after_id, limit)
+        contacts = cls.cache.get(key, version)
+        if contacts is None:
+            contacts = cls.narrow(text, after_id, limit, version)
+            if contacts is None:
+                latency.inject("search")
+                contacts = list(islice(cls.db.iter_search(text, after_id), limit))
+            cls.cache.put(key, version, contacts)
+        return list(contacts)
 
     @classmethod
-    def search(cls, text):
-        result = []
-        for c in cls.db.values():
-            match_first = c.first is not None and text in c.first
-            match_last = c.last is not None and text in c.last
-            match_email = c.email is not None and text in c.email
-            match_phone = c.phone is not None and text in c.phone
-            if match_first or match_last or match_email or match_phone:
-                result.append(c)
-        return result
+    def narrow(cls, text, after_id, limit, version) -> list | None:
+        """Filters the cached results of a prefix of `text`, which contain all results
+        of `text` if the prefix's page wasn't full."""
+        found = needle(text)
+        for end in range(len(text) - 1, 0, -1):
+            if needle(text[:end]) not in found:
+                # e.g. "(" is looked up as is, but "(5" as the phone digits "5"
+                continue
+            broader = cls.cache.peek(("search", text[:end], after_id, limit), version)
+            if broader is not None and len(broader) < limit:
+                cls.cache.narrowed += 1
+                return [c for c in broader if matches(c, text)]
+        return None
 
     @classmethod
     def load_db(cls):
-        with open("contacts.json", "r") as contacts_file:
-            contacts = json.load(contacts_file)
+        if BACKEND in ("sqlite", "shared"):
+            cls.load_store()
+            return
+        if BACKEND == "compact" and not isinstance(cls.db, CompactTable):
+            cls.db = CompactTable(Contact)
+        if WATCH and cls.file_lock is None:
+            if DURABILITY != "sync":
+                # the log has to be written in the order the changes are made
+                raise ValueError("CONTACTS_WATCH=1 needs CONTACTS_DURABILITY=sync")
+            cls.file_lock = FileLock(data_path("contacts.lock"))
+        if (JOURNAL or WATCH) and cls.journal is None:
+            # with `WATCH` the log also tells the other processes what changed
+            cls.journal = Journal(data_path("contacts.log"))
+        if DURABILITY != "sync" and cls.flusher is None:
+            cls.flusher = Flusher(cls.write, DURABILITY)
+        # no process may compact the log between reading snapshot and log
+        with cls.locked():
+            data = cls.read_snapshot()
             cls.db.clear()
-            for c in contacts:
+            for c in data["contacts"]:
                 cls.db[c["id"]] = Contact(
                     c["id"], c["first"], c["last"], c["phone"], c["email"]
                 )
+            cls.db.next_id = max(cls.db.next_id, data["next_id"])
+            if cls.journal is not None:
+                cls.journal.rewind()
+                for r in cls.journal.follow():
+                    cls.replay(r)
+
+    @classmethod
+    def replay(cls, r: dict):
+        if r["op"] == "put":
+            cls.db[r["id"]] = Contact(
+                r["id"], r["first"], r["last"], r["phone"], r["email"]
+            )
+        elif r["op"] == "delete":
+            # the snapshot may already miss the row if compaction was interrupted
+            cls.db.pop(r["id"], None)
+        else:
+            for op in r["ops"]:
+                cls.replay(op)
+
+    @classmethod
+    def load_store(cls):
+        """Switches to the store selected by `BACKEND`, importing contacts.json into a
+        new one. An existing store is never imported into, also when it is empty
+        because all contacts were deleted."""
+        if BACKEND == "sqlite" and not isinstance(cls.db, SqliteStore):
+            path = data_path("contacts.sqlite3")
+        elif BACKEND == "shared" and not isinstance(cls.db, SharedStore):
+            path = data_path("contacts.mmap")
+        else:
+            return
+        created = not os.path.exists(path)
+        store = SqliteStore if BACKEND == "sqlite" else SharedStore
+        cls.db = store(Contact, path)
+        if not created:
+            return
+        # one transaction, so that workers starting together import only once
+        with cls.db.transaction():
+            if len(cls.db) == 0 and os.path.exists(data_path("contacts.json")):
+                data = cls.read_snapshot()
+                for c in data["contacts"]:
+                    cls.db[c["id"]] = Contact(
+                        c["id"], c["first"], c["last"], c["phone"], c["email"]
+                    )
+                cls.db.next_id = max(cls.db.next_id, data["next_id"])
+
+    @staticmethod
+    def read_snapshot() -> dict:
+        with open(data_path("contacts.json"), "r") as contacts_file:
+            data = json.load(contacts_file)
+        # plain lists are files written before the id counter was persisted
+        if isinstance(data, list):
+            data = {"next_id": 1, "contacts": data}
+        return data
 
     @staticmethod
     def save_db():
-        out_arr = [c.__dict__ for c in Contact.db.values()]
-        with open("contacts.json", "w") as f:
-            json.dump(out_arr, f, indent=2)
+        with Contact.lock:
+            out_arr = [c.__dict__ for c in Contact.db.values()]
+            next_id = Contact.db.next_id
+        with open(data_path("contacts.json.tmp"), "w") as f:
+            json.dump({"next_id": next_id, "contacts": out_arr}, f, indent=2)
+        os.replace(data_path("contacts.json.tmp"), data_path("contacts.json"))
+
+    @classmethod
+    def persist(cls, changes: list[tuple[str, "Contact"]]) -> int | None:
+        """Persists `(op, contact)` changes already applied to `db`, `op` being put or
+        delete, called holding `lock`.
+
+        With a `flusher` the changes are only queued, copied as they are now, in the
+        order they were applied, and the flusher's ticket is returned to wait for.
+        """
+        if cls.db.durable or not changes:
+            return None
+        if cls.flusher is not None:
+            copies = [
+                (op, Contact(c.id, c.first, c.last, c.phone, c.email))
+                for op, c in changes
+            ]
+            return cls.flusher.enqueue(copies)
+        with cls.lock:
+            cls.write(changes)
+        return None
+
+    @classmethod
+    def write(cls, changes: list[tuple[str, "Contact"]]):
+        if cls.journal is None:
+            # a single rewrite covers any number of changes
+            cls.save_db()
+            return
+        records = [
+            {"op": op, **(c.row() if op == "put" else {"id": c.id})}
+            for op, c in changes
+        ]
+        if len(records) == 1:
+            cls.journal.append(records[0])
+        else:
+            # a single line, so that a torn write loses the whole batch
+            cls.journal.append({"op": "batch", "ops": records})
+        if cls.journal.should_compact():
+            cls.compact_db()
+
+    @classmethod
+    def compact_db(cls):
+        "Folds the journal into contacts.json."
+        cls.save_db()
+        cls.journal.truncate()
 
     @classmethod
     def find(cls, id_) -> Self | None:
         id_ = int(id_)
+        cls.sync()
         c = cls.db.get(id_)
         if c is not None:
             c.errors = {}
 
         return c
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Contact.forked)
+
+
+class BatchError(Exception):
+    "Raised when a batch committed by leaving its `with` block is invalid."
+
+    def __init__(self, batch: "Batch"):
+        super().__init__("Batch contains invalid contacts")
+        self.batch = batch
+
+
+class Batch:
+    """Collects saves and deletes and applies them all at once, or not at all.
+
+    `commit` validates the contacts against the stored ones and each other, and
+    persists the whole batch with a single write. Used as a context manager the
+    batch commits when the block ends, raising `BatchError` if it is invalid.
+    Saved contacts should be fresh instances, not ones returned by `find`, so
+    that nothing changes before the commit.
+    """
+
+    def __init__(self):
+        self.saves = []
+        self.deletes = []
+
+    def save(self, contact: Contact):
+        self.saves.append(contact)
+
+    def delete(self, contact: Contact):
+        self.deletes.append(contact)
+
+    def validate(self) -> bool:
+        ids = Counter(c.id for c in self.saves + self.deletes if c.id is not None)
+        # emails of saved or deleted contacts may be reused within the batch
+        touched = set(ids)
+        claims = Counter(c.email for c in self.saves)
+        valid = True
+        for c in self.saves + self.deletes:
+            if ids[c.id] > 1:
+                c.errors["id"] = "Contact Changed More Than Once"
+        for c in self.saves:
+            c.validate(ignore=touched)
+            if claims[c.email] > 1:
+                c.errors["email"] = "Email Must Be Unique"
+        for c in self.saves + self.deletes:
+            if c.id is not None and c.id not in Contact.db:
+                c.errors.setdefault("id", "Contact Not Found")
+            valid = valid and not c.errors
+        return valid
+
+    def commit(self) -> bool:
+        with Contact.transaction() as changes:
+            if not self.validate():
+                return False
+            for c in self.saves:
+                if c.id is None:
+                    c.id = Contact.db.allocate_id()
+                Contact.db[c.id] = c
+                changes.append(("put", c))
+            for c in self.deletes:
+                del Contact.db[c.id]
+                changes.append(("delete", c))
+        return True
+
+    def __enter__(self) -> "Batch":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and not self.commit():
+            raise BatchError(self)
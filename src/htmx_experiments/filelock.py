@@ -0,0 +1,48 @@
+"Exclusive lock shared by all processes using the same lock file."
+
+import fcntl
+import os
+from contextlib import contextmanager
+from threading import RLock
+
+
+class FileLock:
+    """`flock` on `path`, which is created if needed.
+
+    `flock` doesn't exclude threads sharing a file descriptor, so threads of one
+    process also take turns via `lock`, which makes `hold` reentrant as well.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.depth = 0  # nesting of `hold` in the thread holding `lock`
+        self.pid = None
+        self.fd = None
+
+    @property
+    def file(self) -> int:
+        "File descriptor of the lock file, which a forked child opens anew."
+        if self.pid != os.getpid():
+            # the parent's descriptor would share its locks with the child
+            self.pid = os.getpid()
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self.fd
+
+    @contextmanager
+    def hold(self):
+        with self.lock:
+            if self.depth == 0:
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.pid = self.fd = None
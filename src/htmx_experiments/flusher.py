@@ -0,0 +1,137 @@
+"""Background thread persisting contact changes, coalescing many changes into one write.
+
+Durability modes:
+
+* "sync": no flusher, every change is written before the request returns.
+* "group": a change waits for the next flush, which it shares with all changes
+  made in the meantime (group commit). Nothing acknowledged is lost on a crash.
+* "async": a change returns right away and is written with the next flush, so a
+  crash loses the changes of the last `interval` seconds. A failed write is
+  logged, and its changes stay queued for the next attempt.
+"""
+
+import atexit
+import logging
+from threading import Condition, Thread
+
+log = logging.getLogger(__name__)
+
+MODES = ("sync", "group", "async")
+
+
+class Flusher:
+    """Calls `write(changes)` from a background thread.
+
+    A flush starts `interval` seconds after the first pending change, or as soon
+    as `max_pending` changes are waiting. In async mode a failed write is tried
+    again every `retry` seconds, in group mode its error is raised to the waiting
+    callers instead.
+    """
+
+    def __init__(self, write, mode="group", interval=0.05, max_pending=100, retry=1.0):
+        if mode not in ("group", "async"):
+            raise ValueError(f"Flusher does not support durability mode {mode=}")
+        self.write = write
+        self.mode = mode
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retry = retry
+        self.pending = []
+        self.submitted = 0  # number of `submit` calls so far
+        self.flushed = 0  # `submitted` as of the end of the last flush
+        self.error = None
+        self.failures = 0  # failed writes in async mode so far
+        self.urgent = False  # set by `flush` to skip the wait for more changes
+        self.stopped = False
+        self.cond = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, changes: list):
+        "Queues `changes`, and in group mode waits until they are written."
+        self.settle(self.enqueue(changes))
+
+    def enqueue(self, changes: list) -> int:
+        """Queues `changes` without waiting, returns the ticket to `settle`.
+
+        Changes are written in the order they are queued, so callers which have to
+        keep an order queue while holding the lock which defines it.
+        """
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError("Flusher is stopped")
+            self.pending.extend(changes)
+            self.submitted += 1
+            self.cond.notify_all()
+            return self.submitted
+
+    def settle(self, ticket: int):
+        "In group mode waits until the changes of `ticket` are written."
+        if self.mode == "group":
+            with self.cond:
+                self.wait(ticket)
+
+    def flush(self):
+        """Blocks until everything submitted so far has been written, or in async
+        mode until an attempt at writing it failed, raising its error."""
+        with self.cond:
+            self.urgent = True
+            self.cond.notify_all()
+            self.wait(self.submitted)
+
+    def wait(self, ticket: int):
+        failures = self.failures
+        while self.flushed < ticket:
+            if self.failures != failures:
+                raise self.error
+            self.cond.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                # give concurrent writers a moment to join this flush
+                self.cond.wait_for(
+                    lambda: (
+                        len(self.pending) >= self.max_pending
+                        or self.urgent
+                        or self.stopped
+                    ),
+                    timeout=self.interval,
+                )
+                changes, self.pending = self.pending, []
+                self.urgent = False
+                ticket = self.submitted
+            try:
+                self.write(changes)
+                error = None
+            except Exception as e:
+                error = e
+                log.exception("Writing %d contact changes failed", len(changes))
+            with self.cond:
+                self.error = error
+                if error is not None and self.mode == "async" and not self.stopped:
+                    # nobody waits for them, so they are kept for the next attempt,
+                    # in front of those queued meanwhile
+                    self.pending[:0] = changes
+                    self.failures += 1
+                    self.cond.notify_all()
+                    self.cond.wait_for(lambda: self.stopped or self.urgent, self.retry)
+                    self.urgent = True  # the retry delay stands in for `interval`
+                    continue
+                self.flushed = ticket
+                self.cond.notify_all()
+
+    def stop(self):
+        "Writes what is still pending and ends the thread, registered to run at exit."
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        atexit.unregister(self.stop)
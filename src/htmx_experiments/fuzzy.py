@@ -0,0 +1,132 @@
+"""Typo tolerant search, which finds contacts with words close to those of a query.
+
+Stores provide a vocabulary of the words of their search keys with two methods:
+`seek(text)`, the first word not sorting before `text`, and `ids(word)`, the ids
+of the contacts containing the word. The vocabulary is walked in sorted order
+like a trie: words sharing a prefix share the rows of the edit distance table
+computed for it, and all words starting with a prefix which is already too far
+from the query word are skipped with a single seek. So a lookup only visits the
+words near the query word instead of computing the distance to every word.
+"""
+
+import heapq
+import re
+
+WORD = re.compile(r"\w+")
+
+
+def words(text: str) -> list[str]:
+    return WORD.findall(text)
+
+
+def max_edits(word: str) -> int:
+    "Typos tolerated in a query word, none in short ones which would match too much."
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 7:
+        return 1
+    return 2
+
+
+def similar(word: str, vocabulary) -> dict[str, int]:
+    """Maps the words of `vocabulary` which start with `word`, give or take
+    `max_edits(word)` insertions, deletions, substitutions or transpositions,
+    to the number of edits."""
+    edits = max_edits(word)
+    found = {}
+    if edits == 0:
+        current = vocabulary.seek(word)
+        while current is not None and current.startswith(word):
+            found[current] = 0
+            current = vocabulary.seek(current + "\0")
+        return found
+    n = len(word)
+    # all that matters about larger distances is that they are too large
+    cap = edits + 1
+    # rows[j][i] are the edits between word[:i] and the first j characters of
+    # `current`, capped at `cap`. Only cells with |i - j| <= edits can be smaller.
+    # best[j] are the fewest edits between word and any of those prefixes, and
+    # smallest[j] the smallest value of rows[j].
+    rows = [[min(i, cap) for i in range(n + 1)]]
+    best = [rows[0][n]]
+    smallest = [0]
+    previous = ""
+    current = vocabulary.seek("")
+    while current is not None:
+        common = 0
+        while (
+            common < min(len(previous), len(current))
+            and previous[common] == current[common]
+        ):
+            common += 1
+        del rows[common + 1 :], best[common + 1 :], smallest[common + 1 :]
+        for j in range(common + 1, len(current) + 1):
+            ch = current[j - 1]
+            above = rows[j - 1]
+            row = [cap] * (n + 1)
+            row[0] = least = min(j, cap)
+            for i in range(max(1, j - edits), min(n, j + edits) + 1):
+                edit = above[i - 1] + (word[i - 1] != ch)
+                if above[i] < edit:
+                    edit = above[i] + 1
+                if row[i - 1] < edit:
+                    edit = row[i - 1] + 1
+                if (
+                    i > 1
+                    and j > 1
+                    and ch == word[i - 2]
+                    and current[j - 2] == word[i - 1]
+                    and rows[j - 2][i - 2] < edit
+                ):
+                    edit = rows[j - 2][i - 2] + 1
+                if edit > cap:
+                    edit = cap
+                row[i] = edit
+                if edit < least:
+                    least = edit
+            rows.append(row)
+            best.append(min(best[j - 1], row[n]))
+            smallest.append(least)
+            # longer prefixes can't get closer than this row or the one above plus one
+            if best[j] > edits and least > edits and smallest[j - 1] >= edits:
+                previous = current[:j]
+                current = vocabulary.seek(previous[:-1] + chr(ord(previous[-1]) + 1))
+                break
+        else:
+            if best[-1] <= edits:
+                found[current] = best[-1]
+            previous = current
+            # no word contains "\0", so this is the word following `current`
+            current = vocabulary.seek(current + "\0")
+    return found
+
+
+def rank(vocabulary, query: str, limit: int) -> list[int]:
+    """Ids of the `limit` contacts closest to the folded `query`, best first.
+
+    A contact has to contain each word of `query`, give or take its `max_edits`,
+    at the start of one of its words. Contacts with fewer edits come first, then
+    those whose words are closest in length to the query's, then by id.
+    """
+    scores = None
+    for word in set(words(query)):
+        costs = {}
+        for match, n in similar(word, vocabulary).items():
+            cost = (n, len(match) - len(word))
+            for id_ in vocabulary.ids(match):
+                if cost < costs.get(id_, (n + 1, 0)):
+                    costs[id_] = cost
+        if scores is None:
+            scores = costs
+        else:
+            scores = {
+                id_: (a + costs[id_][0], b + costs[id_][1])
+                for id_, (a, b) in scores.items()
+                if id_ in costs
+            }
+        if not scores:
+            return []
+    if scores is None:
+        return []
+    best = heapq.nsmallest(limit, ((cost, id_) for id_, cost in scores.items()))
+    return [id_ for _, id_ in best]
@@ -0,0 +1,142 @@
+"Append-only log of contact mutations, replayed on top of the JSON snapshot."
+
+import json
+import os
+from pathlib import Path
+from threading import RLock
+
+
+class Journal:
+    """Writes one compact JSON line per mutation.
+
+    `Contact` appends a record for every `save` / `delete` and folds the log into
+    `contacts.json` once `compact_every` records have piled up, so the cost of a
+    write depends on the size of the change, not on the size of the table.
+
+    Processes sharing the log learn about each other's changes via `follow`.
+    Compaction replaces the log with a new file, so that they can still read the
+    rest of the old one.
+    """
+
+    def __init__(self, path="contacts.log", compact_every=1000):
+        self.path = Path(path)
+        self.compact_every = compact_every
+        self.size = 0  # records appended since the last compaction
+        self.file = None
+        self.reader = None  # the log as read by `follow`, up to `position`
+        self.position = 0
+        self.lock = RLock()
+
+    def append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            if self.file is not None and self.replaced(self.file):
+                # another process compacted the log
+                self.file.close()
+                self.file = None
+            if self.file is None:
+                self.repair()
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.size += 1
+            if self.reader is not None and not self.replaced(self.reader):
+                # nothing to `follow` up to here if it was called right before
+                self.position = self.file.tell()
+
+    def repair(self):
+        """Cuts off a torn last line, which a crash in the middle of `append` leaves,
+        so that the next record doesn't continue it.
+
+        Writers hold a lock which keeps other processes from appending meanwhile,
+        so a line without its newline can't be one still being written.
+        """
+        try:
+            f = open(self.path, "r+b")
+        except FileNotFoundError:
+            return
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def replaced(self, file) -> bool:
+        "True if `file` is no longer the file at `path`."
+        try:
+            return os.stat(self.path).st_ino != os.fstat(file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def follow(self) -> list[dict]:
+        """Returns the records appended since the last call, by any process.
+
+        Writers should call it right before `append`, while holding a lock which
+        keeps other processes from writing, so that it skips their own records.
+        """
+        records = []
+        with self.lock:
+            while True:
+                if self.reader is None:
+                    if not self.path.exists():
+                        return records
+                    self.reader = open(self.path, "rb")
+                    self.position = 0
+                    self.size = 0
+                if os.fstat(self.reader.fileno()).st_size > self.position:
+                    self.reader.seek(self.position)
+                    for line in self.reader:
+                        if not line.endswith(b"\n"):
+                            break  # not completely written yet
+                        records.append(json.loads(line))
+                        self.position += len(line)
+                        self.size += 1
+                if not self.replaced(self.reader):
+                    return records
+                # the rest of the old log is read, continue with the new one
+                self.reader.close()
+                self.reader = None
+
+    def behind(self) -> bool:
+        "True if `follow` would find new records, only looking at the file's size."
+        with self.lock:
+            try:
+                size = os.stat(self.path).st_size
+            except FileNotFoundError:
+                return False
+            if self.reader is None:
+                return True
+            return size > self.position or self.replaced(self.reader)
+
+    def rewind(self):
+        "Makes the next `follow` start at the beginning of the log."
+        with self.lock:
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+    def truncate(self):
+        with self.lock:
+            self.close()
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text("")
+            os.replace(tmp, self.path)
+            self.size = 0
+            # follow the new log from its start, but past the records appended next
+            self.reader = open(self.path, "rb")
+            self.position = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.rewind()
+
+    def should_compact(self) -> bool:
+        return self.size >= self.compact_every
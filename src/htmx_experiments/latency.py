@@ -0,0 +1,28 @@
+"""Opt-in artificial delays for `Contact` operations, to reproduce a slow backend.
+
+Set `CONTACTS_LATENCY` to comma separated `operation=seconds` pairs, e.g.
+`CONTACTS_LATENCY=count=2,search=0.1`, or change `DELAYS` at runtime.
+Operations are "count", "search" and "save".
+"""
+
+import os
+import time
+
+
+def parse(spec: str) -> dict[str, float]:
+    delays = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        operation, _, seconds = item.partition("=")
+        delays[operation.strip()] = float(seconds)
+    return delays
+
+
+DELAYS = parse(os.environ.get("CONTACTS_LATENCY", ""))
+
+
+def inject(operation: str):
+    delay = DELAYS.get(operation)
+    if delay:
+        time.sleep(delay)
@@ -0,0 +1,44 @@
+"Loads the contacts once, in a background thread or when they are first needed."
+
+from threading import Event, Lock, Thread
+
+
+class Loader:
+    """Calls `load` once it succeeded, however many threads ask for it.
+
+    A failed `load` is retried by the next `wait`, so a missing file can be
+    fixed without restarting the app.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.lock = Lock()
+        self.loaded = Event()
+        self.error = None
+        self.started = False  # set by `start`
+
+    def start(self):
+        "Loads in a background thread, so that the app can answer health checks meanwhile."
+        self.started = True
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        with self.lock:
+            if self.loaded.is_set():
+                return
+            try:
+                self.load()
+            except Exception as e:
+                self.error = e
+                raise
+            self.error = None
+            self.loaded.set()
+
+    def wait(self):
+        "Returns once loaded, loading right here if no other thread is at it."
+        if not self.loaded.is_set():
+            self.run()
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded.is_set()
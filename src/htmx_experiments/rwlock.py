@@ -0,0 +1,47 @@
+"Readers-writer lock for the in-memory contact tables."
+
+from contextlib import contextmanager
+from threading import Condition
+
+
+class RWLock:
+    """Lets any number of readers in at once, but a writer only alone.
+
+    A waiting writer keeps new readers out, so a steady stream of searches can't
+    starve writers. Writers are expected to hold the lock only briefly.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writing or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
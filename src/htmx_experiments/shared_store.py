@@ -0,0 +1,294 @@
+"""Contact storage in a memory-mapped file, shared by all processes serving it.
+
+Every process maps the same file, so the operating system keeps a single copy of
+the contacts in memory however many workers read them. A writer publishes a new
+version by writing a new file and renaming it over the old one. Readers map the
+new version the next time they read, reads already in progress finish on the
+version they started with.
+
+The file is a `htmx_experiments.snapshot`, so it can also be converted from
+and to contacts.json.
+"""
+
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from .filelock import FileLock
+from .fuzzy import rank
+from .snapshot import FIELDS, Snapshot, encode, write_file
+from .table import WordIndex, fold, needle, sort_key, sort_order
+
+COUNTER = struct.Struct("<q")
+
+
+class SharedStore(MutableMapping):
+    """Mapping of contact id to `Contact`, backed by a memory-mapped file.
+
+    Writes are buffered by `transaction` and published together when it ends,
+    one writer at a time across all processes, which a `FileLock` on
+    `{path}.lock` ensures. The lock file also holds the id counter, which the
+    snapshot records as of its version. Reads see the latest published version
+    and decode the rows they return into fresh `Contact` instances, so changes
+    have to be written back via `__setitem__`.
+    """
+
+    durable = True  # every write is published, no need for `Contact.save_db`
+
+    def __init__(self, factory, path="contacts.mmap"):
+        self.factory = factory  # builds a contact from (id, first, last, phone, email)
+        self.path = str(path)
+        self.lock = FileLock(f"{self.path}.lock")
+        self.pending = None  # id -> record or None (deleted) of the open transaction
+        self.snapshot = None
+        # built for a snapshot by the first request needing them
+        self.words = None  # (snapshot, its `WordIndex`), see `fuzzy_search`
+        self.orders = {}  # field -> (snapshot, positions sorted by it), see `page`
+        self.index_lock = threading.Lock()
+        with self.transaction():
+            pass  # maps the latest version, creating the file if needed
+
+    def close(self):
+        self.lock.close()
+
+    def current(self) -> Snapshot:
+        "Returns the latest published version, mapping it if it is new."
+        snapshot = self.snapshot
+        if snapshot is None or os.stat(self.path).st_ino != snapshot.inode:
+            snapshot = self.snapshot = Snapshot(self.path)
+        return snapshot
+
+    @contextmanager
+    def transaction(self):
+        "Publishes all writes of the block as one version, or none of them on error."
+        with self.lock.hold():
+            if self.pending is not None:
+                yield
+                return
+            try:
+                if not os.path.exists(self.path):
+                    write_file(self.path, array("q"), array("q", [0]), [])
+                self.current()
+                self.pending = {}
+                yield
+                if self.pending:
+                    self.publish(self.pending)
+            finally:
+                self.pending = None
+
+    def publish(self, changes: dict):
+        "Writes the next version, copying the unchanged records in bulk."
+        old = self.snapshot
+        ids, offsets, heap = array("q"), array("q"), []
+        size = 0
+
+        def copy(start, stop):
+            nonlocal size
+            if start == stop:
+                return
+            ids.frombytes(
+                old.view[old.ids_start + 8 * start : old.ids_start + 8 * stop]
+            )
+            shift = size - old.offsets[start]
+            if shift:
+                offsets.extend(offset + shift for offset in old.offsets[start:stop])
+            else:
+                offsets.frombytes(
+                    old.view[
+                        old.offsets_start + 8 * start : old.offsets_start + 8 * stop
+                    ]
+                )
+            heap.append(
+                old.view[old.heap + old.offsets[start] : old.heap + old.offsets[stop]]
+            )
+            size += old.offsets[stop] - old.offsets[start]
+
+        done = 0  # records of `old` before this one are copied or replaced
+        for id_, record in sorted(changes.items()):
+            i = bisect_left(old.ids, id_)
+            copy(done, i)
+            done = i + 1 if i < old.count and old.ids[i] == id_ else i
+            if record is not None:
+                ids.append(id_)
+                offsets.append(size)
+                heap.append(record)
+                size += len(record)
+        copy(done, old.count)
+        offsets.append(size)
+        write_file(self.path, ids, offsets, heap, old.version + 1, self.next_id)
+        self.snapshot = Snapshot(self.path)
+
+    def contact(self, snapshot: Snapshot, i: int):
+        return self.factory(snapshot.ids[i], *snapshot.row(i))
+
+    def __getitem__(self, id_):
+        snapshot = self.current()
+        i = snapshot.index(id_)
+        if i is None:
+            raise KeyError(id_)
+        return self.contact(snapshot, i)
+
+    def __contains__(self, id_):
+        return self.current().index(id_) is not None
+
+    def __setitem__(self, id_, contact):
+        record = encode((contact.first, contact.last, contact.phone, contact.email))
+        with self.transaction():
+            self.pending[id_] = record
+            if id_ >= self.next_id:
+                self.next_id = id_ + 1
+
+    def __delitem__(self, id_):
+        with self.transaction():
+            if id_ in self.pending:
+                exists = self.pending[id_] is not None
+            else:
+                exists = id_ in self
+            if not exists:
+                raise KeyError(id_)
+            self.pending[id_] = None
+
+    def __iter__(self):
+        return iter(self.current().ids.tolist())
+
+    def __len__(self):
+        return self.current().count
+
+    def values(self) -> list:
+        snapshot = self.current()
+        return [self.contact(snapshot, i) for i in range(snapshot.count)]
+
+    def clear(self):
+        with self.transaction():
+            self.pending.clear()
+            self.pending.update(dict.fromkeys(self.snapshot.ids.tolist()))
+
+    @property
+    def next_id(self) -> int:
+        data = os.pread(self.lock.file, COUNTER.size, 0)
+        counter = COUNTER.unpack(data)[0] if data else 1
+        # the lock file is new if the snapshot was copied or converted
+        return max(counter, self.current().next_id)
+
+    @next_id.setter
+    def next_id(self, value: int):
+        with self.transaction():
+            os.pwrite(self.lock.file, COUNTER.pack(value), 0)
+
+    @property
+    def version(self) -> tuple:
+        "Changes with every published version, also if the file is replaced otherwise."
+        snapshot = self.current()
+        return (self.path, snapshot.inode, snapshot.version)
+
+    @contextmanager
+    def export(self):
+        """Yields the number of contacts, `next_id` and an iterator over the rows as
+        (id, first, last, phone, email) in id order, all as of entering the block.
+
+        Published versions never change, so the rows are decoded from the current
+        one as they are consumed.
+        """
+        snapshot = self.current()
+        rows = ((snapshot.ids[i], *snapshot.row(i)) for i in range(snapshot.count))
+        yield snapshot.count, snapshot.next_id, rows
+
+    def allocate_id(self) -> int:
+        with self.transaction():
+            id_ = self.next_id
+            self.next_id = id_ + 1
+        return id_
+
+    def reindex(self, contact):
+        "Nothing to do, there are no indexes besides the sorted ids."
+
+    def email_owners(self, email) -> set[int]:
+        snapshot = self.current()
+        if email:
+            found = snapshot.find(email.encode())
+        else:
+            # the empty email is contained in every record
+            found = range(snapshot.count)
+        return {snapshot.ids[i] for i in found if snapshot.row(i)[3] == email}
+
+    def page(self, start: int, stop: int, sort=None) -> list:
+        """Returns the contacts from `start` to `stop` by id, or in the order of `sort`.
+
+        The file only holds the id order, so each process sorts a snapshot by a
+        field when that order is first asked for. Every write publishes a new
+        snapshot, so with steady writes this costs each process a sort per write,
+        0.7 s for 200k contacts, see benchmarks/bench_startup.py.
+        """
+        snapshot = self.current()
+        if sort is None:
+            positions = range(snapshot.count)
+        else:
+            field, descending = sort_order(sort)
+            positions = self.order(snapshot, field)
+            if descending:
+                n = len(positions)
+                start, stop = max(n - stop, 0), max(n - start, 0)
+                positions = positions[start:stop][::-1]
+                start, stop = 0, None
+        return [self.contact(snapshot, i) for i in positions[start:stop]]
+
+    def order(self, snapshot: Snapshot, field: str) -> list[int]:
+        "Positions of the records of `snapshot` sorted by `field`, then by id."
+        with self.index_lock:
+            cached = self.orders.get(field)
+            if cached is None or cached[0] is not snapshot:
+                column = FIELDS.index(field)
+                keys = [
+                    sort_key(snapshot.row(i)[column]) for i in range(snapshot.count)
+                ]
+                # records are in id order, which `sorted` keeps for equal keys
+                positions = sorted(range(snapshot.count), key=keys.__getitem__)
+                cached = self.orders[field] = (snapshot, positions)
+            return cached[1]
+
+    def after(self, after_id: int, limit: int) -> list:
+        snapshot = self.current()
+        start = bisect_right(snapshot.ids, after_id)
+        return [
+            self.contact(snapshot, i)
+            for i in range(start, min(start + limit, snapshot.count))
+        ]
+
+    def search(self, text: str) -> list:
+        return list(self.iter_search(text))
+
+    def iter_search(self, text: str, after_id=0):
+        "Yields the contacts containing `text` with ids above `after_id`, in id order."
+        snapshot = self.current()
+        start = bisect_right(snapshot.ids, after_id)
+        found = needle(text)
+        if found:
+            # scans the heap, but in C and without decoding any record
+            hits = snapshot.find(found.encode(), start)
+        else:
+            hits = range(start, snapshot.count)
+        for i in hits:
+            # a hit may be in one of the raw fields, only the key counts
+            if found in snapshot.key(i):
+                yield self.contact(snapshot, i)
+
+    def fuzzy_search(self, text: str, limit: int) -> list:
+        """Returns the `limit` contacts closest to `text`, see `fuzzy.rank`.
+
+        The file has no word index, so each process builds one in memory for the
+        first fuzzy search after a change, 1.5 s for 100k contacts, see
+        benchmarks/bench_fuzzy.py.
+        """
+        snapshot = self.current()
+        with self.index_lock:
+            if self.words is None or self.words[0] is not snapshot:
+                words = WordIndex()
+                for i in range(snapshot.count):
+                    words.add_key(snapshot.ids[i], snapshot.key(i))
+                self.words = (snapshot, words)
+            found = rank(self.words[1], fold(text), limit)
+        return [self.contact(snapshot, snapshot.index(id_)) for id_ in found]
@@ -0,0 +1,155 @@
+"""Binary contacts snapshot, which is memory-mapped and decoded one record at a time.
+
+Opening a snapshot costs the same for any number of contacts, unlike parsing
+contacts.json, and only the records actually read are ever decoded.
+
+File layout, integers are little-endian:
+
+* header: magic, version, number of contacts `n`, next id (int64)
+* the `n` contact ids in ascending order (int64)
+* `n + 1` offsets of the records into the heap, the last one being its size (int64)
+* heap: the records in id order, each the byte lengths of first, last, phone,
+  email and their search key (int32, -1 for None) followed by the UTF-8 encoded
+  values, see `table.search_key`
+
+Convert from and to contacts.json with
+
+    python -m htmx_experiments.snapshot contacts.json contacts.mmap
+    python -m htmx_experiments.snapshot contacts.mmap contacts.json
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .table import search_key
+
+MAGIC = b"CONTACT3"  # CONTACT2 files lack the search keys, convert them again
+HEADER = struct.Struct("<8sqqq")
+LENGTHS = struct.Struct("<5i")
+FIELDS = ("first", "last", "phone", "email")
+
+
+def encode(row: tuple) -> bytes:
+    "Encodes (first, last, phone, email) and their search key as a heap record."
+    values = [None if value is None else value.encode() for value in row]
+    values.append(search_key(*row).encode())
+    lengths = LENGTHS.pack(*(-1 if value is None else len(value) for value in values))
+    return lengths + b"".join(value for value in values if value)
+
+
+def write_file(path: str, ids: array, offsets: array, heap: list, version=0, next_id=1):
+    "Writes a snapshot next to `path` and renames it into place."
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, version, len(ids), next_id))
+        f.write(ids)
+        f.write(offsets)
+        for piece in heap:
+            f.write(piece)
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    "A snapshot file, mapped read-only."
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.count, self.next_id = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a contacts snapshot")
+        self.view = memoryview(self.buf)
+        self.ids_start = HEADER.size
+        self.offsets_start = self.ids_start + 8 * self.count
+        self.heap = self.offsets_start + 8 * (self.count + 1)
+        self.ids = self.view[self.ids_start : self.offsets_start].cast("q")
+        self.offsets = self.view[self.offsets_start : self.heap].cast("q")
+
+    def index(self, id_) -> int | None:
+        "Position of the record of `id_`, if there is one."
+        i = bisect_left(self.ids, id_)
+        if i < self.count and self.ids[i] == id_:
+            return i
+        return None
+
+    def row(self, i: int) -> tuple:
+        "Decodes the `i`-th record into (first, last, phone, email)."
+        pos = self.heap + self.offsets[i]
+        lengths = LENGTHS.unpack_from(self.buf, pos)
+        pos += LENGTHS.size
+        values = []
+        for n in lengths[:-1]:
+            if n < 0:
+                values.append(None)
+            else:
+                values.append(str(self.view[pos : pos + n], "utf-8"))
+                pos += n
+        return tuple(values)
+
+    def key(self, i: int) -> str:
+        "The search key of the `i`-th record, without decoding its fields."
+        pos = self.heap + self.offsets[i]
+        *lengths, n = LENGTHS.unpack_from(self.buf, pos)
+        pos += LENGTHS.size + sum(length for length in lengths if length > 0)
+        return str(self.view[pos : pos + n], "utf-8")
+
+    def find(self, needle: bytes, start=0):
+        """Yields the positions, from `start` on, of the records whose bytes contain
+        `needle`, which must not be empty."""
+        pos = self.buf.find(needle, self.heap + self.offsets[start])
+        while pos != -1:
+            i = bisect_right(self.offsets, pos - self.heap) - 1
+            yield i
+            # continue with the next record, one hit per record is enough
+            pos = self.buf.find(needle, self.heap + self.offsets[i + 1])
+
+
+def from_json(json_path, path):
+    "Converts contacts.json, or a file in its format, into a snapshot."
+    with open(json_path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"next_id": 1, "contacts": data}
+    rows = sorted(data["contacts"], key=lambda c: c["id"])
+    ids, offsets, heap = array("q"), array("q"), []
+    size = 0
+    for c in rows:
+        record = encode(tuple(c[field] for field in FIELDS))
+        ids.append(c["id"])
+        offsets.append(size)
+        heap.append(record)
+        size += len(record)
+    offsets.append(size)
+    next_id = max(data["next_id"], ids[-1] + 1 if ids else 1)
+    write_file(str(path), ids, offsets, heap, next_id=next_id)
+
+
+def to_json(path, json_path):
+    "Converts a snapshot into the format of contacts.json."
+    snapshot = Snapshot(str(path))
+    contacts = [
+        {"id": snapshot.ids[i], **dict(zip(FIELDS, snapshot.row(i)))}
+        for i in range(snapshot.count)
+    ]
+    with open(json_path, "w") as f:
+        json.dump({"next_id": snapshot.next_id, "contacts": contacts}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts contacts between JSON and binary snapshots, "
+        "in the direction given by the extension of SOURCE."
+    )
+    parser.add_argument("source")
+    parser.add_argument("target")
+    args = parser.parse_args()
+    if args.source.endswith(".json"):
+        from_json(args.source, args.target)
+    else:
+        to_json(args.source, args.target)
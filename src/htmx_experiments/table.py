@@ -0,0 +1,566 @@
+"In-memory contact table which keeps secondary indexes in sync with its rows."
+
+import struct
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import UserDict
+from contextlib import contextmanager, nullcontext
+from itertools import count
+from sys import intern
+
+from .fuzzy import rank, words
+from .rwlock import RWLock
+
+# rows checked per read lock by `iter_search` for queries without trigrams
+SCAN_CHUNK = 1000
+# posting lists longer than this many times the candidates aren't intersected
+INTERSECT_RATIO = 4
+# versions are unique across tables, so that caches can't mix up two of them
+VERSIONS = count(1)
+# a query made of these, with at least one digit, is looked up in the phone digits
+PHONE_CHARS = frozenset("0123456789+-()./ ")
+# fields contacts can be listed by, see `sort_order`
+SORT_FIELDS = ("first", "last", "email")
+# the sorts a page can be asked for, each field ascending or descending
+SORTS = frozenset((*SORT_FIELDS, *(f"-{field}" for field in SORT_FIELDS)))
+# header of a `CompactTable` row, the lengths of its encoded fields
+RECORD = struct.Struct("<4i")
+
+
+def fold(text: str) -> str:
+    'Casefolds `text` and strips its accents, so that "zoe" finds "Zoë".'
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def digits(text: str) -> str:
+    return "".join(ch for ch in text if ch.isdigit())
+
+
+def search_key(first, last, phone, email) -> str:
+    """The string searches look at: first, last and email folded plus the digits of phone.
+
+    Stores compute it once per write, so that a search compares queries against
+    it without allocating anything per row.
+    """
+    folded = [fold(value) if value else "" for value in (first, last, email)]
+    return "\n".join([*folded, digits(phone) if phone else ""])
+
+
+def needle(text: str) -> str:
+    "The form of the query `text` which is looked up in search keys."
+    if set(text) <= PHONE_CHARS and any(ch.isdigit() for ch in text):
+        return digits(text)
+    return fold(text)
+
+
+def sort_order(sort: str) -> tuple[str, bool]:
+    'Splits a sort such as "last", or "-last" for descending, into field and direction.'
+    field = sort.removeprefix("-")
+    if field not in SORT_FIELDS:
+        raise ValueError(f"Contacts can't be sorted by {sort!r}")
+    return field, sort.startswith("-")
+
+
+def sort_key(value) -> str:
+    "Contacts sort case- and accent-insensitively, missing values first."
+    return fold(value) if value else ""
+
+
+def matches(contact, text: str) -> bool:
+    "True if `text` is found in the search key of `contact`, see `needle`."
+    key = search_key(contact.first, contact.last, contact.phone, contact.email)
+    return needle(text) in key
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class IdMap(dict):
+    """Maps keys to sets of ids.
+
+    Most keys belong to a single contact, so a lone id is stored as is rather
+    than in a set of its own, which is a lot smaller.
+    """
+
+    def add(self, key, id_):
+        ids = self.get(key)
+        if ids is None:
+            self[key] = id_
+        elif isinstance(ids, set):
+            ids.add(id_)
+        elif ids != id_:
+            self[key] = {ids, id_}
+
+    def discard(self, key, id_):
+        ids = self[key]
+        if not isinstance(ids, set):
+            del self[key]
+            return
+        ids.discard(id_)
+        if len(ids) == 1:
+            self[key] = ids.pop()
+
+    def ids(self, key) -> set[int]:
+        ids = self.get(key)
+        if ids is None:
+            return set()
+        return ids if isinstance(ids, set) else {ids}
+
+
+class EmailIndex:
+    """Maps an email to the ids of the contacts stored with it.
+
+    Like the other indexes, it first computes the `entry` of a contact, which may
+    fail, and `add` then stores it, which doesn't, see `ContactTable.__setitem__`.
+    """
+
+    def __init__(self):
+        self.ids = IdMap()
+        self.indexed = {}
+
+    def entry(self, contact, key: str):
+        hash(contact.email)  # raises for an unhashable email
+        return contact.email
+
+    def add(self, id_, email):
+        self.indexed[id_] = email
+        self.ids.add(email, id_)
+
+    def discard(self, id_):
+        self.ids.discard(self.indexed.pop(id_), id_)
+
+    def clear(self):
+        self.ids.clear()
+        self.indexed.clear()
+
+    def owners(self, email) -> set[int]:
+        return self.ids.ids(email)
+
+
+class TrigramIndex:
+    """Maps every three character substring of the search keys to the ids containing it.
+
+    A contact can only contain a needle of three or more characters if its search
+    key contains all of the needle's trigrams, so intersecting their posting lists
+    yields the candidates which still have to be checked against `keys`.
+
+    A posting list is an array of ids in ascending order, which takes 8 bytes per
+    id rather than a set's 50 or so. The postings are only built by the first search
+    which needs them, in one pass over the keys in id order which merely appends.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.postings = None  # trigram -> array of ids
+
+    def entry(self, contact, key: str) -> str:
+        return key
+
+    def add(self, id_, key: str):
+        self.keys[id_] = key
+        if self.postings is None:
+            return
+        for gram in trigrams(key):
+            ids = self.postings.get(gram)
+            if ids is None:
+                self.postings[gram] = array("q", [id_])
+            elif ids[-1] < id_:
+                ids.append(id_)
+            else:
+                ids.insert(bisect_left(ids, id_), id_)
+
+    def discard(self, id_):
+        key = self.keys.pop(id_)
+        if self.postings is None:
+            return
+        for gram in trigrams(key):
+            ids = self.postings[gram]
+            del ids[bisect_left(ids, id_)]
+            if not ids:
+                del self.postings[gram]
+
+    def clear(self):
+        self.keys.clear()
+        self.postings = None
+
+    def build(self):
+        "Builds the postings, if that wasn't done since they were cleared."
+        if self.postings is not None:
+            return
+        postings = {}
+        for id_ in sorted(self.keys):
+            for gram in trigrams(self.keys[id_]):
+                ids = postings.get(gram)
+                if ids is None:
+                    postings[gram] = array("q", [id_])
+                else:
+                    ids.append(id_)
+        self.postings = postings
+
+    def candidates(self, needle: str) -> list[int]:
+        """The ids, in ascending order, whose keys may contain `needle`.
+
+        Posting lists much longer than the candidates found so far hardly narrow
+        them down, so they are left out, checking the keys is as quick.
+        """
+        postings = sorted(
+            (self.postings.get(gram, ()) for gram in trigrams(needle)), key=len
+        )
+        found = list(postings[0])
+        for ids in postings[1:]:
+            if len(ids) > INTERSECT_RATIO * len(found):
+                break
+            found = intersect(found, ids)
+        return found
+
+
+def intersect(found: list[int], ids) -> list[int]:
+    "The ids of the ascending `found` which the ascending `ids` contain too."
+    kept = []
+    i = 0
+    for id_ in found:
+        # both ascend, so the next one is looked up after this one
+        i = bisect_left(ids, id_, i)
+        if i == len(ids):
+            break
+        if ids[i] == id_:
+            kept.append(id_)
+    return kept
+
+
+class WordIndex:
+    """Maps the words of the search keys to the ids containing them, for `fuzzy`.
+
+    The sorted list of words is only built by the first fuzzy search, which saves
+    sorting while loading and inserting into it for every new word meanwhile.
+    """
+
+    def __init__(self):
+        self.postings = IdMap()
+        self.indexed = {}
+        self.sorted = None
+
+    def entry(self, contact, key: str) -> tuple:
+        return tuple({intern(word) for word in words(key)})
+
+    def add(self, id_, found: tuple):
+        self.indexed[id_] = found
+        for word in found:
+            if self.sorted is not None and word not in self.postings:
+                insort(self.sorted, word)
+            self.postings.add(word, id_)
+
+    def add_key(self, id_, key: str):
+        self.add(id_, self.entry(None, key))
+
+    def discard(self, id_):
+        for word in self.indexed.pop(id_):
+            self.postings.discard(word, id_)
+            if self.sorted is not None and word not in self.postings:
+                del self.sorted[bisect_left(self.sorted, word)]
+
+    def clear(self):
+        self.postings.clear()
+        self.indexed.clear()
+        self.sorted = None
+
+    def build(self):
+        "Sorts the words, if that wasn't done since they were cleared."
+        if self.sorted is None:
+            self.sorted = sorted(self.postings)
+
+    def seek(self, text: str) -> str | None:
+        self.build()
+        i = bisect_left(self.sorted, text)
+        return self.sorted[i] if i < len(self.sorted) else None
+
+    def ids(self, word: str) -> set[int]:
+        return self.postings.ids(word)
+
+
+class SortedIndex:
+    """Keeps the ids sorted by the `sort_key` of a field, ties by id, for paging.
+
+    The order is only built by the first page requested in it, so fields which
+    are never sorted by cost nothing. From then on every write moves one entry,
+    and a page is a slice of the order.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.indexed = {}
+        self.order = None  # sorted (sort key, id) pairs
+
+    def build(self, contacts):
+        for c in contacts:
+            self.indexed[c.id] = sort_key(getattr(c, self.field))
+        self.order = sorted((key, id_) for id_, key in self.indexed.items())
+
+    def entry(self, contact, key: str) -> str | None:
+        if self.order is not None:
+            return sort_key(getattr(contact, self.field))
+        return None
+
+    def add(self, id_, key: str | None):
+        if self.order is not None:
+            self.indexed[id_] = key
+            insort(self.order, (key, id_))
+
+    def discard(self, id_):
+        if self.order is not None:
+            del self.order[bisect_left(self.order, (self.indexed.pop(id_), id_))]
+
+    def clear(self):
+        self.indexed.clear()
+        self.order = None
+
+    def ids(self, start: int, stop: int, descending=False) -> list[int]:
+        if descending:
+            n = len(self.order)
+            pairs = self.order[max(n - stop, 0) : max(n - start, 0)][::-1]
+        else:
+            pairs = self.order[start:stop]
+        return [id_ for _, id_ in pairs]
+
+
+class ContactTable(UserDict):
+    """Mapping of contact id to `Contact`.
+
+    Every write goes through `__setitem__` / `__delitem__`, so the indexes always
+    describe the rows currently stored. `ids` holds the stored ids in ascending
+    order for paging. `next_id` only ever grows, so ids of deleted contacts are
+    not handed out again. `version` changes with every write.
+
+    Writes hold `lock` for writing, reads which look at more than one row hold
+    it for reading, so that threads can search and page concurrently while
+    writers change the table one at a time.
+    """
+
+    durable = False  # `Contact` persists the table to contacts.json
+
+    def __init__(self, rows=None):
+        self.emails = EmailIndex()
+        self.trigrams = TrigramIndex()
+        self.words = WordIndex()
+        self.sorts = {field: SortedIndex(field) for field in SORT_FIELDS}
+        self.indexes = [self.emails, self.trigrams, self.words, *self.sorts.values()]
+        self.ids = []
+        self.next_id = 1
+        self.version = next(VERSIONS)
+        self.lock = RWLock()
+        super().__init__(rows)
+
+    def pack(self, contact):
+        "Turns a contact into the row stored in `data`."
+        return contact
+
+    def unpack(self, id_, row):
+        "Turns a row of `data` back into a contact."
+        return row
+
+    def fields(self, row) -> tuple:
+        "(first, last, phone, email) of a row of `data`."
+        return (row.first, row.last, row.phone, row.email)
+
+    def __getitem__(self, id_):
+        return self.unpack(id_, self.data[id_])
+
+    def get(self, id_, default=None):
+        row = self.data.get(id_)
+        return default if row is None else self.unpack(id_, row)
+
+    def __iter__(self):
+        with self.lock.read():
+            return iter(self.ids[:])
+
+    def values(self) -> list:
+        with self.lock.read():
+            return [self.unpack(id_, self.data[id_]) for id_ in self.ids]
+
+    def __setitem__(self, id_, contact):
+        row = self.pack(contact)
+        indexed = self.unpack(id_, row)
+        key = search_key(*self.fields(row))
+        with self.lock.write():
+            # everything which may fail, e.g. for a field which isn't a string,
+            # before anything changes
+            entries = [index.entry(indexed, key) for index in self.indexes]
+            if id_ in self.data:
+                for index in self.indexes:
+                    index.discard(id_)
+            elif not self.ids or id_ > self.ids[-1]:
+                # new contacts get the highest id so far, appending keeps `ids` sorted
+                self.ids.append(id_)
+            else:
+                self.ids.insert(bisect_left(self.ids, id_), id_)
+            self.data[id_] = row
+            for index, entry in zip(self.indexes, entries):
+                index.add(id_, entry)
+            if id_ >= self.next_id:
+                self.next_id = id_ + 1
+            self.version = next(VERSIONS)
+
+    def __delitem__(self, id_):
+        with self.lock.write():
+            del self.data[id_]
+            del self.ids[bisect_left(self.ids, id_)]
+            for index in self.indexes:
+                index.discard(id_)
+            self.version = next(VERSIONS)
+
+    def clear(self):
+        with self.lock.write():
+            self.data.clear()
+            self.ids.clear()
+            for index in self.indexes:
+                index.clear()
+            self.version = next(VERSIONS)
+
+    def transaction(self):
+        "Nothing to roll back, `Batch` validates before it writes."
+        return nullcontext()
+
+    @contextmanager
+    def export(self):
+        """Yields the number of contacts, `next_id` and an iterator over the rows as
+        (id, first, last, phone, email) in id order, all as of entering the block.
+
+        Stored contacts may be changed in place, so the fields are copied under the
+        read lock, which costs a tuple per contact but no strings.
+        """
+        with self.lock.read():
+            rows = [(id_, *self.fields(self.data[id_])) for id_ in self.ids]
+            next_id = self.next_id
+        yield len(rows), next_id, iter(rows)
+
+    def allocate_id(self) -> int:
+        with self.lock.write():
+            id_ = self.next_id
+            self.next_id += 1
+        return id_
+
+    def reindex(self, contact):
+        "Refreshes the indexes for `contact` if it is the row stored under its id."
+        if self.data.get(contact.id) is contact:
+            self[contact.id] = contact
+
+    def email_owners(self, email) -> set[int]:
+        with self.lock.read():
+            return set(self.emails.owners(email))
+
+    def page(self, start: int, stop: int, sort=None) -> list:
+        "Returns the contacts from `start` to `stop` by id, or in the order of `sort`."
+        if sort is None:
+            with self.lock.read():
+                return [self[id_] for id_ in self.ids[start:stop]]
+        field, descending = sort_order(sort)
+        index = self.sorts[field]
+        if index.order is None:
+            with self.lock.write():
+                if index.order is None:
+                    index.build(self.unpack(id_, row) for id_, row in self.data.items())
+        with self.lock.read():
+            return [self[id_] for id_ in index.ids(start, stop, descending)]
+
+    def after(self, after_id: int, limit: int) -> list:
+        "Returns up to `limit` contacts with ids greater than `after_id`."
+        with self.lock.read():
+            start = bisect_right(self.ids, after_id)
+            return [self[id_] for id_ in self.ids[start : start + limit]]
+
+    def search(self, text: str) -> list:
+        return list(self.iter_search(text))
+
+    def iter_search(self, text: str, after_id=0):
+        """Yields the contacts containing `text` with ids above `after_id`, in id order.
+
+        Rows are read as the generator is consumed, so taking a page of results
+        stops the search early. The lock is only held while reading rows, never
+        while the caller handles a result.
+        """
+        found = needle(text)
+        keys = self.trigrams.keys
+        if len(found) >= 3:
+            while True:
+                with self.lock.read():
+                    if self.trigrams.postings is not None:
+                        ids = self.trigrams.candidates(found)
+                        break
+                # only building the postings, once, needs a write lock
+                with self.lock.write():
+                    self.trigrams.build()
+            ids = ids[bisect_right(ids, after_id) :]
+            for start in range(0, len(ids), SCAN_CHUNK):
+                # a row is read along with its key, candidates may have changed or
+                # be gone in the meantime
+                with self.lock.read():
+                    rows = [
+                        self[id_]
+                        for id_ in ids[start : start + SCAN_CHUNK]
+                        if found in keys.get(id_, "")
+                    ]
+                yield from rows
+            return
+        while True:
+            with self.lock.read():
+                start = bisect_right(self.ids, after_id)
+                chunk = self.ids[start : start + SCAN_CHUNK]
+                rows = [self[id_] for id_ in chunk if found in keys[id_]]
+            if not chunk:
+                return
+            yield from rows
+            after_id = chunk[-1]
+
+    def fuzzy_search(self, text: str, limit: int) -> list:
+        "Returns the `limit` contacts closest to `text`, see `fuzzy.rank`."
+        while True:
+            with self.lock.read():
+                if self.words.sorted is not None:
+                    return [self[id_] for id_ in rank(self.words, fold(text), limit)]
+            # only sorting the words, once, needs a write lock
+            with self.lock.write():
+                self.words.build()
+
+
+class CompactTable(ContactTable):
+    """`ContactTable` which stores each contact as a single bytes record.
+
+    A record is the `RECORD` header, the UTF-8 length of each field or -1 for None,
+    followed by the encoded fields, less than half the size of a `Contact` with
+    its strings, see benchmarks/bench_memory.py.
+    A `Contact`, together with its `errors`, is only created when a row is read,
+    so reads return copies and changes have to be written back via `__setitem__`.
+    """
+
+    def __init__(self, factory, rows=None):
+        self.factory = factory  # builds a contact from (id, first, last, phone, email)
+        super().__init__(rows)
+
+    def pack(self, contact) -> bytes:
+        values = [
+            None if value is None else value.encode()
+            for value in (contact.first, contact.last, contact.phone, contact.email)
+        ]
+        lengths = RECORD.pack(
+            *(-1 if value is None else len(value) for value in values)
+        )
+        return lengths + b"".join(value for value in values if value)
+
+    def unpack(self, id_, row: bytes):
+        return self.factory(id_, *self.fields(row))
+
+    def fields(self, row: bytes) -> tuple:
+        values = []
+        pos = RECORD.size
+        for n in RECORD.unpack_from(row):
+            if n < 0:
+                values.append(None)
+            else:
+                values.append(str(row[pos : pos + n], "utf-8"))
+                pos += n
+        return tuple(values)
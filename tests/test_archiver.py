@@ -0,0 +1,480 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import src.htmx_experiments.archiver as archiver
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.archiver import (
+    FIELDS,
+    FORMATS,
+    ArchiveManager,
+    Archiver,
+    Manifest,
+    accepts_gzip,
+    etag_matches,
+    json_object,
+    read_archive,
+    sse,
+    write_archive,
+)
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.shared_store import SharedStore
+from src.htmx_experiments.sqlite_store import SqliteStore
+from src.htmx_experiments.table import CompactTable, ContactTable
+
+ROOT = Path(__file__).resolve().parent.parent
+ROWS = [
+    (1, "Alice", "Smith", "123-456", "alice@example.com"),
+    (2, "Bob", 'O"Brien', None, "bob@example.com"),
+    (4, "Zoë", "Ørsted", "", "zoe@example.com"),
+]
+
+
+def make_store(kind, tmp_path):
+    if kind == "memory":
+        return ContactTable()
+    if kind == "compact":
+        return CompactTable(Contact)
+    if kind == "sqlite":
+        return SqliteStore(Contact, tmp_path / "contacts.sqlite3")
+    return SharedStore(Contact, tmp_path / "contacts.mmap")
+
+
+@pytest.fixture(params=["memory", "compact", "sqlite", "shared"])
+def store(request, tmp_path):
+    store = make_store(request.param, tmp_path)
+    with store.transaction():
+        for row in ROWS:
+            store[row[0]] = Contact(*row)
+        store.next_id = 7
+    yield store
+    if hasattr(store, "close"):
+        store.close()
+
+
+DICTS = [dict(zip(["id", "first", "last", "phone", "email"], row)) for row in ROWS]
+
+
+def test_write_archive_has_the_format_of_contacts_json(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(archiver, "CHUNK_ROWS", 2)
+    fractions = []
+
+    size = write_archive(store, tmp_path / "archive.json.gz", fractions.append)
+    text = gzip.decompress((tmp_path / "archive.json.gz").read_bytes())
+    assert size == len(text)
+    data = json.loads(text)
+    assert data["next_id"] == 7
+    assert data["contacts"] == DICTS
+    assert fractions == [2 / 3, 1.0]
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 1000])
+def test_write_archive_formats(tmp_path, monkeypatch, chunk_rows):
+    monkeypatch.setattr(archiver, "CHUNK_ROWS", chunk_rows)
+    table = ContactTable({row[0]: Contact(*row) for row in ROWS})
+
+    for format_ in FORMATS:
+        path = tmp_path / f"archive.{format_}.gz"
+        write_archive(table, path, format_=format_)
+        text = b"".join(read_archive(path, chunk_size=16)).decode()
+        if format_ == "json":
+            assert json.loads(text)["contacts"] == DICTS
+        elif format_ == "ndjson":
+            assert [json.loads(line) for line in text.splitlines()] == DICTS
+        else:
+            lines = list(csv.DictReader(io.StringIO(text, newline="")))
+            assert [line["last"] for line in lines] == ["Smith", 'O"Brien', "Ørsted"]
+            assert lines[1]["phone"] == ""
+
+
+def test_json_object_equals_json_dumps():
+    for row in [*ROWS, (9, "Tab\tand \\ and \u2028", None, None, None)]:
+        expected = json.dumps(dict(zip(FIELDS, row)), separators=(",", ":"))
+        assert json_object(row) == expected
+
+
+def test_write_archive_of_no_contacts(tmp_path):
+    assert write_archive(ContactTable(), tmp_path / "archive.json.gz")
+    data = json.loads(gzip.decompress((tmp_path / "archive.json.gz").read_bytes()))
+    assert data == {"next_id": 1, "contacts": []}
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("gzip, deflate, br", True),
+        ("br;q=1.0, GZIP;q=0.5", True),
+        ("gzip;q=0", False),
+        ("*", True),
+        ("identity", False),
+        (None, False),
+    ],
+)
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) == expected
+
+
+def test_digest_addresses_the_content(tmp_path):
+    table = ContactTable({row[0]: Contact(*row) for row in ROWS})
+    digests = []
+    for name in ["a", "b", "c"]:
+        if name == "c":
+            table[1] = Contact(1, "Alicia", "Smith", "123-456", "alice@example.com")
+        manifest = Manifest()
+        write_archive(table, tmp_path / f"{name}.json.gz", manifest=manifest)
+        digests.append(manifest.digest)
+    assert digests[0] == digests[1] != digests[2]
+    assert list(manifest.ids) == [1, 2, 4]
+
+
+def test_manifest_hashes_are_the_same_in_every_process():
+    code = (
+        "from src.htmx_experiments.archiver import Manifest; "
+        f"print(list(Manifest().add({ROWS!r})))"
+    )
+    hashes = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=ROOT,
+            env=os.environ | {"PYTHONHASHSEED": seed},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in ["1", "2"]
+    }
+    assert hashes == {f"{list(Manifest().add(ROWS))}\n"}
+
+
+def test_saved_manifest_loads(tmp_path):
+    manifest = Manifest()
+    manifest.add(ROWS)
+    manifest.save(tmp_path / "a.manifest")
+
+    loaded = Manifest.load(tmp_path / "a.manifest", "abc")
+    assert (loaded.ids, loaded.hashes) == (manifest.ids, manifest.hashes)
+    assert loaded.digest == "abc"
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 1000])
+def test_changes_since_an_archive(tmp_path, monkeypatch, chunk_rows):
+    monkeypatch.setattr(archiver, "CHUNK_ROWS", chunk_rows)
+    table = ContactTable({row[0]: Contact(*row) for row in ROWS})
+    base = Manifest()
+    write_archive(table, tmp_path / "full.json.gz", manifest=base)
+    table[2] = Contact(2, "Bob", "Brien", None, "bob@example.com")
+    table[5] = Contact(5, "Eve", "Ng", None, "eve@example.com")
+    del table[4]
+
+    write_archive(table, tmp_path / "changes.json.gz", base=base)
+    data = json.loads(gzip.decompress((tmp_path / "changes.json.gz").read_bytes()))
+    assert data["since"] == base.digest
+    assert [c["id"] for c in data["contacts"]] == [2, 5]
+    assert data["deleted"] == [4]
+
+    write_archive(table, tmp_path / "changes.ndjson.gz", format_="ndjson", base=base)
+    text = gzip.decompress((tmp_path / "changes.ndjson.gz").read_bytes())
+    lines = [json.loads(line) for line in text.splitlines()]
+    assert [line["id"] for line in lines] == [2, 5, 4]
+    assert lines[2] == {"id": 4, "deleted": True}
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"xyz", W/"abc"', True),
+        ("*", True),
+        ('"xyz"', False),
+        ("abc", False),
+        (None, False),
+    ],
+)
+def test_etag_matches(header, expected):
+    assert etag_matches(header, "abc") == expected
+
+
+def test_export_ignores_later_writes(store):
+    with store.export() as (count, next_id, rows):
+        first = next(rows)
+        store[1] = Contact(1, "Changed")
+        del store[2]
+        store[5] = Contact(5, "New")
+        rest = list(rows)
+    assert count == 3
+    assert [first, *rest] == [tuple(row) for row in ROWS]
+
+
+def test_cancelled_write_keeps_previous_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(archiver, "CHUNK_ROWS", 1)
+    path = tmp_path / "archive.json"
+    path.write_text("previous")
+    table = ContactTable({row[0]: Contact(*row) for row in ROWS})
+
+    assert not write_archive(table, path, cancelled=lambda: True)
+    assert path.read_text() == "previous"
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+@pytest.fixture
+def contacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        Contact, "db", ContactTable({row[0]: Contact(*row) for row in ROWS})
+    )
+
+
+def wait_for(job: Archiver, *statuses):
+    for _ in range(200):
+        if job.status() in statuses:
+            return
+        time.sleep(0.01)
+    raise AssertionError(f"{job.status()} not in {statuses}")
+
+
+def test_jobs_have_their_own_progress_and_file(contacts, tmp_path):
+    manager = ArchiveManager(workers=2)
+    first, second = manager.submit(), manager.submit("csv")
+    wait_for(first, "Complete")
+    wait_for(second, "Complete")
+
+    assert first.id != second.id
+    assert first.archive_file().endswith(".json.gz")
+    assert second.archive_file().endswith(".csv.gz")
+    assert (second.download_name(), second.media_type()) == ("contacts.csv", "text/csv")
+    data = json.loads(gzip.decompress(Path(first.archive_file()).read_bytes()))
+    assert [c["id"] for c in data["contacts"]] == [1, 2, 4]
+    assert manager.get(first.id) is first
+    assert manager.get("unknown") is None
+
+    manager.cancel(first.id)
+    assert manager.get(first.id) is None
+    assert not Path(first.archive_file()).exists()
+    assert Path(second.archive_file()).exists()
+
+
+def test_other_processes_find_complete_jobs(contacts, tmp_path):
+    job = ArchiveManager().submit("csv")
+    wait_for(job, "Complete")
+
+    # as in another worker process, which only shares the data directory
+    other = ArchiveManager()
+    found = other.get(job.id)
+    assert found.status() == "Complete"
+    assert (found.format_name, found.digest, found.size) == (
+        "csv",
+        job.digest,
+        job.size,
+    )
+    assert found.archive_file() == job.archive_file()
+    assert other.get("0" * 32) is None
+    assert other.get("../contacts") is None
+
+    other.cancel(job.id)
+    assert not Path(job.archive_file()).exists()
+    assert other.get(job.id) is None
+
+
+def test_saved_jobs_expire(contacts):
+    job = ArchiveManager(ttl=0).submit()
+    wait_for(job, "Complete")
+
+    assert ArchiveManager().get(job.id) is None
+    assert not Path(job.archive_file()).exists()
+    assert not Path(job.job_file()).exists()
+
+
+def test_jobs_queue_for_a_free_worker(contacts, monkeypatch):
+    release = threading.Event()
+
+    def blocked(*args):
+        release.wait(5)
+        return 0
+
+    monkeypatch.setattr(archiver, "write_archive", blocked)
+    manager = ArchiveManager(workers=1)
+    first, second = manager.submit(), manager.submit()
+    wait_for(first, "Running")
+    assert second.status() == "Queued"
+
+    release.set()
+    wait_for(second, "Complete")
+    assert first.status() == "Complete"
+
+
+def test_cancelled_job_stops(contacts, monkeypatch):
+    monkeypatch.setattr(archiver, "CHUNK_ROWS", 1)
+    started = threading.Event()
+    report = Archiver.report
+
+    def slow_report(self, fraction):
+        started.set()
+        time.sleep(0.05)
+        report(self, fraction)
+
+    monkeypatch.setattr(Archiver, "report", slow_report)
+    manager = ArchiveManager(workers=1)
+    job = manager.submit()
+    started.wait(5)
+    manager.cancel(job.id)
+    manager.pool.shutdown(wait=True)
+
+    assert job.progress() < 1
+    assert not Path(job.archive_file()).exists()
+    assert list(Path(htmx_contact.DATA_DIR).glob("*.tmp")) == []
+
+
+def test_finished_jobs_expire(contacts):
+    manager = ArchiveManager(ttl=0)
+    job = manager.submit()
+    wait_for(job, "Complete")
+    time.sleep(0.01)
+
+    assert manager.get(job.id) is None
+    assert not Path(job.archive_file()).exists()
+
+
+def test_failed_job(contacts, monkeypatch):
+    def broken(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(archiver, "write_archive", broken)
+    job = ArchiveManager().submit()
+    wait_for(job, "Failed")
+
+
+def test_unknown_format(contacts):
+    with pytest.raises(ValueError):
+        ArchiveManager().submit("xml")
+
+
+def test_archiver_without_job(contacts):
+    assert Archiver.get().status() == "Waiting"
+    assert Archiver.get("unknown").status() == "Waiting"
+
+
+def test_sse():
+    assert sse("done") == "event: done\ndata: \n\n"
+    assert sse("progress", "<div>\n50%\n</div>") == (
+        "event: progress\ndata: <div>\ndata: 50%\ndata: </div>\n\n"
+    )
+
+
+def test_progress_changes_only_with_the_shown_percent(contacts):
+    job = Archiver("job")
+    version = job.version
+    job.report(0.101)
+    job.report(0.109)
+    assert job.version == version + 1
+    job.report(0.11)
+    assert job.version == version + 2
+
+
+def test_events_push_changes(contacts):
+    job = Archiver("job")
+    stream = job.events(lambda: f"{job.status()} {job.progress():.0%}", keepalive=0.01)
+
+    assert next(stream) == sse("progress", "Queued 0%")
+    assert next(stream) == ": keepalive\n\n"
+    job.set_status("Running")
+    assert next(stream) == sse("progress", "Running 0%")
+    threading.Timer(0.05, job.report, [0.5]).start()
+    event = next(stream)
+    while event == ": keepalive\n\n":
+        event = next(stream)
+    assert event == sse("progress", "Running 50%")
+    job.set_status("Complete")
+    assert list(stream) == [sse("done")]
+
+
+def test_async_events_push_changes(contacts):
+    job = Archiver("job")
+
+    async def collect():
+        events = []
+        async for event in job.aevents(lambda: f"{job.progress():.0%}", keepalive=5):
+            events.append(event)
+            if len(events) == 1:
+                # reported by the worker thread while the stream waits
+                threading.Timer(0.05, job.report, [0.5]).start()
+            elif len(events) == 2:
+                threading.Timer(0.05, job.reset).start()
+        return events
+
+    events = asyncio.run(asyncio.wait_for(collect(), 5))
+    assert events == [sse("progress", "0%"), sse("progress", "50%"), sse("done")]
+    assert job.waiters == []
+
+
+def test_unchanged_store_reuses_the_archive(contacts, monkeypatch):
+    exports = []
+    write = archiver.write_archive
+
+    def counted(*args):
+        exports.append(args[4])
+        return write(*args)
+
+    monkeypatch.setattr(archiver, "write_archive", counted)
+    manager = ArchiveManager()
+    first = manager.submit()
+    wait_for(first, "Complete")
+
+    second = manager.submit()
+    assert second.status() == "Complete"
+    assert (second.digest, second.size) == (first.digest, first.size)
+    assert second.etag() == f'W/"{first.digest}"'
+    manager.cancel(first.id)
+    data = json.loads(gzip.decompress(Path(second.archive_file()).read_bytes()))
+    assert [c["id"] for c in data["contacts"]] == [1, 2, 4]
+    wait_for(manager.submit("csv"), "Complete")
+    assert exports == ["json", "csv"]
+
+    Contact.db[1] = Contact(1, "Alicia", "Smith", "123-456", "alice@example.com")
+    third = manager.submit()
+    wait_for(third, "Complete")
+    assert exports == ["json", "csv", "json"]
+    assert third.digest != first.digest
+    assert not Path(first.cache_file()).exists()
+
+
+def test_jobs_for_the_changes_since_an_archive(contacts):
+    manager = ArchiveManager(history=1)
+    full = manager.submit("ndjson")
+    wait_for(full, "Complete")
+    del Contact.db[2]
+
+    changes = manager.submit("json", since=full.etag())
+    wait_for(changes, "Complete")
+    assert changes.download_name() == "contacts-changes.json"
+    data = json.loads(gzip.decompress(Path(changes.archive_file()).read_bytes()))
+    assert (data["contacts"], data["deleted"]) == ([], [2])
+    # only the manifest of the latest archive is kept
+    with pytest.raises(ValueError):
+        manager.submit("json", since=full.digest)
+    with pytest.raises(ValueError):
+        manager.submit("csv", since=changes.digest)
+
+
+def test_other_processes_export_changes_since_an_archive(contacts, tmp_path):
+    full = ArchiveManager().submit()
+    wait_for(full, "Complete")
+    assert (tmp_path / f"archive-{full.digest}.manifest").exists()
+    del Contact.db[2]
+
+    # as in another worker process, which only shares the data directory
+    changes = ArchiveManager().submit("ndjson", since=full.digest)
+    wait_for(changes, "Complete")
+    text = gzip.decompress(Path(changes.archive_file()).read_bytes())
+    assert text == b'{"id":2,"deleted":true}\n'
@@ -0,0 +1,108 @@
+from src.htmx_experiments.cache import ResultCache
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.table import ContactTable
+
+
+def test_lru_eviction_and_counters():
+    cache = ResultCache(maxsize=2)
+    assert cache.get("a", 1) is None
+    cache.put("a", 1, [1])
+    cache.put("b", 1, [2])
+    assert cache.get("a", 1) == [1]
+    # "b" is the least recently used now
+    cache.put("c", 1, [3])
+    assert cache.get("b", 1) is None
+    assert cache.get("c", 1) == [3]
+
+    assert cache.stats() == {
+        "size": 2,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 1,
+        "narrowed": 0,
+    }
+
+
+def test_new_version_drops_everything():
+    cache = ResultCache()
+    cache.get("a", 1)
+    cache.put("a", 1, [1])
+    assert cache.get("a", 2) is None
+    # computed before the change, too late to be cached
+    cache.put("a", 1, [1])
+    assert cache.get("a", 2) is None
+
+
+def test_contact_search_is_cached_until_the_next_change(monkeypatch):
+    monkeypatch.setattr(Contact, "cache", ResultCache())
+    monkeypatch.setattr(
+        Contact,
+        "db",
+        ContactTable(
+            {
+                1: Contact(1, "Joe", "Smith", None, "joe@example.com"),
+                2: Contact(2, "John", "Doe", None, "john@example.com"),
+            }
+        ),
+    )
+    searches = []
+    search = Contact.db.iter_search
+    monkeypatch.setattr(
+        Contact.db,
+        "iter_search",
+        lambda text, after_id: searches.append(text) or search(text, after_id),
+    )
+
+    assert [c.id for c in Contact.search("jo")] == [1, 2]
+    assert [c.id for c in Contact.search("jo")] == [1, 2]
+    # narrowed down from the cached results for "jo"
+    assert [c.id for c in Contact.search("joe")] == [1]
+    assert searches == ["jo"]
+    assert Contact.cache.narrowed == 1
+
+    Contact.db[3] = Contact(3, "Joey", None, None, "joey@example.com")
+    assert [c.id for c in Contact.search("joe")] == [1, 3]
+    assert searches == ["jo", "joe"]
+    assert Contact.cache.stats()["hits"] == 1
+
+
+def test_contact_pages_are_cached(monkeypatch):
+    monkeypatch.setattr(Contact, "cache", ResultCache())
+    monkeypatch.setattr(
+        Contact,
+        "db",
+        ContactTable({i: Contact(i, email=f"{i}@x.com") for i in range(1, 4)}),
+    )
+    assert [c.id for c in Contact.all(page=1, limit=2)] == [1, 2]
+    assert [c.id for c in Contact.all(page=1, limit=2)] == [1, 2]
+    assert [c.id for c in Contact.all(after_id=1, limit=2)] == [2, 3]
+    assert Contact.cache.hits == 1
+
+    del Contact.db[1]
+    assert [c.id for c in Contact.all(page=1, limit=2)] == [2, 3]
+
+
+def test_full_search_pages_are_not_narrowed(monkeypatch):
+    monkeypatch.setattr(Contact, "cache", ResultCache())
+    monkeypatch.setattr(
+        Contact,
+        "db",
+        ContactTable({i: Contact(i, "joe" if i > 2 else "jo") for i in range(1, 6)}),
+    )
+    assert [c.id for c in Contact.search("jo", limit=2)] == [1, 2]
+    # the page for "jo" may miss later matches of "joe"
+    assert [c.id for c in Contact.search("joe", limit=2)] == [3, 4]
+    assert Contact.cache.narrowed == 0
+    assert [c.id for c in Contact.search("joe", after_id=4, limit=2)] == [5]
+
+
+def test_search_is_not_narrowed_from_a_differently_folded_prefix(monkeypatch):
+    monkeypatch.setattr(Contact, "cache", ResultCache())
+    monkeypatch.setattr(
+        Contact,
+        "db",
+        ContactTable({1: Contact(1, "(a)"), 2: Contact(2, phone="(555) 0100")}),
+    )
+    assert [c.id for c in Contact.search("(")] == [1]
+    assert [c.id for c in Contact.search("(5")] == [2]
+    assert Contact.cache.narrowed == 0
@@ -1,9 +1,14 @@
 import json
+import multiprocessing
+import os
+import threading
 from pathlib import Path
 
 import pytest
 
-from src.htmx_experiments.contact import Contact
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.contact import BatchError, Contact
+from src.htmx_experiments.table import CompactTable, ContactTable
 
 
 @pytest.fixture
@@ -85,6 +90,54 @@ def test_save_new_contact(handle_contact_json, sample_contact: Contact):
     assert len(Contact.db) == 1
 
 
+def test_validate_unique_email_after_delete(handle_contact_json, clean_db):
+    jane = Contact(
+        first="Jane", last="Smith", phone="0987654321", email="john@example.com"
+    )
+    assert jane.save()
+    jane.delete()
+
+    john = Contact(
+        first="John", last="Doe", phone="1234567890", email="john@example.com"
+    )
+    assert john.validate()
+
+
+def test_validate_unique_email_after_update(handle_contact_json, clean_db):
+    jane = Contact(
+        first="Jane", last="Smith", phone="0987654321", email="jane@example.com"
+    )
+    assert jane.save()
+    jane.update("Jane", "Smith", "0987654321", "john@example.com")
+
+    john = Contact(
+        first="John", last="Doe", phone="1234567890", email="john@example.com"
+    )
+    assert not john.validate()
+    assert Contact(email="jane@example.com").validate()
+
+
+def test_ids_not_reused_after_reload(handle_contact_json, clean_db):
+    first = Contact(first="A", email="a@example.com")
+    second = Contact(first="B", email="b@example.com")
+    assert first.save() and second.save()
+    second.delete()
+
+    Contact.load_db()
+    third = Contact(first="C", email="c@example.com")
+    assert third.save()
+    assert third.id > second.id
+
+
+def test_load_db_reads_plain_list(handle_contact_json, clean_db):
+    rows = [{"id": 3, "first": "A", "last": "", "phone": "", "email": "a@x.com"}]
+    Path("contacts.json").write_text(json.dumps(rows))
+
+    Contact.load_db()
+    assert Contact.find(3).first == "A"
+    assert Contact.db.next_id > 3
+
+
 def test_save_duplicate_email(handle_contact_json, sample_contact: Contact):
     Contact.db[1] = Contact(
         id_=1, first="Jane", last="Smith", phone="0987654321", email="john@example.com"
@@ -105,22 +158,24 @@ def test_delete(handle_contact_json, sample_contact: Contact):
 
 
 def test_count():
-    Contact.db = {
-        i: Contact(
-            id_=i,
-            first=f"Name{i}",
-            last="Test",
-            phone="1234567890",
-            email=f"name{i}@example.com",
-        )
-        for i in range(1, 11)
-    }
+    Contact.db = ContactTable(
+        {
+            i: Contact(
+                id_=i,
+                first=f"Name{i}",
+                last="Test",
+                phone="1234567890",
+                email=f"name{i}@example.com",
+            )
+            for i in range(1, 11)
+        }
+    )
     assert Contact.count() == 10
 
 
 def test_all_paginated():
     # Create 150 contacts
-    Contact.db = {i: Contact(id_=i) for i in range(1, 151)}
+    Contact.db = ContactTable({i: Contact(id_=i) for i in range(1, 151)})
 
     first_page = Contact.all()
     assert len(first_page) == 100
@@ -129,6 +184,34 @@ def test_all_paginated():
     assert len(second_page) == 50
 
 
+def test_all_after_id():
+    Contact.db = ContactTable({i: Contact(id_=i) for i in range(1, 151)})
+
+    page = Contact.all(after_id=0, limit=10)
+    assert [c.id for c in page] == list(range(1, 11))
+
+    page = Contact.all(after_id=page[-1].id)
+    assert [c.id for c in page] == list(range(11, 111))
+    assert Contact.all(after_id="150") == []
+
+
+def test_all_sorted():
+    Contact.db = ContactTable(
+        {i: Contact(id_=i, last=f"Name{i % 7}") for i in range(1, 151)}
+    )
+
+    page = Contact.all(sort="last", limit=30)
+    assert [c.last for c in page] == ["Name0"] * 21 + ["Name1"] * 9
+    assert [c.id for c in page[:3]] == [7, 14, 21]
+    page = Contact.all(page=5, sort="-last", limit=30)
+    # ties are in descending id order as well
+    assert [c.id for c in page[-3:]] == [21, 14, 7]
+    with pytest.raises(ValueError):
+        Contact.all(sort="phone")
+    with pytest.raises(ValueError):
+        Contact.all(after_id=0, sort="last")
+
+
 def test_search():
     contact = Contact(
         id_=1,
@@ -158,15 +241,169 @@ def test_find(sample_contact: Contact):
     assert not_found is None
 
 
-@pytest.mark.xfail(reason="Bug - Path to contacts.json hardcoded in Contact.")
-def test_load_save_db(handle_contact_json):
+def test_compact_backend(handle_contact_json, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "BACKEND", "compact")
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    Path("contacts.json").write_text(
+        json.dumps(
+            [{"id": 1, "first": "A", "last": "B", "phone": "1", "email": "a@x.com"}]
+        )
+    )
+    Contact.load_db()
+    assert isinstance(Contact.db, CompactTable)
+
+    c = Contact.find(1)
+    c.email = "taken@x.com"
+    assert json.loads(str(c))["email"] == "taken@x.com"
+    assert Contact.find(1).email == "a@x.com"
+
+    c.update("A", "C", "1", "a@x.com")
+    assert c.save()
+    assert Contact.find(1).__dict__ == {
+        "id": 1,
+        "first": "A",
+        "last": "C",
+        "phone": "1",
+        "email": "a@x.com",
+        "errors": {},
+    }
+
+
+@pytest.fixture
+def saved_contacts(handle_contact_json, clean_db, monkeypatch):
+    "Three stored contacts, with `Contact.save_db` counting its calls instead of writing."
+    for i in range(1, 4):
+        Contact.db[i] = Contact(id_=i, first=f"N{i}", email=f"n{i}@example.com")
+    writes = []
+    monkeypatch.setattr(Contact, "save_db", lambda: writes.append(1))
+    return writes
+
+
+def test_batch_persists_once(saved_contacts):
+    with Contact.batch() as batch:
+        batch.save(Contact(first="New", email="new@example.com"))
+        batch.save(Contact(2, "Two", None, None, "n2@example.com"))
+        batch.delete(Contact.find(1))
+        batch.delete(Contact.find(3))
+
+    assert saved_contacts == [1]
+    assert sorted(Contact.db) == [2, batch.saves[0].id]
+    assert Contact.find(2).first == "Two"
+
+
+def test_batch_is_all_or_nothing(saved_contacts):
+    batch = Contact.batch()
+    batch.save(Contact(1, "Changed", None, None, "n1@example.com"))
+    batch.save(Contact(first="Dup", email="n2@example.com"))
+    batch.delete(Contact.find(3))
+
+    assert not batch.commit()
+    assert batch.saves[0].errors == {}
+    assert batch.saves[1].errors == {"email": "Email Must Be Unique"}
+    assert saved_contacts == []
+    assert Contact.find(1).first == "N1"
+    assert 3 in Contact.db
+
+
+def test_batch_validates_contacts_together(saved_contacts):
+    # emails are swapped within the batch, but used twice by new contacts
+    batch = Contact.batch()
+    batch.save(Contact(1, "N1", None, None, "n2@example.com"))
+    batch.save(Contact(2, "N2", None, None, "n1@example.com"))
+    assert batch.commit()
+    assert Contact.find(1).email == "n2@example.com"
+
+    batch = Contact.batch()
+    batch.save(Contact(first="A", email="same@example.com"))
+    batch.save(Contact(first="B", email="same@example.com"))
+    batch.delete(Contact(99))
+    assert not batch.commit()
+    assert batch.deletes[0].errors == {"id": "Contact Not Found"}
+
+
+def test_batch_context_raises_when_invalid(saved_contacts):
+    with pytest.raises(BatchError):
+        with Contact.batch() as batch:
+            batch.save(Contact(first="No email"))
+    assert len(Contact.db) == 3
+
+    with pytest.raises(BatchError):
+        with Contact.batch() as batch:
+            batch.save(Contact(1, email="n1@example.com"))
+            batch.delete(Contact.find(1))
+    assert batch.deletes[0].errors == {"id": "Contact Changed More Than Once"}
+    assert 1 in Contact.db
+
+
+def test_init_loads_from_data_dir_on_first_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    monkeypatch.setattr(Contact, "loader", None)
+    rows = [{"id": 3, "first": "A", "last": None, "phone": None, "email": "a@x.com"}]
+    (tmp_path / "contacts.json").write_text(json.dumps(rows))
+
+    Contact.init(warm_up=False)
+    assert not Contact.ready()
+    assert len(Contact.db) == 0
+
+    assert [c.id for c in Contact.all()] == [3]
+    assert Contact.ready()
+    c = Contact(first="B", email="b@x.com")
+    assert c.save()
+    saved = json.loads((tmp_path / "contacts.json").read_text())
+    assert [r["id"] for r in saved["contacts"]] == [3, 4]
+
+
+def list_first_contact():
+    assert [c.id for c in Contact.all()] == [3]
+
+
+@pytest.mark.filterwarnings("ignore:This process .* is multi-threaded")
+def test_fork_while_loading_starts_over(tmp_path, monkeypatch):
+    rows = [{"id": 3, "first": "A", "last": None, "phone": None, "email": "a@x.com"}]
+    (tmp_path / "contacts.json").write_text(json.dumps(rows))
+    monkeypatch.setattr(htmx_contact, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    monkeypatch.setattr(Contact, "loader", None)
+    monkeypatch.setattr(Contact, "lock", threading.RLock())
+    parent = os.getpid()
+    loading, release = threading.Event(), threading.Event()
+    load_db = Contact.load_db
+
+    def load():
+        if os.getpid() == parent:
+            # stuck holding the lock when the child is forked
+            with Contact.lock:
+                loading.set()
+                release.wait(5)
+        load_db()
+
+    monkeypatch.setattr(Contact, "load_db", load)
+    Contact.init()
+    assert loading.wait(5)
+
+    child = multiprocessing.get_context("fork").Process(target=list_first_contact)
+    child.start()
+    child.join(10)
+    release.set()
+    if child.is_alive():
+        child.kill()
+    assert child.exitcode == 0
+    Contact.wait_loaded()
+
+
+def test_load_save_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(Contact, "db", ContactTable())
     # Create a test contact
     contact = Contact(
         id_=1, first="Test", last="User", phone="1234567890", email="test@example.com"
     )
     contact.save()
+    assert (tmp_path / "contacts.json").exists()
 
     # Save and load the database
+    contact.db.clear()
     contact.load_db()
 
     assert len(contact.db) == 1
@@ -0,0 +1,42 @@
+import fcntl
+import os
+
+import pytest
+
+from src.htmx_experiments.filelock import FileLock
+
+
+def try_lock(path) -> bool:
+    "Tries to lock `path` the way another process would."
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def test_hold_excludes_others_and_is_reentrant(tmp_path):
+    path = tmp_path / "contacts.lock"
+    lock = FileLock(path)
+
+    with lock.hold():
+        assert not try_lock(path)
+        with lock.hold():
+            pass
+        # still held by the outer block
+        assert not try_lock(path)
+    assert try_lock(path)
+    lock.close()
+
+
+def test_released_on_error(tmp_path):
+    path = tmp_path / "contacts.lock"
+    lock = FileLock(path)
+    with pytest.raises(RuntimeError):
+        with lock.hold():
+            raise RuntimeError
+    assert try_lock(path)
+    lock.close()
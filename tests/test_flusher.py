@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.flusher import Flusher
+from src.htmx_experiments.journal import Journal
+
+
+class Writes:
+    "Records the change lists passed to `write`, optionally taking a while."
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, changes):
+        time.sleep(self.delay)
+        self.calls.append(list(changes))
+
+
+def test_group_commit_coalesces_concurrent_changes():
+    writes = Writes(delay=0.01)
+    flusher = Flusher(writes, "group", interval=0.02)
+    done = []
+
+    def submit(i):
+        flusher.submit([i])
+        # the change has been written once `submit` returns
+        done.append(any(i in call for call in writes.calls))
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    flusher.stop()
+
+    assert done == [True] * 20
+    assert sorted(i for call in writes.calls for i in call) == list(range(20))
+    assert len(writes.calls) < 20
+
+
+def test_async_returns_before_writing():
+    writes = Writes()
+    flusher = Flusher(writes, "async", interval=10)
+
+    flusher.submit(["a"])
+    flusher.submit(["b"])
+    assert writes.calls == []
+
+    flusher.flush()
+    assert writes.calls == [["a", "b"]]
+    flusher.stop()
+
+
+def test_max_pending_flushes_early():
+    writes = Writes()
+    flusher = Flusher(writes, "async", interval=10, max_pending=3)
+
+    flusher.submit([1, 2, 3])
+    deadline = time.monotonic() + 5
+    while not writes.calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert writes.calls == [[1, 2, 3]]
+    flusher.stop()
+
+
+def test_stop_writes_pending_changes():
+    writes = Writes()
+    flusher = Flusher(writes, "async", interval=10)
+    flusher.submit(["a"])
+
+    flusher.stop()
+    assert writes.calls == [["a"]]
+    with pytest.raises(RuntimeError):
+        flusher.submit(["b"])
+
+
+def test_group_commit_raises_write_errors():
+    def fail(changes):
+        raise OSError("disk full")
+
+    flusher = Flusher(fail, "group", interval=0)
+    with pytest.raises(OSError):
+        flusher.submit(["a"])
+    flusher.stop()
+
+
+def test_async_keeps_failed_changes_for_the_next_attempt(caplog):
+    attempts = []
+
+    def write(changes):
+        attempts.append(list(changes))
+        if len(attempts) < 3:
+            raise OSError("disk full")
+
+    flusher = Flusher(write, "async", interval=10, retry=0.01)
+    flusher.submit(["a"])
+    flusher.submit(["b"])
+    with pytest.raises(OSError):
+        flusher.flush()
+    for _ in range(200):
+        if len(attempts) == 3:
+            break
+        time.sleep(0.01)
+    flusher.stop()
+
+    assert attempts == [["a", "b"]] * 3
+    assert flusher.error is None
+    failures = [r for r in caplog.records if r.name == "src.htmx_experiments.flusher"]
+    assert [r.exc_info[0] for r in failures] == [OSError, OSError]
+
+
+def test_async_gives_up_failed_changes_at_exit(caplog):
+    attempts = []
+
+    def fail(changes):
+        attempts.append(list(changes))
+        raise OSError("disk full")
+
+    flusher = Flusher(fail, "async", interval=10, retry=10)
+    flusher.submit(["a"])
+    flusher.stop()
+
+    assert attempts == [["a"]]
+    assert "Writing 1 contact changes failed" in caplog.text
+
+
+def test_sync_is_not_a_flusher_mode():
+    with pytest.raises(ValueError):
+        Flusher(Writes(), "sync")
+
+
+def test_contact_group_durability(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(htmx_contact, "DURABILITY", "group")
+    Path("contacts.json").write_text("[]")
+    Contact.db.clear()
+
+    Contact.load_db()
+    try:
+        assert Contact.flusher is not None
+        c = Contact(first="A", email="a@example.com")
+        assert c.save()
+        # written before `save` returned
+        data = json.loads(Path("contacts.json").read_text())
+        assert [r["id"] for r in data["contacts"]] == [c.id]
+    finally:
+        Contact.flusher.stop()
+        Contact.flusher = None
+
+
+def test_contact_changes_are_logged_as_committed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(htmx_contact, "DURABILITY", "async")
+    monkeypatch.setattr(Contact, "journal", Journal())
+    Path("contacts.json").write_text("[]")
+    Contact.db.clear()
+
+    Contact.load_db()
+    Contact.flusher.interval = 10
+    try:
+        c = Contact(first="A", email="a@example.com")
+        assert c.save()
+        c.first = "Unsaved"
+        c.delete()
+        Contact.flusher.flush()
+        # one flush, one record
+        (line,) = Path("contacts.log").read_text().splitlines()
+        assert json.loads(line)["ops"] == [
+            {"op": "put", **c.row(), "first": "A"},
+            {"op": "delete", "id": c.id},
+        ]
+
+        Contact.load_db()
+        assert len(Contact.db) == 0
+    finally:
+        Contact.flusher.stop()
+        Contact.flusher = None
+        Contact.journal.close()
@@ -0,0 +1,94 @@
+import random
+import threading
+
+import src.htmx_experiments.table as htmx_table
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.fuzzy import max_edits, rank, similar
+from src.htmx_experiments.table import ContactTable, WordIndex
+
+
+def edits(word: str, other: str) -> int:
+    "Fewest edits between `word` and any prefix of `other`, computed naively."
+    d = [list(range(len(other) + 1))]
+    for i in range(1, len(word) + 1):
+        d.append([i] + [0] * len(other))
+        for j in range(1, len(other) + 1):
+            d[i][j] = min(
+                d[i - 1][j] + 1,
+                d[i][j - 1] + 1,
+                d[i - 1][j - 1] + (word[i - 1] != other[j - 1]),
+            )
+            if (
+                i > 1
+                and j > 1
+                and word[i - 1] == other[j - 2]
+                and word[i - 2] == other[j - 1]
+            ):
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return min(d[len(word)])
+
+
+def test_similar_equals_naive_scan():
+    rng = random.Random(0)
+    word = lambda k: "".join(rng.choices("abcde", k=rng.randint(1, k)))
+    vocabulary = WordIndex()
+    for i in range(1000):
+        vocabulary.add_key(i, word(9))
+
+    for _ in range(100):
+        query = word(10)
+        expected = {}
+        for other in vocabulary.postings:
+            n = edits(query, other)
+            if n <= max_edits(query):
+                expected[other] = n
+        assert similar(query, vocabulary) == expected, query
+
+
+def test_rank_prefers_fewer_edits_then_closer_lengths():
+    table = ContactTable()
+    table[1] = Contact(1, "Johnny", "Smith")
+    table[2] = Contact(2, "John", "Smyth")
+    table[3] = Contact(3, "John", "Smith")
+    table[4] = Contact(4, "Jane", "Smith")
+
+    assert rank(table.words, "jhon smith", 10) == [3, 1, 2]
+    assert rank(table.words, "jhon smith", 1) == [3]
+    # "smyth" is two edits away
+    assert rank(table.words, "smiht", 10) == [1, 3, 4]
+    assert rank(table.words, "nobody", 10) == []
+
+
+def test_word_index_follows_writes_after_sorting():
+    table = ContactTable({1: Contact(1, "Alice"), 2: Contact(2, "Alicia")})
+    assert [c.id for c in table.fuzzy_search("Alci", 10)] == [1, 2]
+
+    table[3] = Contact(3, "Alize")
+    del table[1]
+    table[2] = Contact(2, "Bob")
+    assert table.words.sorted == sorted(table.words.postings)
+    assert [c.id for c in table.fuzzy_search("Alci", 10)] == [3]
+
+
+def test_fuzzy_search_lets_other_readers_in(monkeypatch):
+    table = ContactTable({1: Contact(1, "Alice"), 2: Contact(2, "Bob")})
+    read = []
+
+    def ranking(words, query, limit):
+        # a page read by another thread while ranking, which a write lock would block
+        reader = threading.Thread(target=lambda: read.append(table.after(0, 1)))
+        reader.start()
+        reader.join(5)
+        return rank(words, query, limit)
+
+    monkeypatch.setattr(htmx_table, "rank", ranking)
+    assert [c.id for c in table.fuzzy_search("Alci", 10)] == [1]
+    assert [[c.id for c in page] for page in read] == [[1]]
+
+
+def test_contact_search_falls_back_to_fuzzy(monkeypatch):
+    monkeypatch.setattr(
+        Contact, "db", ContactTable({1: Contact(1, "Zoë", "Ørsted", None, "z@x.com")})
+    )
+    assert Contact.search("zoe ørstde") == []
+    assert [c.id for c in Contact.search("zoe ørstde", fuzzy=True)] == [1]
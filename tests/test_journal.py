@@ -0,0 +1,233 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+
+import pytest
+
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.journal import Journal
+from src.htmx_experiments.table import ContactTable
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    "Runs the test in a temporary directory with an empty snapshot and journaling enabled."
+    monkeypatch.chdir(tmp_path)
+    Path("contacts.json").write_text("[]")
+    Contact.db.clear()
+    Contact.journal = Journal(compact_every=3)
+    yield Contact.journal
+    Contact.journal.close()
+    Contact.journal = None
+
+
+def logged(journal: Journal) -> list[dict]:
+    "The records in the log of `journal`, as another process would read them."
+    return Journal(journal.path).follow()
+
+
+def test_append_and_records(tmp_path):
+    journal = Journal(tmp_path / "contacts.log")
+    journal.append({"op": "put", "id": 1, "first": "Ä"})
+    journal.append({"op": "delete", "id": 1})
+    journal.close()
+
+    assert logged(journal) == [
+        {"op": "put", "id": 1, "first": "Ä"},
+        {"op": "delete", "id": 1},
+    ]
+    assert journal.size == 2
+
+
+def test_save_appends_instead_of_rewriting(journal: Journal):
+    c = Contact(first="A", email="a@example.com")
+    assert c.save()
+
+    assert json.loads(Path("contacts.json").read_text()) == []
+    assert [r["op"] for r in logged(journal)] == ["put"]
+
+
+def test_load_db_replays_journal(journal: Journal):
+    journal.compact_every = 10
+    a = Contact(first="A", email="a@example.com")
+    b = Contact(first="B", email="b@example.com")
+    assert a.save() and b.save()
+    a.update("A2", None, None, "a@example.com")
+    assert a.save() is True
+    journal.close()
+
+    Contact.db.clear()
+    Contact.load_db()
+
+    assert Contact.find(a.id).first == "A2"
+    assert Contact.find(b.id).first == "B"
+    assert journal.size == 3
+
+
+def test_journal_env_switch_logs_in_data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "JOURNAL", True)
+    monkeypatch.setattr(htmx_contact, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(Contact, "journal", None)
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    (tmp_path / "contacts.json").write_text("[]")
+
+    Contact.load_db()
+    assert Contact.journal.path == tmp_path / "contacts.log"
+    assert Contact(first="A", email="a@example.com").save()
+    Contact.journal.close()
+
+    assert [r["op"] for r in logged(Contact.journal)] == ["put"]
+    assert json.loads((tmp_path / "contacts.json").read_text()) == []
+
+
+def test_append_after_a_torn_line(journal: Journal):
+    journal.compact_every = 10
+    a = Contact(first="A", email="a@example.com")
+    assert a.save()
+    journal.close()
+    # a crash in the middle of the next append
+    with open("contacts.log", "a") as f:
+        f.write('{"op":"put","id":2,"fi')
+
+    Contact.db.clear()
+    Contact.load_db()
+    b = Contact(first="B", email="b@example.com")
+    assert b.save()
+    journal.close()
+
+    Contact.db.clear()
+    Contact.load_db()
+    assert [c.first for c in Contact.db.values()] == ["A", "B"]
+
+
+def test_compaction_folds_journal_into_snapshot(journal: Journal):
+    ids = []
+    for i in range(3):
+        c = Contact(first=f"N{i}", email=f"n{i}@example.com")
+        assert c.save()
+        ids.append(c.id)
+    Contact.find(ids[0]).delete()
+
+    snapshot = json.loads(Path("contacts.json").read_text())
+    assert [r["id"] for r in snapshot["contacts"]] == ids
+    assert [r["op"] for r in logged(journal)] == ["delete"]
+
+    Contact.db.clear()
+    Contact.load_db()
+    assert sorted(Contact.db) == ids[1:]
+
+
+def test_batch_is_one_record(journal: Journal):
+    journal.compact_every = 10
+    a = Contact(first="A", email="a@example.com")
+    assert a.save()
+
+    with Contact.batch() as batch:
+        batch.save(Contact(first="B", email="b@example.com"))
+        batch.delete(Contact.find(a.id))
+
+    records = logged(journal)
+    assert [r["op"] for r in records] == ["put", "batch"]
+    assert [r["op"] for r in records[1]["ops"]] == ["put", "delete"]
+
+    journal.close()
+    Contact.db.clear()
+    Contact.load_db()
+    assert [c.first for c in Contact.db.values()] == ["B"]
+
+
+def test_follow_returns_records_of_other_writers(tmp_path):
+    path = tmp_path / "contacts.log"
+    writer, follower = Journal(path), Journal(path)
+    assert follower.follow() == []
+
+    writer.append({"op": "delete", "id": 1})
+    assert follower.behind()
+    assert follower.follow() == [{"op": "delete", "id": 1}]
+    assert not follower.behind()
+
+    # a follower skips what it appends itself
+    follower.append({"op": "delete", "id": 2})
+    assert follower.follow() == []
+    writer.close()
+    follower.close()
+
+
+def test_follow_waits_for_complete_lines(tmp_path):
+    path = tmp_path / "contacts.log"
+    follower = Journal(path)
+    with open(path, "a") as f:
+        f.write('{"op":"delete",')
+        f.flush()
+        assert follower.follow() == []
+        f.write('"id":1}\n')
+    assert follower.follow() == [{"op": "delete", "id": 1}]
+    follower.close()
+
+
+def test_follow_reads_the_rest_of_a_compacted_log(tmp_path):
+    path = tmp_path / "contacts.log"
+    writer, follower = Journal(path), Journal(path)
+    writer.append({"op": "delete", "id": 1})
+    assert follower.follow() == [{"op": "delete", "id": 1}]
+
+    writer.append({"op": "delete", "id": 2})
+    writer.truncate()
+    writer.append({"op": "delete", "id": 3})
+    assert follower.follow() == [
+        {"op": "delete", "id": 2},
+        {"op": "delete", "id": 3},
+    ]
+    assert follower.size == 1
+    writer.close()
+    follower.close()
+
+
+def save_in_other_process(directory, first):
+    os.chdir(directory)
+    htmx_contact.WATCH = True
+    Contact.load_db()
+    c = Contact(first=first, email=f"{first}@example.com")
+    assert c.save()
+
+
+@pytest.fixture
+def watch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(htmx_contact, "WATCH", True)
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    monkeypatch.setattr(Contact, "journal", None)
+    monkeypatch.setattr(Contact, "file_lock", None)
+    Path("contacts.json").write_text("[]")
+    yield
+    if Contact.journal is not None:
+        Contact.journal.close()
+    if Contact.file_lock is not None:
+        Contact.file_lock.close()
+
+
+def test_watch_applies_changes_of_other_processes(watch, tmp_path):
+    Contact.load_db()
+    a = Contact(first="A", email="a@example.com")
+    assert a.save()
+
+    ctx = multiprocessing.get_context("spawn")
+    p = ctx.Process(target=save_in_other_process, args=(tmp_path, "B"))
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+
+    # the other process saw `a`, so `b` got the next id
+    (b,) = Contact.search("B@")
+    assert b.id == a.id + 1
+    assert Contact.count() == 2
+    # and the email index knows it
+    assert not Contact(first="B2", email="B@example.com").save()
+
+
+def test_watch_needs_sync_durability(watch, monkeypatch):
+    monkeypatch.setattr(htmx_contact, "DURABILITY", "group")
+    with pytest.raises(ValueError):
+        Contact.load_db()
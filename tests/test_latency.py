@@ -0,0 +1,37 @@
+import pytest
+
+from src.htmx_experiments import latency
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.table import ContactTable
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    "Records the requested delays instead of sleeping."
+    calls = []
+    monkeypatch.setattr(latency.time, "sleep", calls.append)
+    monkeypatch.setattr(latency, "DELAYS", {})
+    return calls
+
+
+def test_parse():
+    assert latency.parse("") == {}
+    assert latency.parse("count=2, search=0.1,") == {"count": 2.0, "search": 0.1}
+
+
+def test_no_delay_by_default(sleeps):
+    Contact.db = ContactTable({1: Contact(id_=1)})
+
+    assert Contact.count() == 1
+    Contact.search("x")
+    assert sleeps == []
+
+
+def test_delay_per_operation(sleeps):
+    latency.DELAYS.update(count=2, search=0.5)
+    Contact.db = ContactTable({1: Contact(id_=1)})
+
+    Contact.count()
+    Contact.search("x")
+    Contact.count()
+    assert sleeps == [2, 0.5, 2]
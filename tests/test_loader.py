@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from src.htmx_experiments.loader import Loader
+
+
+def test_loads_once_on_first_wait():
+    calls = []
+    loader = Loader(lambda: calls.append(1))
+    assert not loader.ready
+
+    loader.wait()
+    loader.wait()
+    assert loader.ready
+    assert calls == [1]
+
+
+def test_wait_blocks_until_background_load_is_done():
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load():
+        started.set()
+        release.wait(5)
+        calls.append(1)
+
+    loader = Loader(load)
+    loader.start()
+    started.wait(5)
+    assert not loader.ready
+
+    threading.Timer(0.05, release.set).start()
+    loader.wait()
+    assert loader.ready
+    assert calls == [1]
+
+
+def test_failed_load_is_retried():
+    attempts = []
+
+    def load():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise FileNotFoundError("contacts.json")
+
+    loader = Loader(load)
+    with pytest.raises(FileNotFoundError):
+        loader.wait()
+    assert not loader.ready
+    assert isinstance(loader.error, FileNotFoundError)
+
+    loader.wait()
+    assert loader.ready
+    assert loader.error is None
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from src.htmx_experiments.rwlock import RWLock
+
+
+def test_readers_share_the_lock():
+    lock = RWLock()
+    inside = threading.Barrier(3, timeout=5)
+
+    def read():
+        with lock.read():
+            # only passes if all three readers hold the lock at the same time
+            inside.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not inside.broken
+
+
+def test_writer_waits_for_readers_and_blocks_new_ones():
+    lock = RWLock()
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def first_reader():
+        with lock.read():
+            reading.set()
+            release.wait(5)
+            events.append("first read done")
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    def second_reader():
+        with lock.read():
+            events.append("second read")
+
+    threads = [threading.Thread(target=first_reader)]
+    threads[0].start()
+    reading.wait(5)
+    threads.append(threading.Thread(target=writer))
+    threads[1].start()
+    while not lock.waiting_writers:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=second_reader))
+    threads[2].start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert events == ["first read done", "write", "second read"]
@@ -0,0 +1,115 @@
+import json
+import multiprocessing
+from pathlib import Path
+
+import pytest
+
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.shared_store import SharedStore
+from src.htmx_experiments.table import ContactTable
+
+from .test_stores import ROWS
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SharedStore(Contact, tmp_path / "contacts.mmap")
+    with store.transaction():
+        for row in ROWS:
+            store[row[0]] = Contact(*row)
+    yield store
+    store.close()
+
+
+def test_other_instance_sees_published_versions(store: SharedStore, tmp_path):
+    other = SharedStore(Contact, tmp_path / "contacts.mmap")
+    before = other.search("Alice")
+
+    store[6] = Contact(6, "Carol", None, None, "carol@example.com")
+    assert [c.id for c in other.search("Carol")] == [6]
+    assert other.allocate_id() == 7
+    assert store.allocate_id() == 8
+    # rows already read stay as they were
+    assert [c.first for c in before] == ["Alice", "alice"]
+    other.close()
+
+
+def test_transaction_publishes_once_or_not_at_all(store: SharedStore):
+    version = store.current().version
+    with pytest.raises(KeyError):
+        with store.transaction():
+            store[6] = Contact(6, email="zz@example.com")
+            del store[1]
+            del store[99]
+    assert list(store) == [1, 2, 3, 4, 5]
+    assert store.current().version == version
+
+    with store.transaction():
+        store[6] = Contact(6, email="zz@example.com")
+        store[3] = Contact(3, "Al", None, None, "al@example.org")
+        del store[1]
+        del store[6]
+    assert list(store) == [2, 3, 4, 5]
+    assert store[3].first == "Al"
+    assert store[4].email == "empty@example.com"
+    assert store.current().version == version + 1
+
+
+def add_contacts(path, first_id):
+    store = SharedStore(Contact, path)
+    for id_ in range(first_id, first_id + 20):
+        store[id_] = Contact(id_, f"P{first_id}", None, None, f"{id_}@example.com")
+    store.close()
+
+
+def test_writers_in_several_processes(tmp_path):
+    path = tmp_path / "contacts.mmap"
+    store = SharedStore(Contact, path)
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=add_contacts, args=(path, first_id))
+        for first_id in (1, 101, 201)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    assert [p.exitcode for p in processes] == [0, 0, 0]
+    assert len(store) == 60
+    assert store.next_id == 221
+    assert [c.id for c in store.search("P101")] == list(range(101, 121))
+    store.close()
+
+
+def test_contact_with_shared_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(htmx_contact, "BACKEND", "shared")
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    rows = [dict(zip(["id", "first", "last", "phone", "email"], row)) for row in ROWS]
+    Path("contacts.json").write_text(json.dumps({"next_id": 10, "contacts": rows}))
+
+    Contact.load_db()
+    assert isinstance(Contact.db, SharedStore)
+    assert len(Contact.db) == 5
+
+    c = Contact.find(1)
+    c.update("Alice", "Jones", "123-456", "bob@example.com")
+    assert not c.save()
+    assert Contact.find(1).last == "Smith"
+
+    c = Contact(first="Dan", email="dan@example.com")
+    assert c.save()
+    assert c.id == 10
+    assert [c.id for c in Contact.search("Dan")] == [10]
+
+    # a store without contacts isn't imported into again
+    with Contact.transaction():
+        for id_ in list(Contact.db):
+            del Contact.db[id_]
+    Contact.db.close()
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    Contact.load_db()
+    assert len(Contact.db) == 0
+    Contact.db.close()
@@ -0,0 +1,47 @@
+import json
+
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.shared_store import SharedStore
+from src.htmx_experiments.snapshot import Snapshot, from_json, to_json
+
+CONTACTS = [
+    {"id": 7, "first": "Zoë", "last": None, "phone": "", "email": "zoe@example.com"},
+    {"id": 2, "first": "Bob", "last": "O'Brien", "phone": None, "email": "b@x.com"},
+]
+
+
+def test_json_round_trip(tmp_path):
+    (tmp_path / "contacts.json").write_text(
+        json.dumps({"next_id": 12, "contacts": CONTACTS})
+    )
+
+    from_json(tmp_path / "contacts.json", tmp_path / "contacts.mmap")
+    snapshot = Snapshot(tmp_path / "contacts.mmap")
+    assert snapshot.count == 2
+    assert snapshot.next_id == 12
+    assert list(snapshot.ids) == [2, 7]
+    assert snapshot.row(snapshot.index(7)) == ("Zoë", None, "", "zoe@example.com")
+    assert snapshot.index(3) is None
+
+    to_json(tmp_path / "contacts.mmap", tmp_path / "out.json")
+    data = json.loads((tmp_path / "out.json").read_text())
+    assert data == {"next_id": 12, "contacts": sorted(CONTACTS, key=lambda c: c["id"])}
+
+
+def test_plain_list_gets_next_id_from_ids(tmp_path):
+    (tmp_path / "contacts.json").write_text(json.dumps(CONTACTS))
+
+    from_json(tmp_path / "contacts.json", tmp_path / "contacts.mmap")
+    assert Snapshot(tmp_path / "contacts.mmap").next_id == 8
+
+
+def test_shared_store_serves_converted_snapshot(tmp_path):
+    (tmp_path / "contacts.json").write_text(
+        json.dumps({"next_id": 12, "contacts": CONTACTS})
+    )
+    from_json(tmp_path / "contacts.json", tmp_path / "contacts.mmap")
+
+    store = SharedStore(Contact, tmp_path / "contacts.mmap")
+    assert [c.first for c in store.search("Zo")] == ["Zoë"]
+    assert store.allocate_id() == 12
+    store.close()
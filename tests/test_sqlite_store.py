@@ -0,0 +1,126 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+import src.htmx_experiments.contact as htmx_contact
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.sqlite_store import SqliteStore
+from src.htmx_experiments.table import ContactTable
+
+from .test_stores import ROWS
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteStore(Contact, tmp_path / "contacts.sqlite3")
+    for row in ROWS:
+        store[row[0]] = Contact(*row)
+    yield store
+    store.close()
+
+
+def test_ids_never_reused(store: SqliteStore, tmp_path):
+    assert store.allocate_id() == 6
+    store[6] = Contact(6, email="zz@example.com")
+    del store[6]
+    store.close()
+
+    reopened = SqliteStore(Contact, tmp_path / "contacts.sqlite3")
+    assert reopened.allocate_id() == 7
+    reopened.close()
+
+
+def test_connection_per_thread(store: SqliteStore):
+    seen = []
+
+    def read():
+        seen.append(store.connection())
+        assert store[1].first == "Alice"
+
+    for _ in range(3):
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+    # finished threads hand their connection over to the next one
+    assert seen[0] is seen[1] is seen[2]
+    assert seen[0] is not store.connection()
+
+
+def test_contact_with_sqlite_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(htmx_contact, "BACKEND", "sqlite")
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    rows = [dict(zip(["id", "first", "last", "phone", "email"], row)) for row in ROWS]
+    Path("contacts.json").write_text(json.dumps(rows))
+
+    Contact.load_db()
+    assert isinstance(Contact.db, SqliteStore)
+    assert len(Contact.db) == 5
+
+    c = Contact.find(1)
+    c.update("Alice", "Jones", "123-456", "bob@example.com")
+    assert not c.save()
+    assert Contact.find(1).last == "Smith"
+
+    c = Contact.find(1)
+    c.update("Alice", "Jones", "123-456", "alice@example.net")
+    assert c.save()
+    assert Contact.find(1).last == "Jones"
+    assert [c.id for c in Contact.search("Jones")] == [1]
+
+    # a store without contacts isn't imported into again
+    with Contact.transaction():
+        for id_ in list(Contact.db):
+            del Contact.db[id_]
+    Contact.db.close()
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    Contact.load_db()
+    assert len(Contact.db) == 0
+    Contact.db.close()
+
+
+def test_transaction_rolls_back(store: SqliteStore):
+    with pytest.raises(KeyError):
+        with store.transaction():
+            store[6] = Contact(6, email="zz@example.com")
+            del store[1]
+            del store[99]
+
+    assert sorted(store) == [1, 2, 3, 4, 5]
+    assert len(store) == 5
+    assert store.search("zz@") == []
+
+    with store.transaction():
+        store[6] = Contact(6, email="zz@example.com")
+        del store[1]
+    assert sorted(store) == [2, 3, 4, 5, 6]
+
+
+def test_database_without_search_keys_is_upgraded(tmp_path):
+    conn = sqlite3.connect(tmp_path / "contacts.sqlite3")
+    conn.executescript(
+        "CREATE TABLE contacts (id INTEGER PRIMARY KEY, first TEXT, last TEXT, "
+        "phone TEXT, email TEXT);"
+        "CREATE VIRTUAL TABLE contacts_search USING fts5(first, last, phone, email, "
+        "content='contacts', content_rowid='id', tokenize='trigram case_sensitive 1');"
+        "CREATE TRIGGER contacts_insert AFTER INSERT ON contacts BEGIN SELECT 1; END;"
+        "CREATE TRIGGER contacts_delete AFTER DELETE ON contacts BEGIN SELECT 1; END;"
+        "CREATE TRIGGER contacts_update AFTER UPDATE ON contacts BEGIN SELECT 1; END;"
+        "INSERT INTO contacts VALUES (1, 'Zoë', 'Ørsted', '555-0100', 'z@x.com');"
+    )
+    conn.close()
+
+    store = SqliteStore(Contact, tmp_path / "contacts.sqlite3")
+    assert [c.id for c in store.search("zoe")] == [1]
+    assert [c.id for c in store.search("orsted")] == []
+    assert [c.id for c in store.search("ørsted")] == [1]
+    assert [c.id for c in store.search("5550100")] == [1]
+    assert [c.id for c in store.fuzzy_search("ørsetd", 10)] == [1]
+    store[2] = Contact(2, "adam", None, None, "a@x.com")
+    assert [c.id for c in store.page(0, 10, "first")] == [2, 1]
+    assert [c.id for c in store.page(0, 10, "-email")] == [1, 2]
+    store.close()
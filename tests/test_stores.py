@@ -0,0 +1,108 @@
+import pytest
+
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.shared_store import SharedStore
+from src.htmx_experiments.sqlite_store import SqliteStore
+from src.htmx_experiments.table import CompactTable, ContactTable
+
+ROWS = [
+    (1, "Alice", "Smith", "123-456", "alice@example.com"),
+    (2, "Bob", 'O"Brien', "555-1234", "bob@example.com"),
+    (3, "alice", None, None, "ALICE@example.org"),
+    (4, "", "", "", "empty@example.com"),
+    (5, "Zoë", "Ørsted", None, "zoe@example.com"),
+]
+
+
+def make_store(kind, tmp_path):
+    if kind == "memory":
+        return ContactTable()
+    if kind == "compact":
+        return CompactTable(Contact)
+    if kind == "sqlite":
+        return SqliteStore(Contact, tmp_path / "contacts.sqlite3")
+    return SharedStore(Contact, tmp_path / "contacts.mmap")
+
+
+@pytest.fixture(params=["memory", "compact", "sqlite", "shared"])
+def store(request, tmp_path):
+    store = make_store(request.param, tmp_path)
+    with store.transaction():
+        for row in ROWS:
+            store[row[0]] = Contact(*row)
+    yield store
+    if hasattr(store, "close"):
+        store.close()
+
+
+# the in-memory table every store has to answer like
+@pytest.fixture
+def table():
+    return ContactTable({row[0]: Contact(*row) for row in ROWS})
+
+
+def test_mapping(store):
+    assert len(store) == 5
+    assert list(store) == [1, 2, 3, 4, 5]
+    assert store[2].last == 'O"Brien'
+    assert store[3].last is None
+    assert store[5].last == "Ørsted"
+    assert store.get(99) is None
+
+    store[2] = Contact(2, "Robert", "Brien", None, "bob@example.com")
+    assert store[2].first == "Robert"
+
+    del store[2]
+    assert 2 not in store
+    with pytest.raises(KeyError):
+        del store[2]
+    assert len(store) == 4
+
+    store.clear()
+    assert len(store) == 0
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["Alice", "alice", "lic", "li", "", "example", '"Bri', "55", "ë", "xyz", "@"],
+)
+def test_search_matches_substring_semantics(store, table, text: str):
+    expected = [c.id for c in table.search(text)]
+    assert [c.id for c in store.search(text)] == expected
+    after = expected[0] if expected else 0
+    assert [c.id for c in store.iter_search(text, after)] == expected[1:]
+
+
+def test_search_follows_updates(store):
+    store[1] = Contact(1, "Carol", "Smith", "123-456", "carol@example.com")
+
+    assert [c.id for c in store.search("Alice")] == [3]
+    assert [c.id for c in store.search("Carol")] == [1]
+
+
+@pytest.mark.parametrize("text", ["Alcie", "smtih", "bob examlpe", "ALICE", "xyz"])
+def test_fuzzy_search_matches_table(store, table, text: str):
+    expected = [c.id for c in table.fuzzy_search(text, 3)]
+    assert [c.id for c in store.fuzzy_search(text, 3)] == expected
+
+
+def test_page_and_email_owners(store):
+    assert [c.id for c in store.page(1, 3)] == [2, 3]
+    assert [c.id for c in store.after(2, 10)] == [3, 4, 5]
+    assert store.email_owners("bob@example.com") == {2}
+    assert store.email_owners("nobody@example.com") == set()
+    # a substring of another email isn't the same email
+    assert store.email_owners("e@example.com") == set()
+
+
+@pytest.mark.parametrize("sort", ["first", "-first", "last", "-last", "email"])
+def test_sorted_pages_match_table(store, table, sort: str):
+    for start, stop in [(0, 10), (1, 3), (3, 10)]:
+        expected = [c.id for c in table.page(start, stop, sort)]
+        assert [c.id for c in store.page(start, stop, sort)] == expected, (start, stop)
+
+    store[2] = Contact(2, "Aaron", "Zed", None, "aaron@example.com")
+    table[2] = Contact(2, "Aaron", "Zed", None, "aaron@example.com")
+    assert [c.id for c in store.page(0, 10, sort)] == [
+        c.id for c in table.page(0, 10, sort)
+    ]
@@ -0,0 +1,342 @@
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from src.htmx_experiments.contact import Contact
+from src.htmx_experiments.table import (
+    RECORD,
+    CompactTable,
+    ContactTable,
+    IdMap,
+    matches,
+)
+
+
+def test_email_index_tracks_writes():
+    table = ContactTable()
+    table[1] = Contact(id_=1, email="a@example.com")
+    table[2] = Contact(id_=2, email="b@example.com")
+
+    assert table.emails.owners("a@example.com") == {1}
+
+    table[1] = Contact(id_=1, email="c@example.com")
+    assert table.emails.owners("a@example.com") == set()
+    assert table.emails.owners("c@example.com") == {1}
+
+    del table[2]
+    assert table.emails.owners("b@example.com") == set()
+
+    table.clear()
+    assert table.emails.owners("c@example.com") == set()
+
+
+def test_email_index_keeps_duplicates():
+    table = ContactTable(
+        {
+            1: Contact(id_=1, email="a@example.com"),
+            2: Contact(id_=2, email="a@example.com"),
+        }
+    )
+
+    assert table.emails.owners("a@example.com") == {1, 2}
+    del table[1]
+    assert table.emails.owners("a@example.com") == {2}
+
+
+def test_reindex_ignores_unstored_contacts():
+    table = ContactTable()
+    stored = Contact(id_=1, email="a@example.com")
+    table[1] = stored
+
+    copy = Contact(id_=1, email="b@example.com")
+    table.reindex(copy)
+    assert table.emails.owners("a@example.com") == {1}
+
+    stored.email = "b@example.com"
+    table.reindex(stored)
+    assert table.emails.owners("b@example.com") == {1}
+
+
+@pytest.mark.parametrize("make", [ContactTable, lambda: CompactTable(Contact)])
+def test_failed_write_changes_nothing(make):
+    table = make()
+    table[1] = Contact(1, "Alice", None, None, "a@x.com")
+    assert [c.id for c in table.page(0, 10, "first")] == [1]
+    version = table.version
+
+    for bad in [
+        Contact(2, 5, None, None, "b@x.com"),
+        Contact(2, None, None, None, ["b@x.com"]),
+        Contact(1, "Al", None, 555, "a@x.com"),
+    ]:
+        with pytest.raises((AttributeError, TypeError)):
+            table[bad.id] = bad
+
+    assert list(table) == [1]
+    assert table.version == version
+    assert table[1].first == "Alice"
+    assert table.email_owners("a@x.com") == {1}
+    assert [c.id for c in table.iter_search("a")] == [1]
+    assert [c.id for c in table.page(0, 10, "first")] == [1]
+
+
+def test_allocate_id_never_reuses_ids():
+    table = ContactTable({1: Contact(id_=1), 5: Contact(id_=5)})
+    assert table.allocate_id() == 6
+
+    table[7] = Contact(id_=7)
+    del table[7]
+    table.clear()
+    assert table.allocate_id() == 8
+
+
+def test_trigram_index_tracks_writes():
+    table = ContactTable({1: Contact(id_=1, first="Alice", email="al@x.com")})
+    # the postings are built by the first search which needs them
+    assert table.trigrams.postings is None
+    assert [c.id for c in table.search("lic")] == [1]
+    assert table.trigrams.candidates("lic") == [1]
+
+    table[1] = Contact(id_=1, first="Bob", email="al@x.com")
+    assert table.trigrams.candidates("lic") == []
+    # the index holds the folded search keys
+    assert table.trigrams.candidates("bob") == [1]
+
+    del table[1]
+    assert table.trigrams.postings == {}
+
+
+def test_trigram_postings_stay_sorted():
+    table = ContactTable({id_: Contact(id_=id_, first="Alice") for id_ in [2, 5, 9]})
+    table.search("lic")
+    table[7] = Contact(id_=7, first="Alice")
+    table[1] = Contact(id_=1, first="Malice")
+    del table[5]
+
+    assert list(table.trigrams.postings["lic"]) == [1, 2, 7, 9]
+    assert table.trigrams.candidates("malic") == [1]
+    assert [c.id for c in table.iter_search("alice", after_id=2)] == [7, 9]
+
+
+def test_search_equals_substring_scan():
+    rng = random.Random(0)
+    alphabet = "abAB@.-1 é"
+    word = lambda: "".join(rng.choices(alphabet, k=rng.randint(0, 8)))
+    table = ContactTable()
+    for i in range(1, 300):
+        table[i] = Contact(i, word(), word(), rng.choice([None, word()]), word())
+    for i in range(1, 300, 7):
+        del table[i]
+
+    for _ in range(300):
+        text = word()[:5]
+        expected = [c.id for c in table.values() if matches(c, text)]
+        assert [c.id for c in table.search(text)] == expected
+        after = expected[len(expected) // 2] if expected else 0
+        assert [c.id for c in table.iter_search(text, after)] == [
+            i for i in expected if i > after
+        ]
+
+
+def test_iter_search_is_lazy(monkeypatch):
+    monkeypatch.setattr("src.htmx_experiments.table.SCAN_CHUNK", 10)
+    table = ContactTable({i: Contact(i, f"n{i}") for i in range(1, 101)})
+    found = table.iter_search("n")
+    assert [next(found).id for _ in range(3)] == [1, 2, 3]
+    # deleted after the generator has started
+    del table[50]
+    table[200] = Contact(200, "n200")
+    assert [c.id for c in found][-2:] == [100, 200]
+    assert 50 not in [c.id for c in table.iter_search("n", after_id=40)]
+
+
+@pytest.mark.parametrize("table_type", [ContactTable, CompactTable])
+def test_search_ignores_case_accents_and_phone_punctuation(table_type):
+    table = table_type(Contact) if table_type is CompactTable else table_type()
+    table[1] = Contact(1, "Zoë", "Ørsted", "+1 (555) 010-2030", "ZOE@example.com")
+    table[2] = Contact(2, "Joe", "Straße", "555-0100", "joe@example.com")
+
+    for text, expected in [
+        ("zoe", [1]),
+        ("ZOË", [1]),
+        ("ørs", [1]),
+        ("strasse", [2]),
+        ("zoe@ex", [1]),
+        ("5550102", [1]),
+        ("555-01", [1, 2]),
+        ("(555) 010-2", [1]),
+        ("1-2", []),
+    ]:
+        assert [c.id for c in table.search(text)] == expected, text
+        assert [c.id for c in table.iter_search(text)] == expected, text
+    assert table.trigrams.keys[1] == "zoe\nørsted\nzoe@example.com\n15550102030"
+
+
+def test_ids_stay_sorted():
+    table = ContactTable({5: Contact(id_=5), 2: Contact(id_=2)})
+    table[9] = Contact(id_=9)
+    table[3] = Contact(id_=3)
+    table[5] = Contact(id_=5, first="again")
+    del table[2]
+
+    assert table.ids == [3, 5, 9]
+    assert [c.id for c in table.page(1, 3)] == [5, 9]
+
+
+def test_after():
+    table = ContactTable({i: Contact(id_=i) for i in range(1, 21) if i % 3})
+
+    assert [c.id for c in table.after(0, 3)] == [1, 2, 4]
+    assert [c.id for c in table.after(3, 3)] == [4, 5, 7]
+    assert [c.id for c in table.after(6, 3)] == [7, 8, 10]
+    assert [c.id for c in table.after(19, 3)] == [20]
+    assert table.after(20, 3) == []
+
+
+@pytest.mark.parametrize("table_type", [ContactTable, CompactTable])
+def test_sorted_pages(table_type):
+    table = table_type(Contact) if table_type is CompactTable else table_type()
+    table[1] = Contact(1, "bob", "Zed")
+    table[2] = Contact(2, "Ålice", "Young")
+    table[3] = Contact(3, "Bob", None)
+    table[4] = Contact(4, "carol", "Xu")
+
+    assert [c.id for c in table.page(0, 10, "first")] == [2, 1, 3, 4]
+    assert [c.id for c in table.page(1, 3, "first")] == [1, 3]
+    assert [c.id for c in table.page(0, 3, "-first")] == [4, 3, 1]
+    assert [c.id for c in table.page(3, 10, "-first")] == [2]
+    assert [c.id for c in table.page(0, 10, "last")] == [3, 4, 2, 1]
+    assert table.page(4, 10, "-last") == []
+    with pytest.raises(ValueError):
+        table.page(0, 10, "phone")
+
+    # writes after the first sorted page keep the order up to date
+    table[5] = Contact(5, "Aaron")
+    table[2] = Contact(2, "Dave", "Young")
+    del table[1]
+    assert [c.id for c in table.page(0, 10, "first")] == [5, 3, 4, 2]
+    assert [c.id for c in table.page(0, 10, "-first")] == [2, 4, 3, 5]
+    table.clear()
+    assert table.page(0, 10, "first") == []
+
+
+def test_id_map_stores_lone_ids_unwrapped():
+    ids = IdMap()
+    ids.add("a", 1)
+    assert ids == {"a": 1}
+
+    ids.add("a", 2)
+    assert ids.ids("a") == {1, 2}
+
+    ids.discard("a", 1)
+    assert ids == {"a": 2}
+    ids.discard("a", 2)
+    assert ids == {}
+    assert ids.ids("a") == set()
+
+
+def test_compact_table_materializes_rows():
+    table = CompactTable(Contact)
+    table[1] = Contact(id_=1, first="Alice", last="Smith", email="a@example.com")
+    table[2] = Contact(id_=2, first="Bob", last="Smith", email="b@example.com")
+
+    # lengths, -1 for None, then the encoded fields
+    assert table.data[1] == RECORD.pack(5, 5, -1, 13) + b"AliceSmitha@example.com"
+    assert table.fields(table.data[1]) == ("Alice", "Smith", None, "a@example.com")
+
+    alice = table[1]
+    assert isinstance(alice, Contact)
+    assert alice is not table[1]
+    assert alice.errors == {}
+    assert [c.id for c in table.search("Smith")] == [1, 2]
+    assert table.emails.owners("b@example.com") == {2}
+
+    # changes only stick once written back
+    alice.update("Alice", "Jones", None, "a@example.com")
+    assert table[1].last == "Smith"
+    table[1] = alice
+    assert table[1].last == "Jones"
+    assert [c.id for c in table.search("Jones")] == [1]
+
+
+def test_compact_rows_take_less_memory():
+    def rows_size(table) -> int:
+        table.indexes = []  # the same for both tables
+        tracemalloc.start()
+        try:
+            for i in range(1, 1001):
+                table[i] = Contact(i, f"F{i}", f"L{i}", f"555-{i:07d}", f"c{i}@x.com")
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    # see benchmarks/bench_memory.py for the whole tables
+    assert rows_size(CompactTable(Contact)) < 0.6 * rows_size(ContactTable())
+
+
+def test_concurrent_reads_and_writes():
+    table = ContactTable(
+        {i: Contact(i, f"N{i}", "Smith", None, f"n{i}@x.com") for i in range(1, 200)}
+    )
+    errors = []
+    stop = threading.Event()
+    writers = threading.Lock()
+
+    def hammer(work):
+        try:
+            while not stop.is_set():
+                work()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def write():
+        id_ = random.randint(1, 400)
+        # like `Contact.lock`, writers are serialized by the caller
+        with writers:
+            if random.random() < 0.4 and id_ in table:
+                del table[id_]
+            else:
+                table[id_] = Contact(
+                    id_,
+                    f"N{id_}",
+                    random.choice(["Smith", "Jones"]),
+                    None,
+                    f"n{id_}@x.com",
+                )
+
+    def read():
+        assert all(matches(c, "Smi") for c in table.search("Smi"))
+        assert all(matches(c, "N") for c in table.search("N"))
+        ids = [c.id for c in table.page(0, 50)]
+        assert ids == sorted(ids)
+        table.after(random.randint(0, 400), 20)
+        table.email_owners("n7@x.com")
+        len(table.values())
+        list(table)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=hammer, args=(write,)) for _ in range(2)]
+        threads += [threading.Thread(target=hammer, args=(read,)) for _ in range(6)]
+        for t in threads:
+            t.start()
+        time.sleep(1)
+        stop.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    # the indexes still describe the rows
+    assert table.ids == sorted(table.data)
+    assert [c.id for c in table.search("Jones")] == [
+        c.id for c in table.values() if c.last == "Jones"
+    ]
+    assert all(table.emails.owners(c.email) == {c.id} for c in table.values())
@@ -0,0 +1,144 @@
+import gzip
+import importlib.util
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# the apps import the package as `htmx_experiments`, like when they are served
+sys.path.insert(0, str(ROOT / "src"))
+spec = importlib.util.spec_from_file_location("web5_app", ROOT / "apps/web5/app.py")
+web5 = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = web5
+spec.loader.exec_module(web5)
+
+from htmx_experiments.table import ContactTable  # noqa: E402
+
+Contact = web5.Contact
+
+ROWS = [
+    {"id": 1, "first": "Alice", "last": "Smith", "phone": None, "email": "a@x.com"},
+    {"id": 2, "first": "Bob", "last": "Jones", "phone": None, "email": "b@x.com"},
+]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    "The app serving `ROWS` from a temporary data directory."
+    (tmp_path / "contacts.json").write_text(json.dumps(ROWS))
+    monkeypatch.setattr(web5.htmx_contact, "DATA_DIR", ".")
+    monkeypatch.setattr(Contact, "db", ContactTable())
+    monkeypatch.setattr(Contact, "loader", None)
+    return web5.create_app(data_dir=tmp_path, warm_up=False).test_client()
+
+
+def test_email_validation_leaves_the_contact_alone(client):
+    assert client.get("/contacts/1/email?email=z@x.com").text == ""
+    assert client.get("/contacts/1/email?email=b@x.com").text == "Email Must Be Unique"
+
+    assert Contact.find(1).email == "a@x.com"
+    assert Contact.db.email_owners("a@x.com") == {1}
+    assert Contact.db.email_owners("z@x.com") == set()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        [],
+        {"save": {}},
+        {"save": [1]},
+        {"save": [{"id": "2", "email": "n@x.com"}]},
+        {"save": [{"first": 5, "email": "n@x.com"}]},
+        {"save": [{"email": ["n@x.com"]}]},
+        {"delete": ["1"]},
+        {"delete": [True]},
+    ],
+)
+def test_bulk_rejects_malformed_bodies(client, body, tmp_path):
+    saved = (tmp_path / "contacts.json").read_text()
+
+    response = client.post("/api/v1/contacts/bulk", json=body)
+    assert response.status_code == 400
+    assert "body" in response.json["errors"]
+
+    assert [c.id for c in Contact.all()] == [1, 2]
+    assert client.get("/contacts?q=a").status_code == 200
+    assert (tmp_path / "contacts.json").read_text() == saved
+
+
+def test_bulk_reports_contacts_changed_twice(client):
+    response = client.post("/api/v1/contacts/bulk", json={"delete": [2, 2]})
+
+    assert response.status_code == 400
+    assert (
+        response.json["errors"]["delete"]
+        == [{"id": "Contact Changed More Than Once"}] * 2
+    )
+    assert [c.id for c in Contact.all()] == [1, 2]
+
+
+def test_bulk_saves_and_deletes(client, tmp_path):
+    body = {
+        "save": [{"id": 1, "first": "Al", "email": "a@x.com"}, {"email": "c@x.com"}],
+        "delete": [2],
+    }
+    response = client.post("/api/v1/contacts/bulk", json=body)
+
+    assert response.status_code == 200
+    assert [c["id"] for c in response.json["contacts"]] == [1, 3]
+    assert response.json["deleted"] == [2]
+    saved = json.loads((tmp_path / "contacts.json").read_text())
+    assert [(c["id"], c["first"]) for c in saved["contacts"]] == [(1, "Al"), (3, None)]
+
+
+def test_health_and_readiness(client):
+    assert client.get("/healthz").text == "ok"
+    # the contacts load on first use
+    assert client.get("/readyz").status_code == 503
+
+    assert client.get("/contacts").status_code == 200
+    assert client.get("/readyz").status_code == 200
+
+
+def archive(client, format_="json") -> str:
+    "Runs an archive job to completion, returns its id."
+    client.post("/contacts/archive", data={"format": format_})
+    with client.session_transaction() as session:
+        job_id = session["archive_job"]
+    for _ in range(200):
+        if web5.Archiver.get(job_id).status() == "Complete":
+            return job_id
+        time.sleep(0.01)
+    raise AssertionError(web5.Archiver.get(job_id).status())
+
+
+def test_archive_download(client):
+    job_id = archive(client)
+    url = f"/contacts/archive/{job_id}/file"
+
+    gzipped = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert gzipped.status_code == 200
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzipped.headers["Vary"] == "Accept-Encoding"
+    contacts = json.loads(gzip.decompress(gzipped.data))["contacts"]
+    assert [c["id"] for c in contacts] == [1, 2]
+
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert json.loads(plain.data)["contacts"] == contacts
+    assert plain.headers["ETag"] == gzipped.headers["ETag"]
+
+    cached = client.get(url, headers={"If-None-Match": gzipped.headers["ETag"]})
+    assert cached.status_code == 304
+    assert client.get("/contacts/archive/nope/file").status_code == 404
+
+
+def test_archive_events_end_once_complete(client):
+    job_id = archive(client)
+
+    response = client.get(f"/contacts/archive/{job_id}/events")
+    assert response.mimetype == "text/event-stream"
+    assert response.text == "event: done\ndata: \n\n"